@@ -60,6 +60,34 @@ config["USER_API"] = "https://%s/user" % conf_data.get(
 )  # for use by authutils
 # use the USER_API URL instead of the public issuer URL to accquire JWT keys
 config["FORCE_ISSUER"] = True
+# async transaction workers (see sheepdog.api.async_init)
+for key in [
+    "ASYNC_WORKERS",
+    "ASYNC_MAX_Q_LEN",
+    "ASYNC_DRAIN_TIMEOUT",
+    "ASYNC_UPLOAD_PROCESSES",
+    "ASYNC_QUEUE_POLL_INTERVAL",
+    "ASYNC_QUEUE_LEASE_SECONDS",
+    "ASYNC_PROJECT_MAX_Q_LEN",
+    "ASYNC_PROJECT_CONCURRENCY",
+    "ASYNC_RETRY_AFTER",
+]:
+    if os.environ.get(key):
+        config[key] = int(os.environ[key])
+# "thread", "process" (upload processes; other async transactions run in
+# threads) or "database" (all async transactions are queued durably, see
+# sheepdog.utils.transaction_queue)
+config["ASYNC_UPLOAD_BACKEND"] = os.environ.get("ASYNC_UPLOAD_BACKEND", "thread")
+# storage of submitted documents (see sheepdog.utils.document_store); only
+# sheepdog decodes them, other readers of transaction_documents.doc get the
+# compressed documents or object references
+config["DOCUMENT_STORE"] = conf_data.get("document_store", {})
+# cache of authorization decisions (see sheepdog.auth.cache)
+config["AUTHZ_CACHE"] = conf_data.get("authz_cache", {})
+# threads creating the Arborist resources of uploads (see sheepdog.auth)
+if os.environ.get("ARBORIST_SYNC_WORKERS"):
+    config["ARBORIST_SYNC_WORKERS"] = int(os.environ["ARBORIST_SYNC_WORKERS"])
+
 config["DICTIONARY_URL"] = os.environ.get(
     "DICTIONARY_URL",
     "https://s3.amazonaws.com/dictionary-artifacts/datadictionary/develop/schema.json",
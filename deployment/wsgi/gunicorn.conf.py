@@ -8,3 +8,10 @@ timeout = 300
 graceful_timeout = 45
 keepalive = 10
 pidfile = "/sheepdog/gunicorn.pid"
+
+
+def worker_exit(server, worker):
+    # let async transactions queued in this worker finish
+    from sheepdog.api import app, async_drain
+
+    async_drain(app)
@@ -1,5 +1,7 @@
+import functools
 import os
 import sys
+import time
 import importlib
 import logging
 import traceback
@@ -17,17 +19,39 @@ from gen3authz.client.arborist.client import ArboristClient
 
 
 import sheepdog
+from sheepdog import auth
 from sheepdog.errors import (
     APIError,
     setup_default_handlers,
     UnhealthyCheck,
 )
 from sheepdog.version_data import VERSION, COMMIT
-from sheepdog.globals import dictionary_version, dictionary_commit
+from sheepdog.globals import (
+    ASYNC_MAX_Q_LEN,
+    ASYNC_RETRY_AFTER,
+    dictionary_version,
+    dictionary_commit,
+)
+from sheepdog.utils.scheduling import AsyncPool, AsyncProcessPool
+from sheepdog.utils.document_store import (
+    decode_stored_documents,
+    document_store_from_config,
+)
+from sheepdog.utils.transaction_queue import (
+    DatabaseTransactionQueue,
+    migrate_transaction_queue,
+)
 
 # recursion depth is increased for complex graph traversals
 sys.setrecursionlimit(10000)
 DEFAULT_ASYNC_WORKERS = 8
+DEFAULT_ASYNC_PROCESSES = 2
+#: Seconds to wait for queued async transactions when a worker shuts down,
+#: across all the pools: keep it below gunicorn's graceful_timeout (see
+#: deployment/wsgi/gunicorn.conf.py)
+DEFAULT_ASYNC_DRAIN_TIMEOUT = 30
+DEFAULT_ASYNC_QUEUE_POLL_INTERVAL = 1
+DEFAULT_ASYNC_QUEUE_LEASE_SECONDS = 300
 
 
 def app_register_blueprints(app):
@@ -62,12 +86,12 @@ def app_register_blueprints(app):
     app.register_blueprint(sheepdog_blueprint, url_prefix="/submission")
 
 
-def db_init(app):
-    app.logger.info("Initializing PsqlGraph driver")
+def new_db_driver(app):
+    """Return a new PsqlGraph driver configured from ``app.config``."""
     connect_args = {}
     if app.config.get("PSQLGRAPH") and app.config["PSQLGRAPH"].get("sslmode"):
         connect_args["sslmode"] = app.config["PSQLGRAPH"]["sslmode"]
-    app.db = PsqlGraphDriver(
+    return PsqlGraphDriver(
         host=app.config["PSQLGRAPH"]["host"],
         user=app.config["PSQLGRAPH"]["user"],
         password=app.config["PSQLGRAPH"]["password"],
@@ -78,6 +102,16 @@ def db_init(app):
             "isolation_level", "READ_COMMITTED"
         ),
     )
+
+
+def db_init(app):
+    app.logger.info("Initializing PsqlGraph driver")
+    app.db = new_db_driver(app)
+    # Where submitted documents are saved, see sheepdog.utils.document_store
+    app.document_store = document_store_from_config(app.config.get("DOCUMENT_STORE"))
+    decode_stored_documents(
+        models.submission.TransactionDocument, app.document_store
+    )
     if app.config.get("AUTO_MIGRATE_DATABASE"):
         migrate_database(app)
 
@@ -93,6 +127,7 @@ def migrate_database(app):
     # hardcoded read role
     read_role = "peregrine"
     postgres_admin.migrate_transaction_snapshots(app.db)
+    migrate_transaction_queue(app.db)
     if postgres_admin.check_version(app.db):
         return
     try:
@@ -128,6 +163,110 @@ def migrate_database(app):
             return
 
 
+def async_init(app):
+    """
+    Start the pool of workers that runs transactions submitted with
+    ``?async=true``.
+    """
+    app.config["ASYNC_WORKERS"] = app.config.get("ASYNC_WORKERS", DEFAULT_ASYNC_WORKERS)
+    app.config["ASYNC_MAX_Q_LEN"] = app.config.get("ASYNC_MAX_Q_LEN", ASYNC_MAX_Q_LEN)
+    app.config["ASYNC_DRAIN_TIMEOUT"] = app.config.get(
+        "ASYNC_DRAIN_TIMEOUT", DEFAULT_ASYNC_DRAIN_TIMEOUT
+    )
+    app.config["ASYNC_UPLOAD_BACKEND"] = app.config.get(
+        "ASYNC_UPLOAD_BACKEND", "thread"
+    )
+    # By default a single project may fill half the queue and the workers
+    app.config["ASYNC_PROJECT_MAX_Q_LEN"] = app.config.get(
+        "ASYNC_PROJECT_MAX_Q_LEN", max(app.config["ASYNC_MAX_Q_LEN"] // 2, 1)
+    )
+    app.config["ASYNC_PROJECT_CONCURRENCY"] = app.config.get(
+        "ASYNC_PROJECT_CONCURRENCY", max(app.config["ASYNC_WORKERS"] // 2, 1)
+    )
+    app.config["ASYNC_RETRY_AFTER"] = app.config.get(
+        "ASYNC_RETRY_AFTER", ASYNC_RETRY_AFTER
+    )
+
+    # Fork upload processes before starting any threads
+    if app.config["ASYNC_UPLOAD_BACKEND"] == "process":
+        app.config["ASYNC_UPLOAD_PROCESSES"] = app.config.get(
+            "ASYNC_UPLOAD_PROCESSES", DEFAULT_ASYNC_PROCESSES
+        )
+        app.async_upload_pool = AsyncProcessPool(
+            max_queue_len=app.config["ASYNC_MAX_Q_LEN"],
+            initializer=functools.partial(async_process_init, app),
+            retry_after=app.config["ASYNC_RETRY_AFTER"],
+        )
+        # db_init (and migrations) opened connections: drop them so that the
+        # forked processes don't inherit sockets shared with this one
+        app.db.engine.dispose()
+        app.async_upload_pool.start(app.config["ASYNC_UPLOAD_PROCESSES"])
+        app.logger.info(
+            "Started {} async upload processes".format(
+                app.config["ASYNC_UPLOAD_PROCESSES"]
+            )
+        )
+
+    app.async_pool = AsyncPool(
+        max_queue_len=app.config["ASYNC_MAX_Q_LEN"],
+        max_project_queue_len=app.config["ASYNC_PROJECT_MAX_Q_LEN"],
+        project_concurrency=app.config["ASYNC_PROJECT_CONCURRENCY"],
+        retry_after=app.config["ASYNC_RETRY_AFTER"],
+    )
+    app.async_pool.start(app.config["ASYNC_WORKERS"])
+    app.logger.info("Started {} async workers".format(app.config["ASYNC_WORKERS"]))
+
+    if app.config["ASYNC_UPLOAD_BACKEND"] == "database":
+        app.config["ASYNC_QUEUE_POLL_INTERVAL"] = app.config.get(
+            "ASYNC_QUEUE_POLL_INTERVAL", DEFAULT_ASYNC_QUEUE_POLL_INTERVAL
+        )
+        app.config["ASYNC_QUEUE_LEASE_SECONDS"] = app.config.get(
+            "ASYNC_QUEUE_LEASE_SECONDS", DEFAULT_ASYNC_QUEUE_LEASE_SECONDS
+        )
+        app.async_upload_pool = DatabaseTransactionQueue(
+            app,
+            poll_interval=app.config["ASYNC_QUEUE_POLL_INTERVAL"],
+            lease_seconds=app.config["ASYNC_QUEUE_LEASE_SECONDS"],
+        )
+        # all async transactions are queued durably, not only uploads
+        app.async_transaction_queue = app.async_upload_pool
+        app.async_upload_pool.start(app.config["ASYNC_WORKERS"])
+        app.logger.info(
+            "Started {} async queue workers".format(app.config["ASYNC_WORKERS"])
+        )
+    elif app.config["ASYNC_UPLOAD_BACKEND"] != "process":
+        app.async_upload_pool = app.async_pool
+
+
+def async_process_init(app):
+    """
+    Prepare a forked async upload process: connections inherited from the
+    parent must not be shared, so the process gets its own PsqlGraph driver.
+    """
+    app.db = new_db_driver(app)
+    app.app_context().push()
+
+
+def async_drain(app):
+    """
+    Let queued and running async transactions finish before the process
+    exits. Called from gunicorn's ``worker_exit`` hook.
+    """
+    async_pool = getattr(app, "async_pool", None)
+    if async_pool is None:
+        return
+    app.logger.info("Draining async workers")
+    # one deadline for all the pools, which must be within gunicorn's
+    # graceful_timeout for the worker to exit cleanly
+    deadline = time.time() + app.config.get(
+        "ASYNC_DRAIN_TIMEOUT", DEFAULT_ASYNC_DRAIN_TIMEOUT
+    )
+    async_upload_pool = getattr(app, "async_upload_pool", async_pool)
+    if async_upload_pool is not async_pool:
+        async_upload_pool.drain(timeout=max(deadline - time.time(), 0))
+    async_pool.drain(timeout=max(deadline - time.time(), 0))
+
+
 def app_init(app):
     # Register duplicates only at runtime
     app.logger.info("Initializing app")
@@ -143,6 +282,11 @@ def app_init(app):
         # If True, enforce indexd record exists before file node registration
         app.config.get("REQUIRE_FILE_INDEX_EXISTS", False)
     )
+    app.config["STREAM_DELIMITED_UPLOADS"] = (
+        # If True, synchronous TSV/CSV uploads are read from the request
+        # stream a chunk of rows at a time
+        app.config.get("STREAM_DELIMITED_UPLOADS", True)
+    )
 
     if app.config.get("USE_USER_HARAKIRI", True):
         setup_user_harakiri(app)
@@ -151,6 +295,7 @@ def app_init(app):
 
     app_register_blueprints(app)
     db_init(app)
+    async_init(app)
     # exclude es init as it's not used yet
     # es_init(app)
     try:
@@ -165,6 +310,8 @@ def app_init(app):
     else:
         app.logger.info("Using default Arborist base URL")
         app.auth = ArboristClient()
+    # Cache of Arborist decisions, see sheepdog.auth.cache
+    auth.configure_authz_cache(app.config.get("AUTHZ_CACHE"))
 
 
     app.node_authz_entity_name = os.environ.get("AUTHZ_ENTITY_NAME", None)
@@ -222,6 +369,53 @@ def health_check():
     return "Healthy", 200
 
 
+@app.route("/_status/async", methods=["GET"])
+def async_status():
+    """
+    Returns the state of the async transaction workers
+    ---
+    tags:
+      - system
+    responses:
+      200:
+        description: queue depth and number of in-flight transactions
+    """
+    async_pool = getattr(app, "async_pool", None)
+    if async_pool is None:
+        return jsonify(message="Async workers are not running"), 503
+    status = _aggregate_status(async_pool.status())
+    async_upload_pool = getattr(app, "async_upload_pool", async_pool)
+    if async_upload_pool is not async_pool:
+        status["upload_processes"] = _aggregate_status(async_upload_pool.status())
+    return jsonify(status), 200
+
+
+def _aggregate_status(status):
+    """
+    Return the counts of a pool status, without the transaction and project
+    ids, as the endpoint is not authenticated.
+    """
+    projects = status.pop("projects", None)
+    status.pop("in_flight", None)
+    if projects is not None:
+        status["project_count"] = len(projects)
+    return status
+
+
+@app.route("/_status/authz_cache", methods=["GET"])
+def authz_cache_status():
+    """
+    Returns the hit and miss counters of this process' authz cache
+    ---
+    tags:
+      - system
+    responses:
+      200:
+        description: authz cache backend and counters
+    """
+    return jsonify(auth.AUTHZ_CACHE.status()), 200
+
+
 @app.route("/_version", methods=["GET"])
 def version():
     """
@@ -264,9 +458,18 @@ def _log_and_jsonify_exception(e):
         return jsonify(message=e.message), e.code
 
 
+def _too_many_requests(e):
+    """Like ``_log_and_jsonify_exception``, but also set ``Retry-After``."""
+    response, code = _log_and_jsonify_exception(e)
+    if e.retry_after is not None:
+        response.headers["Retry-After"] = str(e.retry_after)
+    return response, code
+
+
 app.register_error_handler(APIError, _log_and_jsonify_exception)
 
 app.register_error_handler(sheepdog.errors.APIError, _log_and_jsonify_exception)
+app.register_error_handler(sheepdog.errors.TooManyRequestsError, _too_many_requests)
 app.register_error_handler(AuthError, _log_and_jsonify_exception)
 
 
@@ -7,23 +7,32 @@ or
 ``pip install git+https://git@github.com/uc-cdis/authutils.git@1.2.3#egg=authutils``
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import functools
 
-from authutils.user import current_user
-from authutils.token.validate import current_token
-from cachelib import SimpleCache
+from authutils.user import CurrentUser, set_current_user
+from authutils.token.validate import current_token, set_current_token
 from cdislogging import get_logger
 import flask
 import jwt
+from sqlalchemy.orm import aliased
 import time
+from werkzeug.local import LocalProxy
 
+from sheepdog.auth.cache import AuthzCache, DEFAULT_MAX_STALENESS, LRUCache
+from sheepdog.auth.mapping import get_auth_mapping_trie
 from sheepdog.errors import AuthNError, AuthZError
 from sheepdog.globals import ROLES
 
 
 logger = get_logger(__name__)
-CACHE_SECONDS = 1
-AUTHZ_CACHE = SimpleCache(default_timeout=CACHE_SECONDS)
+CACHE_SECONDS = DEFAULT_MAX_STALENESS
+#: Configured from the AUTHZ_CACHE setting by configure_authz_cache
+AUTHZ_CACHE = AuthzCache(max_staleness=CACHE_SECONDS)
+#: Default number of threads creating Arborist resources
+RESOURCE_SYNC_WORKERS = 8
+#: Arborist resources known to exist, see sync_resources
+KNOWN_RESOURCES = LRUCache(max_size=100000, default_timeout=3600)
 try:
     from authutils.token.validate import validate_request
 except ImportError:
@@ -33,6 +42,42 @@ except ImportError:
     )
 
 
+def _get_current_user():
+    user = getattr(flask.g, "transaction_user", None)
+    if user is not None:
+        return user
+    return set_current_user()
+
+
+#: The user of the request, or of the async transaction being run (see
+#: :func:`set_transaction_user`)
+current_user = LocalProxy(_get_current_user)
+
+
+def get_transaction_user():
+    """
+    Return the user of the current request as needed to run a transaction
+    on their behalf once the request is gone (see
+    :func:`set_transaction_user`). The user's token is not included.
+    """
+    return {"id": current_user.id, "username": current_user.username}
+
+
+def set_transaction_user(user):
+    """
+    Make ``user`` (see :func:`get_transaction_user`) the current user of the
+    app context, to run an async transaction outside of its request.
+    """
+    claims = {"sub": user["id"], "context": {"user": {"name": user["username"]}}}
+    flask.g.transaction_user = CurrentUser(claims=claims)
+    set_current_token(claims)
+
+
+def configure_authz_cache(config):
+    """Set up ``AUTHZ_CACHE`` as described by the ``AUTHZ_CACHE`` setting."""
+    AUTHZ_CACHE.configure(config)
+
+
 def get_jwt_from_header():
     jwt_token = None
     auth_header = flask.request.headers.get("Authorization")
@@ -46,13 +91,16 @@ def get_jwt_from_header():
 
 
 def check_if_jwt_close_to_expiry(jwt_token):
-    """Check if a JWT is close to expiry based on `CACHE_SECONDS`."""
+    """
+    Check if a JWT is close to expiry based on the configured
+    ``AUTHZ_CACHE.max_staleness``.
+    """
     try:
         # decode the JWT to check its expiration, use verify_signature=False to skip signature verification
         decoded_token = jwt.decode(jwt_token, options={"verify_signature": False})
 
-        # The token is considered "close to expiry" if it expires within the next CACHE_SECONDS seconds.
-        return decoded_token.get("exp", 0) < time.time() + CACHE_SECONDS
+        # The token is considered "close to expiry" if it expires before a decision cached now would.
+        return decoded_token.get("exp", 0) < time.time() + AUTHZ_CACHE.max_staleness
     except jwt.exceptions.DecodeError as e:
         logger.error(f"Unable to decode jwt token: {e}")
         raise AuthNError("Didn't receive JWT correctly")
@@ -140,100 +188,269 @@ def authorize(program, project, roles, resource_list=None):
 
     jwt_token = get_jwt_from_header()
     jwt_close_to_expiry = check_if_jwt_close_to_expiry(jwt_token)
-    cache_key = f"{jwt_token}_{roles}_{resource}"
+    cache_key = AUTHZ_CACHE.key(jwt_token, roles, resources)
     authz = None
 
-    if not jwt_close_to_expiry and AUTHZ_CACHE.has(cache_key):
+    if not jwt_close_to_expiry:
         authz = AUTHZ_CACHE.get(cache_key)
-    else:
+    if authz is None:
         authz = flask.current_app.auth.auth_request(
-            jwt=jwt_token, service="sheepdog", methods=roles, resources=[resource]
+            jwt=jwt_token, service="sheepdog", methods=roles, resources=resources
         )
-        AUTHZ_CACHE.set(cache_key, authz)
+        AUTHZ_CACHE.set(cache_key, authz, jwt_token)
 
     if not authz:
         raise AuthZError("user is unauthorized")
 
 
+class AuthorizationContext(object):
+    """
+    Memo of the authorization decisions made during one transaction, in
+    front of ``AUTHZ_CACHE``: each ``(roles, resource)`` is authorized once
+    and the decision is reused for every entity of the transaction.
+
+    An async transaction run outside of its request has no token to
+    authorize with: it gets the decisions made when it was scheduled (see
+    :meth:`to_json`), and is denied anything else.
+    """
+
+    def __init__(self, decisions=None, resolved_only=False):
+        self._decisions = decisions or {}
+        self.resolved_only = resolved_only
+
+    def authorize(self, program, project, roles, resource_list=None):
+        """Same as :func:`authorize`, resolved once per transaction."""
+        key = (program, project, tuple(roles), tuple(resource_list or ()))
+        if key not in self._decisions:
+            if self.resolved_only:
+                raise AuthZError("user is unauthorized")
+            try:
+                authorize(program, project, roles, resource_list)
+                self._decisions[key] = None
+            except AuthZError as e:
+                self._decisions[key] = e
+        if self._decisions[key] is not None:
+            raise self._decisions[key]
+
+    def resolve(self, program, project, roles, resource_list=None):
+        """Make the decision for ``roles`` now, e.g. before scheduling."""
+        try:
+            self.authorize(program, project, roles, resource_list)
+        except AuthZError:
+            pass
+
+    def to_json(self):
+        """Return the decisions made so far."""
+        return [
+            {
+                "program": program,
+                "project": project,
+                "roles": list(roles),
+                "resource_list": list(resource_list),
+                "authorized": error is None,
+            }
+            for (program, project, roles, resource_list), error in (
+                self._decisions.items()
+            )
+        ]
+
+    @classmethod
+    def from_json(cls, doc):
+        """Return a context making only the decisions of :meth:`to_json`."""
+        decisions = {
+            (
+                decision["program"],
+                decision["project"],
+                tuple(decision["roles"]),
+                tuple(decision["resource_list"]),
+            ): (None if decision["authorized"] else AuthZError("user is unauthorized"))
+            for decision in doc or []
+        }
+        return cls(decisions, resolved_only=True)
+
+
 def create_resource(program, project=None, data=None):
     resource = "/programs/{}".format(program)
 
     if project:
         resource += "/projects/{}".format(project)
 
-    if isinstance(data, list):
-        for d in data:
-            get_and_create_resource_values(resource, d)
-    else:
-        get_and_create_resource_values(resource, data)
+    if not isinstance(data, list):
+        data = [data]
+    paths = []
+    for d in data:
+        # resources are created after the fact: an entity whose path can't
+        # be built is logged and skipped rather than failing the request
+        try:
+            path = get_resource_path(resource, d)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Unable to get the resource path of {}: {}".format(d, e))
+            continue
+        if path is not None:
+            paths.append(path)
+    sync_resources(paths)
 
 
-def get_and_create_resource_values(resource, data):
+def get_resource_path(resource, data):
+    """
+    Return the path of the Arborist resource of the entity ``data``, or None
+    if a submitter id it needs is missing. Links and entities given by id
+    (e.g. in merged documents) are looked up for their submitter id.
+    """
     stop_node = flask.current_app.node_authz_entity
     person_node = flask.current_app.subject_entity
-    if data and data["type"] == person_node.label:
-        resource += "/persons/{}".format(data["submitter_id"])
-    elif data and data["type"] == stop_node.label:
-        person = None
-        if isinstance(data["persons"], list):
-            person = data["persons"][0]
-        else:
-            person = data["persons"]
-        resource += "/persons/{}/subjects/{}".format(person["submitter_id"], data["submitter_id"])
-    logger.warn(resource)
+    if data and person_node is not None and data["type"] == person_node.label:
+        person_id = get_submitter_id(person_node, data)
+        if person_id is None:
+            logger.warning("No submitter_id for {} {}".format(data["type"], data))
+            return None
+        resource += "/persons/{}".format(person_id)
+    elif data and stop_node is not None and data["type"] == stop_node.label:
+        person = data.get("persons")
+        if isinstance(person, list):
+            person = person[0] if person else None
+        person_id = get_submitter_id(person_node, person) if person else None
+        subject_id = get_submitter_id(stop_node, data)
+        if person_id is None or subject_id is None:
+            logger.warning(
+                "No person or submitter_id for {} {}".format(data["type"], data)
+            )
+            return None
+        resource += "/persons/{}/subjects/{}".format(person_id, subject_id)
+    return resource
+
+
+def get_submitter_id(cls, data):
+    """
+    Return the submitter id of the ``cls`` entity (or link) ``data``,
+    looking it up by id if it only has one.
+    """
+    if data.get("submitter_id"):
+        return data["submitter_id"]
+    if cls is None or not data.get("id"):
+        return None
+    db = flask.current_app.db
+    with db.session_scope(can_inherit=False):
+        node = db.nodes(cls).ids(data["id"]).first()
+        return node.props.get("submitter_id") if node is not None else None
+
+
+def sync_resources(paths):
+    """
+    Create the Arborist resources at ``paths``: each path is only sent once,
+    paths known to exist are skipped, and the others are created
+    concurrently by up to ``ARBORIST_SYNC_WORKERS`` threads.
+    """
+    paths = [path for path in dict.fromkeys(paths) if not KNOWN_RESOURCES.has(path)]
+    if not paths:
+        return
+    client = flask.current_app.auth
+    workers = flask.current_app.config.get(
+        "ARBORIST_SYNC_WORKERS", RESOURCE_SYNC_WORKERS
+    )
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        created = executor.map(
+            functools.partial(_create_arborist_resource, client), paths
+        )
+        for path, path_created in zip(paths, created):
+            if path_created:
+                KNOWN_RESOURCES.set(path, True)
 
 
+def _create_arborist_resource(client, resource):
     logger.info("Creating arborist resource {}".format(resource))
 
     json_data = {
         "name": resource,
         "description": "Created by sheepdog",  # TODO use authz provider field
     }
-    resp = flask.current_app.auth.create_resource(
-        parent_path="", resource_json=json_data, create_parents=True
-    )
-    if resp and resp.get("error"):
-        logger.error(
-            "Unable to create resource: code {} - {}".format(
-                resp.error.code, resp.error.message
-            )
+    try:
+        resp = client.create_resource(
+            parent_path="", resource_json=json_data, create_parents=True
         )
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Unable to create resource {}: {}".format(resource, e))
+        return False
+    if resp and resp.get("error"):
+        logger.error("Unable to create resource {}: {}".format(resource, resp["error"]))
+        return False
+    return True
 
 
-def check_resource_access(program, project, nodes):
-    subject_submitter_ids = []
-    stop_node = flask.current_app.node_authz_entity_name
+def get_subject_path(cls, link, stop_node):
+    """
+    Return the ``(edge class, destination class)`` hops from ``cls`` through
+    ``link`` up to the ``stop_node`` type, following the first link of each
+    ancestor type, or None if the path ends at the program instead.
+    """
+    hops = [get_link_hop(cls, link)]
+    tmp = hops[-1][1]
+    while tmp.label != stop_node and tmp.label != "program":
+        # assuming ony one parents
+        node_type = list(tmp._pg_links.keys())[0]
+        hops.append(get_link_hop(tmp, node_type))
+        tmp = hops[-1][1]
+    return hops if tmp.label == stop_node else None
+
+
+def get_link_hop(cls, link):
+    """Return the ``(edge class, destination class)`` of the ``cls`` link."""
+    edge_out = cls._pg_links[link]["edge_out"]
+    edge_cls = getattr(cls, edge_out).property.mapper.class_
+    return edge_cls, cls._pg_links[link]["dst_type"]
+
+
+def join_subject_path(query, cls, hops):
+    """
+    Join ``query`` on ``cls`` along ``hops`` (see :func:`get_subject_path`)
+    and select the ``(id, submitter_id)`` of the entities at its end.
+    """
+    src = cls
+    for edge_cls, dst_cls in hops:
+        edge, dst = aliased(edge_cls), aliased(dst_cls)
+        query = query.join(edge, edge.src_id == src.node_id).join(
+            dst, dst.node_id == edge.dst_id
+        )
+        src = dst
+    return query.with_entities(
+        src.node_id, src._props["submitter_id"].astext
+    ).distinct()
 
+
+def resolve_subjects(nodes, stop_node):
+    """
+    Return the ``(id, submitter_id)`` of the ``stop_node`` entities owning
+    ``nodes``, with one query per label and link that joins the path up to
+    the stop node for all the nodes of that label at once.
+    """
+    subjects = set()
+    ids_by_class = {}
     for node in nodes:
         if node.label == stop_node:
-            subject_submitter_ids.append({"id": node.node_id, "submitter_id": node.props.get("submitter_id", None)})
+            subjects.add((node.node_id, node.props.get("submitter_id", None)))
         else:
-            for link in node._pg_links:
-                tmp_dads = getattr(node, link, None)
-                if tmp_dads:
-                    tmp_dad = tmp_dads[0]
-                    nodeType = link
-                    path_tmp = nodeType
-                    tmp = node._pg_links[link]["dst_type"]
-                    while tmp.label != stop_node and tmp.label != "program":
-                        # assuming ony one parents
-                        nodeType = list(tmp._pg_links.keys())[0]
-                        path_tmp = path_tmp + "." + nodeType
-                        tmp = tmp._pg_links[nodeType]["dst_type"]
-                        # TODO double check this with deeper relationship > 2 nodes under project
-                        tmp_dad = getattr(tmp_dad, nodeType)[0]
-
-                    if tmp.label == stop_node:
-                        subject_submitter_ids.append({"id": tmp_dad.node_id, "submitter_id": tmp_dad.props.get("submitter_id", None)})
-                    else:
-                        logger.warn("resource not found " + node.label)
-                        logger.warn(node)
+            ids_by_class.setdefault(type(node), []).append(node.node_id)
+
+    for cls, node_ids in ids_by_class.items():
+        for link in cls._pg_links:
+            hops = get_subject_path(cls, link, stop_node)
+            if hops is None:
+                logger.warn("resource not found " + cls.label)
+                continue
+            query = flask.current_app.db.nodes(cls).ids(node_ids)
+            query = join_subject_path(query, cls, hops)
+            subjects.update(tuple(row) for row in query.all())
+    return subjects
+
+
+def check_resource_access(program, project, nodes):
+    stop_node = flask.current_app.node_authz_entity_name
+    subjects = resolve_subjects(nodes, stop_node)
 
     try:
-        resources = [
-                "/{}s/{}".format(stop_node, node["submitter_id"])
-                for node in subject_submitter_ids
-            ]
+        resources = sorted(
+            {"/{}s/{}".format(stop_node, submitter_id) for _, submitter_id in subjects}
+        )
         authorize(program, project, [ROLES["READ"]], resources)
     except AuthZError:
         return "You do not have read permission on project {} for one or more of the subjects requested"
@@ -241,30 +458,24 @@ def check_resource_access(program, project, nodes):
 
 # TEST BUT YOU NEED TO ADD ACTUAL ID LIST NOT ONLY THE ONE LISTED IN THE DB
 def get_authorized_ids(program, project):
-    try:
-        mapping = flask.current_app.auth.auth_mapping(current_user.username)
-    except AuthZError as e:
-        logger.warn(
-            "Unable to retrieve auth mapping for user `{}`: {}".format(current_user.username, e)
-        )
-        mapping = {}
-
-    base_resource_path = "/programs/{}/projects/{}".format(program, project)
-    result = [resource_path for resource_path, permissions in mapping.items() if base_resource_path in resource_path]
-    ids = []
-
-    for path in result:
-        parts = path.strip("/").split("/")
-        if path != "/" and parts[0] != "programs":
-            continue
-
-        if len(parts) > 6 or (len(parts) > 2 and parts[2] != "projects") or (len(parts) > 4 and (flask.current_app.node_authz_entity_name is None or flask.current_app.node_authz_entity is None or parts[4] != (flask.current_app.node_authz_entity_name + "s"))):
-            continue
-
-        if len(parts) <  6:
-            return(None)
-        else:
-            ids.append(parts[5])
+    """
+    Return the submitter ids of the authz entities of the project the user
+    has access to, or None if the user has access to the whole project.
+    """
 
-    return(ids)
+    def get_mapping():
+        try:
+            return flask.current_app.auth.auth_mapping(current_user.username)
+        except AuthZError as e:
+            logger.warn(
+                "Unable to retrieve auth mapping for user `{}`: {}".format(current_user.username, e)
+            )
+            return None
 
+    trie = get_auth_mapping_trie(
+        current_user.username, get_jwt_from_header(), get_mapping
+    )
+    entity_name = flask.current_app.node_authz_entity_name
+    if flask.current_app.node_authz_entity is None:
+        entity_name = None
+    return trie.authorized_ids(program, project, entity_name)
@@ -0,0 +1,189 @@
+"""
+Cache of authorization decisions (see :func:`sheepdog.auth.authorize`).
+
+The decisions are kept in a ``cachelib`` backend configured by the
+``AUTHZ_CACHE`` setting: an in-process LRU cache by default, or a backend
+shared by all the workers, such as ``filesystem`` (shared by the processes of
+a host) or ``redis``. A decision is cached for at most ``max_staleness``
+seconds, and never past the expiration of the token it was made for.
+"""
+
+from collections import OrderedDict
+import hashlib
+from threading import Lock
+import time
+
+from cachelib import BaseCache, FileSystemCache, RedisCache
+import jwt
+
+
+DEFAULT_MAX_STALENESS = 1
+DEFAULT_MAX_SIZE = 1024
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache holding at most ``max_size`` items, evicting the least
+    recently used one first.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self.max_size = max_size
+        #: key -> (expiration time, value)
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else None
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._items[key] = (self._expires(timeout), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+
+def cache_backend_from_config(config):
+    """
+    Return the cache backend described by ``config`` (the ``AUTHZ_CACHE``
+    setting), e.g.::
+
+        {"backend": "lru", "max_size": 1024}
+        {"backend": "filesystem", "path": "/var/sheepdog/authz"}
+        {"backend": "redis", "host": "localhost", "port": 6379}
+    """
+    config = config or {}
+    backend = config.get("backend", "lru")
+    if backend == "lru":
+        return LRUCache(max_size=config.get("max_size", DEFAULT_MAX_SIZE))
+    if backend == "filesystem":
+        return FileSystemCache(
+            config["path"], threshold=config.get("max_size", DEFAULT_MAX_SIZE)
+        )
+    if backend == "redis":
+        return RedisCache(
+            host=config.get("host", "localhost"),
+            port=config.get("port", 6379),
+            password=config.get("password"),
+            db=config.get("db", 0),
+            key_prefix=config.get("key_prefix", "sheepdog-authz:"),
+        )
+    raise ValueError("Unknown authz cache backend '{}'".format(backend))
+
+
+def get_jwt_expiry(jwt_token):
+    """Return the expiration time of ``jwt_token``, or None if unknown."""
+    try:
+        decoded_token = jwt.decode(jwt_token, options={"verify_signature": False})
+    except jwt.exceptions.DecodeError:
+        return None
+    return decoded_token.get("exp")
+
+
+class AuthzCache(object):
+    """
+    Authorization decisions by token, roles and resource, with hit and miss
+    counters (per process) for monitoring.
+    """
+
+    def __init__(self, backend=None, max_staleness=DEFAULT_MAX_STALENESS):
+        self.backend = backend or LRUCache()
+        self.max_staleness = max_staleness
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        """Switch to the backend and staleness given by ``config``."""
+        config = config or {}
+        self.backend = cache_backend_from_config(config)
+        self.max_staleness = config.get("max_staleness", DEFAULT_MAX_STALENESS)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(jwt_token, roles, resources):
+        """
+        Return the key of a decision on all of ``resources``. Tokens and
+        resource lists are hashed so that shared backends don't hold them and
+        keys stay short.
+        """
+        token_hash = hashlib.sha256(jwt_token.encode("utf-8")).hexdigest()
+        resources_hash = hashlib.sha256(
+            "\n".join(resources).encode("utf-8")
+        ).hexdigest()
+        return "{}_{}_{}".format(token_hash, roles, resources_hash)
+
+    def get(self, key):
+        """Return the cached decision for ``key``, or None."""
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def has(self, key):
+        return self.backend.has(key)
+
+    def set(self, key, value, jwt_token=None):
+        """
+        Cache a decision for ``max_staleness`` seconds, or until
+        ``jwt_token`` expires if that is sooner.
+        """
+        timeout = self.max_staleness
+        expiry = get_jwt_expiry(jwt_token) if jwt_token else None
+        if expiry is not None:
+            timeout = min(timeout, int(expiry - time.time()))
+        if timeout <= 0:
+            # a timeout of 0 would never expire
+            return
+        self.backend.set(key, value, timeout=timeout)
+
+    def clear(self):
+        self.backend.clear()
+
+    def status(self):
+        requests = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "max_staleness": self.max_staleness,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else None,
+        }
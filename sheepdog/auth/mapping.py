@@ -0,0 +1,90 @@
+"""
+Index of a user's Arborist auth mapping, to find the subjects of a project
+the user has access to (see :func:`sheepdog.auth.get_authorized_ids`).
+
+The resource paths of the mapping are stored in a trie of path segments, so
+looking up a project only walks ``programs/<p>/projects/<q>/<entity>s/<id>``
+instead of scanning every path. The tries are cached per user until their
+token expires.
+"""
+
+import hashlib
+import time
+
+from sheepdog.auth.cache import LRUCache, get_jwt_expiry
+
+
+#: Auth mapping tries by user and token
+AUTH_MAPPING_CACHE = LRUCache(max_size=256)
+
+
+class ResourceTrie(object):
+    """Trie of the segments of resource paths."""
+
+    def __init__(self, paths=()):
+        #: segment -> child trie
+        self.children = {}
+        #: whether a path ends here
+        self.terminal = False
+        for path in paths:
+            self.insert(path)
+
+    def insert(self, path):
+        node = self
+        for part in path.strip("/").split("/"):
+            node = node.children.setdefault(part, ResourceTrie())
+        node.terminal = True
+
+    def find(self, *parts):
+        """Return the sub-trie at ``parts``, or None."""
+        node = self
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def authorized_ids(self, program, project, entity_name):
+        """
+        Return the submitter ids of the ``entity_name`` entities of the
+        project that are resources of the mapping, or None if the whole
+        project (or all of its ``entity_name`` entities) is.
+        """
+        project_node = self.find("programs", program, "projects", project)
+        if project_node is None:
+            return []
+        if project_node.terminal:
+            return None
+        if entity_name is None:
+            return []
+        entities_node = project_node.children.get(entity_name + "s")
+        if entities_node is None:
+            return []
+        if entities_node.terminal:
+            return None
+        return [
+            submitter_id
+            for submitter_id, node in entities_node.children.items()
+            if node.terminal
+        ]
+
+
+def get_auth_mapping_trie(username, jwt_token, get_mapping):
+    """
+    Return the trie of the auth mapping of ``username``, cached until
+    ``jwt_token`` expires. ``get_mapping()`` returns the mapping, or None if
+    it could not be retrieved (which isn't cached).
+    """
+    token_hash = hashlib.sha256(jwt_token.encode("utf-8")).hexdigest()
+    key = "{}_{}".format(username, token_hash)
+    trie = AUTH_MAPPING_CACHE.get(key)
+    if trie is not None:
+        return trie
+
+    mapping = get_mapping()
+    trie = ResourceTrie(mapping or {})
+    expiry = get_jwt_expiry(jwt_token)
+    timeout = int(expiry - time.time()) if expiry is not None else 0
+    if mapping is not None and timeout > 0:
+        AUTH_MAPPING_CACHE.set(key, trie, timeout=timeout)
+    return trie
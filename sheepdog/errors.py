@@ -25,5 +25,16 @@ class NoIndexForFileError(UserError):
         self.code = 400
 
 
+class TooManyRequestsError(APIError):
+    """
+    Raised when the API can't take more work for now; the response carries a
+    ``Retry-After`` header if ``retry_after`` (seconds) is given.
+    """
+
+    def __init__(self, message, retry_after=None, code=429):
+        super(TooManyRequestsError, self).__init__(message, code)
+        self.retry_after = retry_after
+
+
 class HandledIntegrityError(Exception):
     pass
@@ -17,11 +17,21 @@ REGEX_UUID = re.compile(
 )
 
 FLAG_IS_ASYNC = "async"
+#: Commit an upload in chunks of this many entities (e.g. "?chunk_size=5000")
+FLAG_CHUNK_SIZE = "chunk_size"
+#: Skip the chunks of a chunked upload before this index
+FLAG_RESUME_FROM_CHUNK = "resume_from_chunk"
+#: Only return the counts and the invalid entities of a transaction
+FLAG_SUMMARY = "summary"
+#: Synchronous upload responses with this many entities are streamed
+STREAM_RESPONSE_MIN_ENTITIES = 1000
 
 DELIMITERS = {"csv": ",", "tsv": "\t"}
 # SUB_DELIMITERS is used to separate items in a list of the same array field.
 SUB_DELIMITERS = {"csv": "#", "tsv": ","}
 SUPPORTED_FORMATS = ["csv", "tsv", "json"]
+#: Number of rows converted at a time when streaming a delimited upload
+DELIMITED_CHUNK_SIZE = 1000
 
 ROLES = {
     "CREATE": "create",
@@ -209,10 +219,15 @@ SUBMITTABLE_STATES = ENTITY_STATE_TRANSITIONS["submitted"]
 
 # Async scheduling configuration
 ASYNC_MAX_Q_LEN = 128
+#: Seconds a client is asked to wait when the async queue is full
+ASYNC_RETRY_AFTER = 30
 ERR_ASYNC_SCHEDULING = (
     "The API is currently under heavy load and currently has too many"
     " asynchronous tasks. Please try again later."
 )
+ERR_ASYNC_PROJECT_SCHEDULING = (
+    "Project {} has too many asynchronous tasks queued. Please try again later."
+)
 
 BCR_MAPPING = """
 # example:
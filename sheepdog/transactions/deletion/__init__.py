@@ -3,6 +3,7 @@ import flask
 from sheepdog import utils
 from sheepdog.errors import UserError
 from sheepdog.globals import FLAG_IS_ASYNC
+from sheepdog.utils.scheduling import schedule_async_transaction
 from sheepdog.transactions.deletion.transaction import DeletionTransaction
 
 
@@ -76,7 +77,7 @@ def handle_deletion_request(program, project, ids, to_delete=None, **tx_kwargs):
                 "transaction_id": transaction.transaction_id,
             }
 
-        flask.current_app.async_pool.schedule(transaction_worker, transaction, ids)
+        schedule_async_transaction(transaction_worker, transaction, ids)
         return flask.jsonify(response), 200
 
     else:
@@ -1,4 +1,3 @@
-from sheepdog.auth import authorize
 from sheepdog.errors import AuthZError
 from sheepdog.globals import submitted_state, ALLOWED_DELETION_STATES
 from sheepdog.transactions.entity_base import EntityBase, EntityErrors
@@ -25,7 +24,7 @@ class DeletionEntity(EntityBase):
         # Check user permissions for deleting nodes
         try:
             program, project = self.transaction.project_id.split("-", 1)
-            authorize(program, project, ["delete"])
+            self.transaction.authz_context.authorize(program, project, ["delete"])
         except AuthZError:
             return self.record_error(
                 "You do not have delete permission for project {}".format(
@@ -9,11 +9,20 @@ class DeletionTransaction(TransactionBase):
 
     REQUIRED_PROJECT_STATES = ["open"]
 
+    ASYNC_AUTHZ_ROLES = (["delete"],)
+
     def __init__(self, **kwargs):
         super(DeletionTransaction, self).__init__(role="delete", **kwargs)
         self.fields_to_delete = kwargs.get("fields", None)
         self.to_delete = kwargs.get("to_delete", None)
 
+    def spec_kwargs(self):
+        return dict(
+            super(DeletionTransaction, self).spec_kwargs(),
+            fields=self.fields_to_delete,
+            to_delete=self.to_delete,
+        )
+
     def write_transaction_log(self):
         """Save a log noting this project was opened"""
 
@@ -147,6 +147,7 @@ class EntityBase(object, metaclass=abc.ABCMeta):
                 **kwargs
             )
         )
+        self.transaction.entity_error_recorded(self)
 
     def record_warning(self, message, keys=None, **kwargs):
         """
@@ -8,6 +8,7 @@ import flask
 
 from sheepdog import utils
 from sheepdog.globals import FLAG_IS_ASYNC
+from sheepdog.utils.scheduling import schedule_async_transaction
 from sheepdog.transactions.transaction_base import TransactionBase
 from sheepdog.transactions.release.transaction import ReleaseTransaction
 
@@ -52,7 +53,7 @@ def handle_release_transaction(program, project, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(transaction_worker, transaction)
+        schedule_async_transaction(transaction_worker, transaction)
         return flask.jsonify(response), 200
     else:
         response, code = transaction_worker(transaction)
@@ -8,6 +8,7 @@ import flask
 
 from sheepdog import utils
 from sheepdog.globals import FLAG_IS_ASYNC
+from sheepdog.utils.scheduling import schedule_async_transaction
 from sheepdog.transactions.review.transaction import OpenTransaction, ReviewTransaction
 
 
@@ -54,7 +55,7 @@ def _single_transaction(tx_cls, program, project, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(transaction_worker, transaction)
+        schedule_async_transaction(transaction_worker, transaction)
         return flask.jsonify(response), 200
     else:
         response, code = transaction_worker(transaction)
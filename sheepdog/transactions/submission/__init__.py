@@ -3,6 +3,7 @@ import flask
 from sheepdog import utils
 from sheepdog.errors import UserError
 from sheepdog.globals import FLAG_IS_ASYNC
+from sheepdog.utils.scheduling import schedule_async_transaction
 from sheepdog.transactions.submission.transaction import SubmissionTransaction
 
 
@@ -38,7 +39,7 @@ def handle_submission_transaction(program, project, *doc_args, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(transaction_worker, transaction)
+        schedule_async_transaction(transaction_worker, transaction)
         return flask.jsonify(response), 200
     else:
         response, code = transaction_worker(transaction)
@@ -4,7 +4,6 @@ import sqlalchemy
 from flask import current_app as capp
 
 from sheepdog import utils
-from sheepdog.auth import authorize
 from sheepdog.errors import AuthZError
 from sheepdog.globals import (
     ENTITY_STATE_CATEGORIES,
@@ -26,16 +25,19 @@ class SubmissionTransaction(TransactionBase):
     #: Don't mark these classes submitted
     SKIPPED_CLASSES = ["case", "annotation"]
 
+    ASYNC_AUTHZ_ROLES = ([ROLE_SUBMIT],)
+
     def __init__(self, smtp_conf=None, **kwargs):
         super(SubmissionTransaction, self).__init__(role="submit", **kwargs)
 
         self.app_config = capp.config
         if utils.should_send_email(self.app_config):
-            self.smtp_conf = smtp_conf
+            # not part of the spec of an async transaction (see spec_kwargs)
+            self.smtp_conf = smtp_conf or capp.get_smtp_conf()
 
         try:
-            program, project = self.transaction.project_id.split("-", 1)
-            authorize(program, project, [ROLE_SUBMIT])
+            program, project = self.project_id.split("-", 1)
+            self.authz_context.authorize(program, project, [ROLE_SUBMIT])
         except AuthZError:
             return self.record_error(
                 "You do not have submit permission for project {}".format(
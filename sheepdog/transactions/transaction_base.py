@@ -4,10 +4,14 @@ from.
 """
 
 from contextlib import contextmanager
+import itertools
 
 import flask
 from flask import current_app
 from datamodelutils import validators
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import selectinload
 
 from sheepdog import auth
 from sheepdog import models
@@ -20,6 +24,11 @@ from sheepdog.globals import (
     TX_LOG_STATE_PENDING,
     TX_LOG_STATE_SUCCEEDED,
 )
+from sheepdog.utils.scheduling import TransactionSpec
+
+
+#: Number of TransactionSnapshot rows written per INSERT statement
+SNAPSHOT_INSERT_BATCH_SIZE = 1000
 
 
 class MissingNode(object):
@@ -31,6 +40,122 @@ class MissingNode(object):
         self.props = {}
 
 
+class TransactionLogWriter(object):
+    """
+    Keep the TransactionLog of a transaction loaded for the life of the
+    transaction, apart from the transaction's own session, and write the
+    changes made to it at a few defined points.
+
+    The log and its documents are queried once, in a short session, and are
+    then kept detached: changes made to them in :meth:`transaction_log`
+    contexts (state, documents, submitter, ...) are only recorded. They are
+    written by :meth:`flush` in a short session of its own, at the flush
+    points: the contexts opened with ``flush=True`` (state transitions and
+    the final write of the log, see :class:`TransactionBase`) and the exit of
+    the transaction. No connection is held between flush points, and changes
+    recorded in a context that raises are written at the next one.
+
+    Snapshots are not ORM objects: they are queued with :meth:`add_snapshots`
+    and written with multi-row INSERTs. Canonical JSON is queued with
+    :meth:`append_canonical_json` and appended to the stored array by a
+    single UPDATE, so the existing array is neither loaded nor re-serialized.
+    """
+
+    def __init__(self, db_driver):
+        self.db_driver = db_driver
+        self.tx_log = None
+        #: (entity_id, action, old_props, new_props) of pending snapshots
+        self.snapshots = []
+        #: Documents to append to the log's canonical_json
+        self.canonical_json = []
+
+    @contextmanager
+    def transaction_log(self, transaction_id, flush=False):
+        """
+        Yield the TransactionLog ``transaction_id``, loading it the first
+        time, and write the changes made so far when the context exits if
+        ``flush``.
+        """
+        if self.tx_log is None or self.tx_log.id != transaction_id:
+            self.load(transaction_id)
+        yield self.tx_log
+        if flush:
+            self.flush()
+
+    def load(self, transaction_id):
+        """Load the TransactionLog ``transaction_id`` and its documents."""
+        if self.tx_log is not None:
+            self.flush()
+        TransactionLog = models.submission.TransactionLog
+        with self.db_driver.session_scope(can_inherit=False):
+            self.tx_log = (
+                self.db_driver.nodes(TransactionLog)
+                .options(selectinload(TransactionLog.documents))
+                .get(transaction_id)
+            )
+
+    def add_snapshots(self, snapshots):
+        """
+        Queue TransactionSnapshots of the transaction log, given as
+        ``(entity_id, action, old_props, new_props)`` tuples.
+        """
+        self.snapshots.extend(snapshots)
+
+    def append_canonical_json(self, docs):
+        """Queue documents to append to the log's canonical_json."""
+        self.canonical_json.extend(docs)
+
+    def flush(self):
+        """
+        Write the changes made to the log, and the queued snapshots and
+        canonical JSON, in one short session. If that fails, the log is
+        loaded again by the next context.
+        """
+        if self.tx_log is None:
+            return
+        try:
+            with self.db_driver.session_scope(can_inherit=False) as session:
+                session.add(self.tx_log)
+                if self.snapshots:
+                    self.insert_snapshots(session)
+                if self.canonical_json:
+                    self.update_canonical_json(session)
+        except Exception:
+            self.tx_log = None
+            raise
+
+    def update_canonical_json(self, session):
+        """Append the pending documents to canonical_json in one UPDATE."""
+        table = models.submission.TransactionLog.__table__
+        docs = bindparam("canonical_json", self.canonical_json, type_=JSONB)
+        session.execute(
+            table.update()
+            .where(table.c.id == self.tx_log.id)
+            .values(canonical_json=table.c.canonical_json.op("||")(docs))
+        )
+        self.canonical_json = []
+
+    def insert_snapshots(self, session):
+        """Write the pending snapshots with multi-row INSERTs."""
+        table = models.submission.TransactionSnapshot.__table__
+        rows = (
+            {
+                "transaction_id": self.tx_log.id,
+                "entity_id": entity_id,
+                "action": action,
+                "old_props": old_props,
+                "new_props": new_props,
+            }
+            for entity_id, action, old_props, new_props in self.snapshots
+        )
+        while True:
+            batch = list(itertools.islice(rows, SNAPSHOT_INSERT_BATCH_SIZE))
+            if not batch:
+                break
+            session.execute(table.insert().values(batch))
+        self.snapshots = []
+
+
 class TransactionBase(object):
     """
     Parent class for sheepdog API transactions.
@@ -44,6 +169,15 @@ class TransactionBase(object):
 
     REQUIRED_PROJECT_STATES = []
 
+    #: Roles the transaction authorizes on its project while it runs, decided
+    #: before it is sent to run in another process (see :meth:`to_spec`)
+    ASYNC_AUTHZ_ROLES = ()
+
+    #: Incremented whenever one of the entities records an error
+    entity_errors_version = 0
+    _entity_partition_key = None
+    _entity_partition = None
+
     def __init__(self, program, project, **kwargs):
         """
         Collected functionality for submission transactions.
@@ -61,6 +195,10 @@ class TransactionBase(object):
             transaction_id: Optionally inherit and write to an existing
                 TransactionLog. If this is not provided, a new TransactionLog
                 will be created.
+            transaction_log_writer: Optionally share the TransactionLogWriter
+                of a parent transaction writing to the same TransactionLog
+            authz_context: Optionally share the AuthorizationContext of a
+                parent transaction
         """
         self.program = program
         self.project = project
@@ -76,6 +214,14 @@ class TransactionBase(object):
         #: Create a transaction log, this will be created and committed to the
         #: database during claim_transaction_log()
         self.transaction_id = kwargs.pop("transaction_id", None)
+        #: Writes the changes to the transaction log
+        self.transaction_log_writer = kwargs.pop(
+            "transaction_log_writer", None
+        ) or TransactionLogWriter(self.db_driver)
+        #: Authorization decisions, shared with subtransactions
+        self.authz_context = (
+            kwargs.pop("authz_context", None) or auth.AuthorizationContext()
+        )
         if kwargs:
             self.logger.warning("Unused arguments: %s", list(kwargs.keys()))
 
@@ -96,6 +242,40 @@ class TransactionBase(object):
         except AttributeError:
             pass
 
+    def spec_kwargs(self):
+        """
+        Return the constructor arguments that rebuild this transaction in
+        another process (see :meth:`to_spec`). They must be JSON serializable
+        and hold no credentials.
+        """
+        return {
+            "program": self.program,
+            "project": self.project,
+            "dry_run": self.dry_run,
+            "document_name": self.document_name,
+            "transaction_id": self.transaction_id,
+        }
+
+    def to_spec(self, worker, *args):
+        """
+        Return the :class:`TransactionSpec` running ``worker(self, *args)``
+        in another process. That process has no request to authorize with,
+        so the spec carries the user and the decisions for
+        ``ASYNC_AUTHZ_ROLES``, made now.
+        """
+        # split as the entities do (see UploadEntity.get_node_create)
+        program, project = self.project_id.split("-", 1)
+        for roles in self.ASYNC_AUTHZ_ROLES:
+            self.authz_context.resolve(program, project, roles)
+        return TransactionSpec(
+            type(self),
+            worker,
+            args,
+            user=auth.get_transaction_user(),
+            authz=self.authz_context.to_json(),
+            **self.spec_kwargs()
+        )
+
     @property
     def session(self):
         """Wrap current database session."""
@@ -116,17 +296,33 @@ class TransactionBase(object):
         """
         Return attributes in dictionary form.
         """
+        return dict(self.json_envelope, entities=self.entity_responses)
+
+    @property
+    def json_envelope(self):
+        """Return the attributes of ``base_json`` other than the entities."""
         return {
             "transaction_id": self.transaction_id,
             "success": self.success,
             "entity_error_count": self.entity_error_count,
             "transactional_error_count": self.transactional_error_count,
-            "entities": self.entity_responses,
             "code": self.status_code,
             "message": self.message,
             "transactional_errors": self.transactional_errors,
         }
 
+    def response_json(self, summary=False):
+        """
+        Return the ``json`` of the transaction with the entity responses as a
+        generator, to be serialized piece by piece by
+        :func:`sheepdog.utils.streaming.spool_json`.
+
+        Args:
+            summary (bool): only include the responses of invalid entities
+        """
+        entities = self.partition_entities()[1] if summary else self.entities
+        return dict(self.json_envelope, entities=(entity.json for entity in entities))
+
     @property
     def status_code(self):
         """Return status code according to ``self.success``."""
@@ -135,13 +331,35 @@ class TransactionBase(object):
         else:
             return 400
 
+    def entity_error_recorded(self, entity):
+        """Called by ``entity`` when it records an error."""
+        self.entity_errors_version += 1
+
+    def partition_entities(self):
+        """
+        Return the lists of valid and invalid entities.
+
+        The partition is cached until an entity records an error or entities
+        are added, so the properties below don't walk all the entities every
+        time they are read. The lists must not be modified.
+        """
+        entities = self.entities
+        key = (self.entity_errors_version, id(entities), len(entities))
+        if self._entity_partition_key != key:
+            valid, invalid = [], []
+            for entity in entities:
+                (valid if entity.is_valid else invalid).append(entity)
+            self._entity_partition = (valid, invalid)
+            self._entity_partition_key = key
+        return self._entity_partition
+
     @property
     def valid_entities(self):
         """
         Return a list of entities that (up to this point) have no recorded
         errors.
         """
-        return [e for e in self.entities if e.is_valid]
+        return self.partition_entities()[0]
 
     @property
     def entity_errors(self):
@@ -149,7 +367,7 @@ class TransactionBase(object):
         Return the error JSON for each entity that is up to this point
         unsuccessful.
         """
-        return [e.errors for e in self.entities if not e.is_valid]
+        return [e.errors for e in self.partition_entities()[1]]
 
     @property
     def entity_error_count(self):
@@ -157,7 +375,7 @@ class TransactionBase(object):
         Return only the number of errors recorded for all of the the
         transaction's entities.
         """
-        return len(self.entity_errors)
+        return len(self.partition_entities()[1])
 
     @property
     def error_count(self):
@@ -220,7 +438,12 @@ class TransactionBase(object):
                 "Project is in state '{}', which prevents {}. In order to"
                 " perform this action, the project must be in state <{}>."
             )
-            raise UserError(msg.format(state, flask.request.path, states))
+            action = (
+                flask.request.path
+                if flask.has_request_context()
+                else type(self).__name__
+            )
+            raise UserError(msg.format(state, action, states))
 
     def __enter__(self):
         """Called when entering a transaction context.
@@ -245,9 +468,16 @@ class TransactionBase(object):
         be sure to call self.session.commit() when they are confident
         they are writing a valid transaction to the database.
 
+        Changes to the transaction log that were not written yet are
+        written (see :class:`TransactionLogWriter`).
+
         """
 
         self.rollback()
+        try:
+            self.transaction_log_writer.flush()
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.exception(e)
 
     def claim_transaction_log(self):
         """Creates a new, default transaction log and writes it to the
@@ -270,21 +500,22 @@ class TransactionBase(object):
             self.transaction_id = transaction_log.id
 
     @contextmanager
-    def fetch_transaction_log(self):
-        """Look up external state of transaction log."""
-        with self.clean_session():
-            yield (
-                self.db_driver.nodes(models.submission.TransactionLog).get(
-                    self.transaction_id
-                )
-            )
+    def fetch_transaction_log(self, flush=False):
+        """
+        Look up external state of transaction log. Changes to it are written
+        at the next flush point, e.g. when the context exits if ``flush``
+        (see :class:`TransactionLogWriter`).
+        """
+        writer = self.transaction_log_writer
+        with writer.transaction_log(self.transaction_id, flush=flush) as tx_log:
+            yield tx_log
 
     def set_transaction_log_state(self, state):
         """
         Transition the transaction_log.state to param:`state` in a clean
         session.
         """
-        with self.fetch_transaction_log() as tx_log:
+        with self.fetch_transaction_log(flush=True) as tx_log:
             tx_log.state = state
 
     @contextmanager
@@ -435,19 +666,28 @@ class TransactionBase(object):
         models.
         """
         timestamp = self.get_transaction_timestamp()
-        with self.fetch_transaction_log() as tx_log:
+        with self.fetch_transaction_log(flush=True) as tx_log:
             tx_log.submitter = auth.current_user.username
-            for entity in self.entities:
-                if not entity.node or isinstance(entity.node, MissingNode):
-                    continue
-                snapshot = models.submission.TransactionSnapshot()
-                snapshot.entity_id = entity.node.node_id
-                snapshot.old_props = entity.old_props
-                snapshot.new_props = entity.node.props
-                snapshot.action = entity.action
-                snapshot.transaction = tx_log
-                self.session.add(snapshot)
-            # Must flush to database to create id
+            self.transaction_log_writer.add_snapshots(
+                (
+                    entity.node.node_id,
+                    entity.action,
+                    entity.old_props,
+                    entity.node.props,
+                )
+                for entity in self.entities
+                if entity.node and not isinstance(entity.node, MissingNode)
+            )
             tx_log.timestamp = timestamp
-            if tx_log.documents:
-                tx_log.documents[0].response_json = self.json
+            tx_document = self.get_transaction_document(tx_log)
+            if tx_document is not None:
+                tx_document.response_json = self.json
+
+    def get_transaction_document(self, tx_log):
+        """
+        Return the TransactionDocument of ``tx_log`` that holds this
+        transaction's response, if any.
+        """
+        if tx_log.documents:
+            return tx_log.documents[0]
+        return None
@@ -5,6 +5,9 @@ Pylint ``no-member`` error disabled because of false positives with
 ``lxml.etree``.
 """
 
+import io
+import json
+
 import flask
 import lxml
 import uuid
@@ -15,21 +18,88 @@ from sheepdog import auth
 from sheepdog import utils
 from sheepdog.errors import ParsingError, SchemaError, UnsupportedError, UserError
 from sheepdog.errors import HandledIntegrityError
-from sheepdog.globals import FLAG_IS_ASYNC, PROJECT_SEED
+from sheepdog.globals import (
+    FLAG_CHUNK_SIZE,
+    FLAG_IS_ASYNC,
+    FLAG_RESUME_FROM_CHUNK,
+    FLAG_SUMMARY,
+    PROJECT_SEED,
+    STREAM_RESPONSE_MIN_ENTITIES,
+)
+from sheepdog.utils.scheduling import schedule_async_transaction
+from sheepdog.utils.streaming import spool_json, spooled_json_response
 from sheepdog.transactions.upload.transaction import (
     BulkUploadTransaction,
+    ChunkedUploadTransaction,
     UploadTransaction,
 )
 
 
-def single_transaction_worker(transaction, *doc_args):
+def schedule_upload(worker, transaction, *args):
+    """
+    Schedule ``worker(transaction, *args)`` on the async upload pool (see
+    :func:`schedule_async_transaction`).
+    """
+    pool = getattr(flask.current_app, "async_upload_pool", None)
+    schedule_async_transaction(
+        worker, transaction, *args, pool=pool or flask.current_app.async_pool
+    )
+
+
+def render_json(transaction):
+    """Return the response json of a transaction."""
+    return transaction.json
+
+
+def render_response(transaction):
+    """
+    Render the response of a synchronous transaction, while its session is
+    still open.
+
+    Large responses, and ``?summary=true`` ones, are serialized piece by piece
+    to a spooled file (see :mod:`sheepdog.utils.streaming`) instead of being
+    built as one dict; :func:`make_response` streams them.
+    """
+    summary = utils.is_flag_set(FLAG_SUMMARY)
+    min_entities = flask.current_app.config.get(
+        "STREAM_RESPONSE_MIN_ENTITIES", STREAM_RESPONSE_MIN_ENTITIES
+    )
+    if summary or len(transaction.entities) >= min_entities:
+        return spool_json(transaction.response_json(summary))
+    return transaction.json
+
+
+def make_response(response, code):
+    """Return the flask response for a rendered transaction response."""
+    if isinstance(response, dict):
+        return flask.jsonify(response), code
+    return spooled_json_response(response, code)
+
+
+def single_transaction_worker(transaction, *doc_args, render=render_json):
     """
     Execute single transaction (called in serial or async).
     """
+    return _run_single_transaction(
+        transaction, transaction.parse_doc, *doc_args, render=render
+    )
+
+
+def stream_transaction_worker(transaction, *stream_args, render=render_json):
+    """
+    Execute single transaction whose delimited document is read from a stream
+    (see :meth:`UploadTransaction.parse_doc_stream`).
+    """
+    return _run_single_transaction(
+        transaction, transaction.parse_doc_stream, *stream_args, render=render
+    )
+
+
+def _run_single_transaction(transaction, parse, *args, render=render_json):
     session = transaction.db_driver.session_scope(can_inherit=False)
     with session, transaction:
         try:
-            transaction.parse_doc(*doc_args)
+            parse(*args)
             transaction.flush()
             transaction.post_validate()
             transaction.commit()
@@ -42,12 +112,31 @@ def single_transaction_worker(transaction, *doc_args):
         except Exception as e:  # pylint: disable=broad-except
             transaction.record_internal_error(e)
         finally:
-            response = transaction.json
+            response = render(transaction)
             code = transaction.status_code
 
+    sync_transaction_resources(transaction)
     return response, code
 
 
+def sync_transaction_resources(transaction):
+    """
+    Create the Arborist resources of the entities of a committed transaction
+    (see :func:`sheepdog.auth.sync_resources`).
+    """
+    if transaction.dry_run or not transaction.success:
+        return
+    try:
+        auth.create_resource(
+            transaction.program,
+            transaction.project,
+            [entity.doc for entity in transaction.valid_entities],
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        # the transaction is committed whatever happens to its resources
+        transaction.logger.exception(e)
+
+
 def _single_transaction(role, program, project, *doc_args, **tx_kwargs):
     """
     Create and execute a single (not bulk) transaction.
@@ -81,13 +170,13 @@ def _single_transaction(role, program, project, *doc_args, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(
-            single_transaction_worker, transaction, *doc_args
-        )
+        schedule_upload(single_transaction_worker, transaction, *doc_args)
         return flask.jsonify(response)
     else:
-        response, code = single_transaction_worker(transaction, *doc_args)
-        return flask.jsonify(response), code
+        response, code = single_transaction_worker(
+            transaction, *doc_args, render=render_response
+        )
+        return make_response(response, code)
 
 
 def handle_single_transaction(role, program, project, **tx_kwargs):
@@ -97,8 +186,35 @@ def handle_single_transaction(role, program, project, **tx_kwargs):
     This function multiplexes on the content-type to call the appropriate
     transaction handler.
     """
-    doc = flask.request.get_data().decode("utf-8")
     content_type = flask.request.headers.get("Content-Type", "").lower()
+    converters = {
+        "text/csv": ("csv", utils.transforms.CSVToJSONConverter),
+        "text/tab-separated-values": ("tsv", utils.transforms.TSVToJSONConverter),
+        "text/tsv": ("tsv", utils.transforms.TSVToJSONConverter),
+    }
+    chunk_size = utils.get_int_flag(FLAG_CHUNK_SIZE, minimum=1)
+    if chunk_size:
+        return _chunked_transaction(
+            role,
+            program,
+            project,
+            chunk_size,
+            converters.get(content_type),
+            **tx_kwargs
+        )
+
+    is_streamed = (
+        content_type in converters
+        and flask.current_app.config.get("STREAM_DELIMITED_UPLOADS", True)
+        and not tx_kwargs.get("is_async", utils.is_flag_set(FLAG_IS_ASYNC))
+    )
+    if is_streamed:
+        doc_format, converter = converters[content_type]
+        return _stream_single_transaction(
+            role, program, project, doc_format, converter(), **tx_kwargs
+        )
+
+    doc = flask.request.get_data().decode("utf-8")
     errors = None
     if content_type == "text/csv":
         doc_format = "csv"
@@ -136,21 +252,156 @@ def handle_single_transaction(role, program, project, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(
-            single_transaction_worker, transaction, *doc_args
+        schedule_upload(single_transaction_worker, transaction, *doc_args)
+
+        return flask.jsonify(response)
+    else:
+        response, code = single_transaction_worker(
+            transaction, *doc_args, render=render_response
         )
 
-        # create the resource in arborist
-        auth.create_resource(program, project, doc_args[3])
+        return make_response(response, code)
 
-        return flask.jsonify(response)
+
+def _stream_single_transaction(
+    role, program, project, doc_format, converter, **tx_kwargs
+):
+    """
+    Create and execute a single transaction for a delimited document that is
+    converted while it is read from the request stream, instead of first
+    reading, decoding and normalizing the whole body in memory.
+    """
+    tx_kwargs.pop("is_async", None)
+    name = flask.request.headers.get("X-Document-Name", None)
+    db_driver = tx_kwargs.pop("db_driver", flask.current_app.db)
+    transaction = UploadTransaction(
+        program=program,
+        project=project,
+        role=role,
+        logger=flask.current_app.logger,
+        flask_config=flask.current_app.config,
+        index_client=flask.current_app.index_client,
+        external_proxies=utils.get_external_proxies(),
+        db_driver=db_driver,
+        **tx_kwargs
+    )
+    response, code = stream_transaction_worker(
+        transaction,
+        name,
+        doc_format,
+        converter,
+        flask.request.stream,
+        render=render_response,
+    )
+
+    return make_response(response, code)
+
+
+def chunked_transaction_worker(transaction, doc_format, chunks):
+    """
+    Execute a chunked transaction: each ``(doc, data)`` of ``chunks`` is
+    processed and committed by its own chunk transaction, in order, until one
+    of them fails.
+    """
+    session = transaction.db_driver.session_scope(can_inherit=False)
+    with session, transaction:
+        pass  # claim the TransactionLog shared by all chunks
+
+    try:
+        for index, (doc, data) in enumerate(chunks):
+            if index < transaction.resume_from_chunk:
+                continue
+            chunk_transaction = transaction.new_chunk_transaction(index)
+            try:
+                single_transaction_worker(
+                    chunk_transaction,
+                    chunk_transaction.document_name,
+                    doc_format,
+                    doc,
+                    data,
+                )
+            except UserError:
+                pass  # recorded in the chunk's response
+            transaction.add_chunk(index, chunk_transaction)
+
+            if not chunk_transaction.success:
+                break
+    except UserError as e:
+        transaction.logger.exception(e)
+        transaction.transactional_errors.append(str(e))
+    transaction.finish()
+
+    return transaction.json, transaction.status_code
+
+
+def _chunked_transaction(role, program, project, chunk_size, converter, **tx_kwargs):
+    """
+    Create and execute a :class:`ChunkedUploadTransaction` for the request
+    body. Delimited documents are converted while they are read from the
+    request stream; JSON documents are split into lists of ``chunk_size``
+    entities.
+    """
+    if tx_kwargs.pop("is_async", utils.is_flag_set(FLAG_IS_ASYNC)):
+        raise UserError(
+            "'{}' cannot be combined with '{}'".format(FLAG_CHUNK_SIZE, FLAG_IS_ASYNC)
+        )
+    resume_from_chunk = utils.get_int_flag(FLAG_RESUME_FROM_CHUNK, default=0)
+
+    if converter:
+        doc_format, converter_cls = converter
+        chunks = _delimited_chunks(converter_cls(), flask.request.stream, chunk_size)
     else:
-        response, code = single_transaction_worker(transaction, *doc_args)
+        doc_format = "json"
+        chunks = _json_chunks(utils.parse.parse_request_json(), chunk_size)
+
+    db_driver = tx_kwargs.pop("db_driver", flask.current_app.db)
+    transaction = ChunkedUploadTransaction(
+        chunk_size,
+        resume_from_chunk=resume_from_chunk,
+        program=program,
+        project=project,
+        role=role,
+        document_name=flask.request.headers.get("X-Document-Name", None),
+        logger=flask.current_app.logger,
+        flask_config=flask.current_app.config,
+        index_client=flask.current_app.index_client,
+        external_proxies=utils.get_external_proxies(),
+        db_driver=db_driver,
+        **tx_kwargs
+    )
+    response, code = chunked_transaction_worker(transaction, doc_format, chunks)
+    return flask.jsonify(response), code
 
-        # create the resource in arborist
-        auth.create_resource(program, project, doc_args[3])
 
-        return flask.jsonify(response), code
+def _delimited_chunks(converter, stream, chunk_size):
+    """
+    Yield ``(doc, data)`` for each chunk of a delimited document read from
+    ``stream``, where ``doc`` holds the chunk's rows under the document's
+    header so that each chunk is a valid document on its own.
+    """
+    spool = io.StringIO()
+    header = None
+    for data in converter.convert_stream(stream, chunk_size, copy_to=spool):
+        if converter.errors:
+            raise UserError("Unable to parse doc: {}".format(converter.errors))
+        doc = spool.getvalue()
+        spool.seek(0)
+        spool.truncate()
+        if header is None:
+            header, _, doc = doc.partition("\n")
+            header += "\n"
+        yield header + doc, data
+    if converter.errors:
+        raise UserError("Unable to parse doc: {}".format(converter.errors))
+
+
+def _json_chunks(data, chunk_size):
+    """Yield ``(doc, data)`` for each list of ``chunk_size`` JSON entities."""
+    if isinstance(data, dict):
+        data = [data]
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        yield json.dumps(chunk), chunk
 
 
 def unpack_bulk_wrapper(wrapper):
@@ -192,7 +443,7 @@ def _add_wrapper_to_bulk_transaction(transaction, wrapper, index):
     transaction.add_doc(name, doc_format, doc, data)
 
 
-def bulk_transaction_worker(transaction, wrappers):
+def bulk_transaction_worker(transaction, wrappers, render=render_json):
     session = transaction.db_driver.session_scope(can_inherit=False)
 
     with session, transaction:
@@ -226,9 +477,10 @@ def bulk_transaction_worker(transaction, wrappers):
         except Exception as e:  # pylint: disable=broad-except
             transaction.record_internal_error(e)
         finally:
-            response = transaction.json
+            response = render(transaction)
+            code = transaction.status_code
 
-        return response, response["code"]
+        return response, code
 
 
 def handle_bulk_transaction(role, program, project, **tx_kwargs):
@@ -272,13 +524,13 @@ def handle_bulk_transaction(role, program, project, **tx_kwargs):
                 "message": "Transaction submitted.",
                 "transaction_id": transaction.transaction_id,
             }
-        flask.current_app.async_pool.schedule(
-            bulk_transaction_worker, transaction, wrappers
-        )
+        schedule_upload(bulk_transaction_worker, transaction, wrappers)
         return flask.jsonify(response)
     else:
-        response, code = bulk_transaction_worker(transaction, wrappers)
-        return flask.jsonify(response), code
+        response, code = bulk_transaction_worker(
+            transaction, wrappers, render=render_response
+        )
+        return make_response(response, code)
 
 
 def handle_biospecimen_bcr_xml_transaction(role, program, project, **tx_kwargs):
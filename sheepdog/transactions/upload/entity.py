@@ -11,7 +11,6 @@ from psqlgraph.exc import ValidationError
 
 from sheepdog import dictionary
 from sheepdog import models
-from sheepdog.auth import authorize
 from sheepdog.errors import AuthZError, InternalError
 from sheepdog.globals import (
     REGEX_UUID,
@@ -59,14 +58,43 @@ class UploadEntity(EntityBase):
         super(UploadEntity, self).__init__(transaction)
         self.doc = {}
         self.parents = {}
-        self._secondary_keys = None
         self._config = config
 
+    @property
+    def doc(self):
+        """The json upload representation of the entity."""
+        return self._doc
+
+    @doc.setter
+    def doc(self, doc):
+        self._doc = doc
+        self.doc_changed()
+
+    def doc_changed(self):
+        """
+        Forget the skeleton node and secondary keys derived from the document.
+        Must be called after modifying ``self.doc`` in place.
+        """
+        self._skeleton_node = None
+        self._skeleton_node_type = None
+        self._secondary_keys = None
+
+    @property
+    def skeleton_node(self):
+        """
+        Return a node with just the document's properties set, built once per
+        version of the document.
+        """
+        if self._skeleton_node_type != self.entity_type:
+            self._skeleton_node = self.get_skeleton_node(self.entity_type, self.doc)
+            self._skeleton_node_type = self.entity_type
+        return self._skeleton_node
+
     @property
     def secondary_keys(self):
         """Return the tuple of unique dicts for the node."""
         if self._secondary_keys is None:
-            node = self.node or self.get_skeleton_node(self.entity_type, self.doc)
+            node = self.node or self.skeleton_node
             if node:
                 self._secondary_keys = node._secondary_keys
             else:
@@ -76,14 +104,14 @@ class UploadEntity(EntityBase):
     @property
     def secondary_keys_dicts(self):
         """Return the list of unique tuples for the node."""
-        node = self.node or self.get_skeleton_node(self.entity_type, self.doc)
+        node = self.node or self.skeleton_node
         return [] if not node else node._secondary_keys_dicts
 
     @property
     def pg_secondary_keys(self):
         """Return the list of unique tuples for the node type"""
 
-        node = self.node or self.get_skeleton_node(self.entity_type, self.doc)
+        node = self.node or self.skeleton_node
         return [] if not node else node.__pg_secondary_keys
 
     def parse(self, doc):
@@ -231,7 +259,7 @@ class UploadEntity(EntityBase):
         # Check user permissions for updating nodes
         try:
             program, project = self.transaction.project_id.split("-", 1)
-            authorize(program, project, ["create"])
+            self.transaction.authz_context.authorize(program, project, ["create"])
         except AuthZError:
             return self.record_error(
                 "You do not have create permission for project {}".format(
@@ -269,16 +297,16 @@ class UploadEntity(EntityBase):
 
         if not self.entity_id:
             self.entity_id = str(uuid.uuid4())
+            # Nodes are looked up by id *and* secondary keys, so there is
+            # nothing to find for a freshly generated id
+            skip_node_lookup = True
 
         # Assert that the node doesn't already exist
         if not skip_node_lookup:
-            nodes = lookup_node(
-                self.transaction.db_driver,
-                self.entity_type,
-                self.entity_id,
-                self.secondary_keys,
+            nodes = self.transaction.node_cache.lookup(
+                self.entity_type, self.entity_id, self.secondary_keys
             )
-            if nodes.count():
+            if nodes:
                 return self.record_error(
                     "Cannot create entity that already exists. "
                     "Try updating entity (PUT instead of POST)",
@@ -290,6 +318,7 @@ class UploadEntity(EntityBase):
         for key, val in self.get_system_property_defaults().items():
             if self.doc.get(key, None) is None:
                 self.doc[key] = val
+        self.doc_changed()
 
         # Create the node and populate its properties
         cls = psqlgraph.Node.get_subclass(self.entity_type)
@@ -309,16 +338,12 @@ class UploadEntity(EntityBase):
             Optional[psqlgraph.Node]
         """
         # Expect one existing node matching the secondary keys.
-        try:
-            node = lookup_node(
-                self.transaction.db_driver,
-                self.entity_type,
-                self.entity_id,
-                self.secondary_keys,
-            ).one()
-        except sqlalchemy.orm.exc.NoResultFound:
+        nodes = self.transaction.node_cache.lookup(
+            self.entity_type, self.entity_id, self.secondary_keys
+        )
+        if not nodes:
             return self.get_node_create()
-        except sqlalchemy.orm.exc.MultipleResultsFound:
+        if len(nodes) > 1:
             self.record_error(
                 "Entity is not unique, multiple entities found with {}".format(
                     self.secondary_keys
@@ -326,11 +351,12 @@ class UploadEntity(EntityBase):
                 type=EntityErrors.NOT_UNIQUE,
             )
             return None
+        node = nodes[0]
 
         # Check user permissions for updating nodes
         try:
             program, project = self.transaction.project_id.split("-", 1)
-            authorize(program, project, ["update"])
+            self.transaction.authz_context.authorize(program, project, ["update"])
         except AuthZError:
             return self.record_error(
                 "You do not have update permission for project {}".format(
@@ -389,6 +415,7 @@ class UploadEntity(EntityBase):
                 ).format(key, self.doc.get(key))
                 self.record_warning(msg, keys=[key], type=EntityErrors.INVALID_PROPERTY)
             self.doc[key] = node._props.get(key)
+        self.doc_changed()
 
         self.action = "update"
         self.entity_id = node.node_id
@@ -426,8 +453,11 @@ class UploadEntity(EntityBase):
                 if target:
                     doc_sk.add(target._secondary_keys)
 
-            # Add links that are in the database, but not the JSON doc
+            # Add links that are in the database, but not the JSON doc.
+            # These are registered in the node cache so that linking to them
+            # by id later on doesn't query for them again.
             for n in getattr(node, name):
+                self.transaction.node_cache.add(n)
                 node_in_doc = n._secondary_keys in doc_sk or n.node_id in doc_ids
                 if not node_in_doc:
                     self.doc[name].append({"id": n.node_id})
@@ -435,6 +465,7 @@ class UploadEntity(EntityBase):
             # Remove empty link list
             if not self.doc[name]:
                 self.doc.pop(name)
+        self.doc_changed()
 
     def _remove_empty_values(self, doc):
         for key in doc.keys():
@@ -626,9 +657,11 @@ class UploadEntity(EntityBase):
                 doc[key] = prop["default"]
         return doc
 
-    def set_association_proxies(self):
+    def link_targets(self):
         """
-        Set all links on the actual node instance.
+        Yield a ``(name, target_id, target)`` tuple for each link in the
+        document, where ``target`` is a skeleton node of the destination type
+        carrying the link's properties.
         """
         if not self.node:
             return
@@ -644,73 +677,80 @@ class UploadEntity(EntityBase):
             if isinstance(links, dict):
                 links = [links]
 
+            target_label = self.node._pg_links.get(name, {}).get("dst_type", None).label
             for link in links:
-                # Get target information
-                target_id = link.get("id")
-                target_label = (
-                    self.node._pg_links.get(name, {}).get("dst_type", None).label
-                )
                 target = self.get_skeleton_node(target_label, link)
+                yield name, link.get("id"), target
 
-                # Query for targets
-                nodes = lookup_node(
-                    self.transaction.db_driver,
-                    self.node._pg_links[name]["dst_type"].label,
-                    node_id=target_id,
-                    secondary_keys=target._secondary_keys,
-                ).all()
-
-                # Verify any link to projects is in the correct project
-                if self.node._pg_links[name]["dst_type"] == models.Project:
-                    for node in nodes:
-                        if node.code != self.transaction.project:
-                            self.record_error(
-                                "Cannot link entity to project"
-                                " {} under {} endpoint".format(
-                                    node.code, self.transaction.project
-                                ),
-                                type=EntityErrors.INVALID_PERMISSIONS,
-                            )
-
-                # Check for duplicates
-                if len(nodes) > 1:
-                    self.record_error(
-                        "More than one link destination found for {}".format(name),
-                        keys=[name],
-                        type=EntityErrors.INVALID_LINK,
-                    )
-                    continue
-
-                # Check for missing links
-                elif len(nodes) == 0:
-                    msg = "No link destination found for {}".format(name)
-                    if target_id:
-                        msg += ", id='{}'".format(target_id)
-
-                    msg += ", unique_keys='{}'".format(target._secondary_keys_dicts)
-                    # NOTE: this file is not using "coding: utf-8"; it it were,
-                    # this would have to use a json.loads(json.dumps(...))
-                    # cycle to remove the unicode articact 'u' in front of all
-                    # the keys.
-
-                    self.record_error(msg, keys=[name], type=EntityErrors.INVALID_LINK)
-                    continue
-
-                # Finally, add the target to the association proxy list
-                for n in nodes:
-                    disallowed = (
-                        "project_id" in n.props
-                        and n.project_id != self.transaction.project_id
-                    )
-                    if disallowed:
+    def set_association_proxies(self):
+        """
+        Set all links on the actual node instance.
+
+        Link destinations are resolved through the transaction's node cache,
+        which :meth:`UploadTransaction.create_links` fills beforehand.
+        """
+        if not self.node:
+            return
+
+        for name, target_id, target in self.link_targets():
+            # Query for targets
+            nodes = self.transaction.node_cache.lookup(
+                self.node._pg_links[name]["dst_type"].label,
+                target_id,
+                target._secondary_keys,
+            )
+
+            # Verify any link to projects is in the correct project
+            if self.node._pg_links[name]["dst_type"] == models.Project:
+                for node in nodes:
+                    if node.code != self.transaction.project:
                         self.record_error(
-                            "Relationship to {} {} in project {} not allowed".format(
-                                n.label, n.node_id, n.project_id
+                            "Cannot link entity to project"
+                            " {} under {} endpoint".format(
+                                node.code, self.transaction.project
                             ),
-                            type=EntityErrors.INVALID_LINK,
+                            type=EntityErrors.INVALID_PERMISSIONS,
                         )
-                    if n not in getattr(self.node, name):
-                        getattr(self.node, name).append(n)
+
+            # Check for duplicates
+            if len(nodes) > 1:
+                self.record_error(
+                    "More than one link destination found for {}".format(name),
+                    keys=[name],
+                    type=EntityErrors.INVALID_LINK,
+                )
+                continue
+
+            # Check for missing links
+            elif len(nodes) == 0:
+                msg = "No link destination found for {}".format(name)
+                if target_id:
+                    msg += ", id='{}'".format(target_id)
+
+                msg += ", unique_keys='{}'".format(target._secondary_keys_dicts)
+                # NOTE: this file is not using "coding: utf-8"; it it were,
+                # this would have to use a json.loads(json.dumps(...))
+                # cycle to remove the unicode articact 'u' in front of all
+                # the keys.
+
+                self.record_error(msg, keys=[name], type=EntityErrors.INVALID_LINK)
+                continue
+
+            # Finally, add the target to the association proxy list
+            for n in nodes:
+                disallowed = (
+                    "project_id" in n.props
+                    and n.project_id != self.transaction.project_id
+                )
+                if disallowed:
+                    self.record_error(
+                        "Relationship to {} {} in project {} not allowed".format(
+                            n.label, n.node_id, n.project_id
+                        ),
+                        type=EntityErrors.INVALID_LINK,
+                    )
+                if n not in getattr(self.node, name):
+                    getattr(self.node, name).append(n)
 
     def specify_errors(self):
         """
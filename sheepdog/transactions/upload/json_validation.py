@@ -0,0 +1,109 @@
+"""
+JSON schema validation of the entities of an upload transaction.
+
+The entities are validated one label at a time: each dictionary schema is
+compiled once into a ``Draft4Validator``, cached across transactions for the
+current version of the dictionary, and used for every entity of that label.
+The errors recorded on each entity are the same as those of
+``GDCJSONValidator``.
+"""
+
+from collections import OrderedDict
+import re
+from threading import Lock
+
+from jsonschema import Draft4Validator, FormatChecker
+
+from sheepdog import dictionary
+from sheepdog.globals import dictionary_commit, dictionary_version
+
+
+MISSING_PROP_REGEXP = re.compile("'([a-zA-Z_-]+)' is a required property")
+EXTRA_PROP_REGEXP = re.compile(
+    r"Additional properties are not allowed \(u'([a-zA-Z_-]+)' was unexpected\)"
+)
+
+_validators = {}
+_validators_lock = Lock()
+
+
+def get_keys(error_message):
+    """Return the property named by a validation error message, if any."""
+    for regexp in (MISSING_PROP_REGEXP, EXTRA_PROP_REGEXP):
+        match = regexp.match(error_message)
+        if match:
+            return [match.group(1)]
+    return []
+
+
+def get_schema_validator(label):
+    """
+    Return the validator of the dictionary schema of ``label``, compiled
+    once per version of the dictionary.
+    """
+    schema = dictionary.schema[label]
+    key = (dictionary_version(), dictionary_commit(), label)
+    validator = _validators.get(key)
+    # The version is "Unknown" for some dictionaries, so check the schema too
+    if validator is None or validator.schema is not schema:
+        # note that the `rfc3339-validator` package is required to validate
+        # the `date-time` format
+        validator = Draft4Validator(schema, format_checker=FormatChecker())
+        with _validators_lock:
+            _validators[key] = validator
+    return validator
+
+
+class BatchJSONValidator(object):
+    """
+    Drop-in replacement for ``GDCJSONValidator`` that validates the entities
+    of a label together, against a cached validator.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+
+    def group_entities(self, entities):
+        """
+        Return the entities to validate grouped by type, in order of first
+        appearance. Like ``GDCJSONValidator``, validation stops at the first
+        entity without a known type, which gets an error recorded.
+        """
+        groups = OrderedDict()
+        for entity in entities:
+            doc = entity.doc
+            if "type" not in doc:
+                entity.record_error("'type' is a required property", keys=["type"])
+                break
+            if doc["type"] not in dictionary.schema:
+                entity.record_error(
+                    "specified type: {} is not in the current data model".format(
+                        doc["type"]
+                    ),
+                    keys=["type"],
+                )
+                break
+            groups.setdefault(doc["type"], []).append(entity)
+        return groups
+
+    def record_errors(self, entities):
+        for label, group in self.group_entities(entities).items():
+            iter_errors = get_schema_validator(label).iter_errors
+            for entity in group:
+                for error in iter_errors(entity.doc):
+                    self.record_error(entity, error)
+
+    def record_error(self, entity, error):
+        if self.logger:
+            self.logger.debug(
+                "Validation error while validating entity '{}' against "
+                "subschema '{}': {}".format(entity.doc, error.schema, error.message)
+            )
+        # the key will be property.subproperty for nested properties
+        keys = [".".join(str(x) for x in error.path)] if error.path else []
+        if not keys:
+            keys = get_keys(error.message)
+        message = error.message
+        if error.context:
+            message += ": {}".format(" and ".join(c.message for c in error.context))
+        entity.record_error(message, keys=keys)
@@ -0,0 +1,174 @@
+"""
+Batched lookup of existing graph nodes for upload transactions.
+
+Instead of issuing one query per entity to find out whether a node already
+exists, an :class:`UploadTransaction` prefetches all of the nodes it may need
+in a few set-based queries per label and resolves each entity against the
+resulting in-memory map.
+"""
+
+from collections import defaultdict
+
+import psqlgraph
+from sqlalchemy import func, tuple_
+
+from sheepdog.transactions.upload.entity import lookup_node
+
+
+#: Maximum number of ids or secondary key tuples sent in a single ``IN`` list.
+NODE_LOOKUP_BATCH_SIZE = 500
+
+
+def _normalize_value(value):
+    """
+    Mirror ``lower(_props ->> key)`` for a single secondary key value: the
+    database compares the text representation of the JSONB value without
+    regard to case.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).lower()
+
+
+def normalize_secondary_keys(secondary_keys):
+    """
+    Return a hashable, case-insensitive form of ``secondary_keys`` (as returned
+    by ``node._secondary_keys``), or ``None`` if the keys are empty or not all
+    set. Incomplete secondary keys are never used to filter queries (see
+    :func:`lookup_node`) and so cannot be cached either.
+    """
+    if not secondary_keys or not all(all(keys) for keys in secondary_keys):
+        return None
+    return tuple(tuple(_normalize_value(v) for v in keys) for keys in secondary_keys)
+
+
+def _batches(items, size=NODE_LOOKUP_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class NodeLookupCache(object):
+    """
+    In-memory map of nodes by ``(label, node_id)`` and by
+    ``(label, secondary_keys)``.
+
+    The cache only answers for keys it has been asked to resolve (through
+    :meth:`prefetch` or :meth:`lookup`), so a cached answer is always the
+    complete set of matching nodes, exactly like the result of
+    :func:`lookup_node`.
+    """
+
+    def __init__(self, db_driver):
+        self.db_driver = db_driver
+        self._nodes_by_id = {}
+        self._nodes_by_secondary_keys = defaultdict(list)
+        #: keys whose lookup result is completely known
+        self._resolved_ids = set()
+        self._resolved_secondary_keys = set()
+
+    def add(self, node):
+        """Register a node (e.g. one returned by a query) in the cache."""
+        label = node.label
+        self._nodes_by_id[(label, node.node_id)] = node
+        self._resolved_ids.add((label, node.node_id))
+        normalized = normalize_secondary_keys(node._secondary_keys)
+        if normalized is not None:
+            nodes = self._nodes_by_secondary_keys[(label, normalized)]
+            if not any(n is node for n in nodes):
+                nodes.append(node)
+
+    def prefetch(self, label, targets):
+        """
+        Resolve all of ``targets`` for nodes of type ``label`` with one query
+        per batch of ids and one query per batch of secondary keys.
+
+        Args:
+            label (str): node label
+            targets (iterable): ``(node_id, secondary_keys)`` tuples, either
+                of which may be ``None``
+        """
+        cls = psqlgraph.Node.get_subclass(label)
+        if not cls:
+            return
+
+        ids, secondary_keys = set(), set()
+        for node_id, keys in targets:
+            if node_id is not None:
+                if (label, node_id) not in self._resolved_ids:
+                    ids.add(node_id)
+                continue
+            normalized = normalize_secondary_keys(keys)
+            if (
+                normalized is not None
+                and (label, normalized) not in self._resolved_secondary_keys
+            ):
+                secondary_keys.add(normalized)
+
+        for batch in _batches(sorted(ids)):
+            for node in self.db_driver.nodes(cls).ids(batch).all():
+                self.add(node)
+            self._resolved_ids.update((label, node_id) for node_id in batch)
+
+        columns = [
+            func.lower(cls._props[key].astext)
+            for keys in getattr(cls, "__pg_secondary_keys", [])
+            for key in keys
+        ]
+        if not columns:
+            return
+        for batch in _batches(secondary_keys):
+            values = [tuple(v for keys in sk for v in keys) for sk in batch]
+            query = self.db_driver.nodes(cls).filter(tuple_(*columns).in_(values))
+            for node in query.all():
+                self.add(node)
+            self._resolved_secondary_keys.update((label, sk) for sk in batch)
+
+    def get(self, label, node_id=None, secondary_keys=None):
+        """
+        Return the cached list of nodes matching ``node_id`` and
+        ``secondary_keys`` (with the semantics of :func:`lookup_node`), or
+        ``None`` if the answer is not known without querying.
+        """
+        normalized = normalize_secondary_keys(secondary_keys)
+        if node_id is not None:
+            if (label, node_id) not in self._resolved_ids:
+                return None
+            node = self._nodes_by_id.get((label, node_id))
+            nodes = [node] if node is not None else []
+            if normalized is not None:
+                nodes = [
+                    n
+                    for n in nodes
+                    if normalize_secondary_keys(n._secondary_keys) == normalized
+                ]
+            return nodes
+        if normalized is not None and (label, normalized) in (
+            self._resolved_secondary_keys
+        ):
+            # Keys may have changed since the node was registered (updates)
+            return [
+                n
+                for n in self._nodes_by_secondary_keys.get((label, normalized), [])
+                if normalize_secondary_keys(n._secondary_keys) == normalized
+            ]
+        return None
+
+    def lookup(self, label, node_id=None, secondary_keys=None):
+        """
+        Return the list of nodes matching ``node_id`` and ``secondary_keys``,
+        from the cache if possible, otherwise from the database.
+        """
+        nodes = self.get(label, node_id, secondary_keys)
+        if nodes is not None:
+            return nodes
+
+        nodes = lookup_node(self.db_driver, label, node_id, secondary_keys).all()
+        for node in nodes:
+            self.add(node)
+        normalized = normalize_secondary_keys(secondary_keys)
+        if node_id is not None and normalized is None:
+            self._resolved_ids.add((label, node_id))
+        elif node_id is None and normalized is not None:
+            self._resolved_secondary_keys.add((label, normalized))
+        return nodes
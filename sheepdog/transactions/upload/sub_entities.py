@@ -16,7 +16,6 @@ from sheepdog import utils
 from sheepdog.transactions.entity_base import EntityErrors
 
 from sheepdog.transactions.upload.entity import UploadEntity
-from sheepdog.transactions.upload.entity import lookup_node
 
 from sheepdog import dictionary
 
@@ -516,12 +515,9 @@ class FileUploadEntity(UploadEntity):
         is_valid = True
         # if a single match exists in the graph, check to see if
         # file exists in index service
-        nodes = lookup_node(
-            self.transaction.db_driver,
-            self.entity_type,
-            self.entity_id,
-            self.secondary_keys,
-        ).all()
+        nodes = self.transaction.node_cache.lookup(
+            self.entity_type, self.entity_id, self.secondary_keys
+        )
         if len(nodes) == 1:
             if self.file_exists:
                 file_by_uuid_index = getattr(self.file_by_uuid, "did", None)
@@ -3,19 +3,22 @@ Define the ``UploadTransaction`` class.
 """
 
 import re
-from collections import Counter
+import tempfile
+from collections import defaultdict
 
 # Validating Entity Existence in dbGaP
 from authutils import dbgap
-from datamodelutils import validators
+from sqlalchemy import Integer, cast, column, values
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.attributes import flag_modified
 from gdcdictionary import gdcdictionary
 
+from sheepdog import auth
 from sheepdog import models
 from sheepdog import utils
 from sheepdog.errors import UserError, HandledIntegrityError
 from sheepdog.globals import (
+    FLAG_RESUME_FROM_CHUNK,
     TX_LOG_STATE_ERRORED,
     TX_LOG_STATE_FAILED,
     TX_LOG_STATE_SUCCEEDED,
@@ -23,12 +26,37 @@ from sheepdog.globals import (
 from sheepdog.transactions.upload.entity import EntityErrors
 from sheepdog.transactions.transaction_base import TransactionBase
 from sheepdog.transactions.upload.entity_factory import UploadEntityFactory
+from sheepdog.transactions.upload.json_validation import BatchJSONValidator
+from sheepdog.transactions.upload.node_cache import NodeLookupCache, _batches
+from sheepdog.utils.document_store import get_document_store, new_document_key
+from sheepdog.utils.streaming import SPOOL_MAX_SIZE
 
 
 KEYS_REGEXP = re.compile(r"_props ->> '([^']+)+'::text")
 VALUES_REGEXP = re.compile(r"=\(([^\(\)]+)\)")
 
 
+def index_entities(entities, key):
+    """
+    Return a dict from each value of ``key(entity)`` to the list of entities
+    with that value, built in a single pass.
+    """
+    index = defaultdict(list)
+    for entity in entities:
+        index[key(entity)].append(entity)
+    return index
+
+
+def duplicated_entities(entities, key):
+    """
+    Yield a ``(value, entities)`` tuple for each value of ``key(entity)``
+    shared by several entities.
+    """
+    for value, group in index_entities(entities, key).items():
+        if len(group) > 1:
+            yield value, group
+
+
 class UploadTransaction(TransactionBase):
     """
     An UploadTransaction should be used as a context manager. This way, we can
@@ -47,6 +75,8 @@ class UploadTransaction(TransactionBase):
 
     REQUIRED_PROJECT_STATES = ["open"]
 
+    ASYNC_AUTHZ_ROLES = (["create"], ["update"])
+
     def __init__(self, **kwargs):
         """
         Initizalize the UploadTransaction.
@@ -57,9 +87,15 @@ class UploadTransaction(TransactionBase):
         #: HTTP[S] proxies used for requests to external services
         # Base class doesn't know about this, so pop first
         self.external_proxies = kwargs.pop("external_proxies", {})
+        # A BulkUploadTransaction shares one cache between its subtransactions
+        node_cache = kwargs.pop("node_cache", None)
+        #: Stores the submitted documents (see sheepdog.utils.document_store)
+        self.document_store = kwargs.pop("document_store", None) or get_document_store()
         super(UploadTransaction, self).__init__(**kwargs)
         self.documents = []
-        self.json_validator = validators.GDCJSONValidator()
+        self.json_validator = BatchJSONValidator(self.logger)
+        #: Existing nodes resolved for this transaction's entities
+        self.node_cache = node_cache or NodeLookupCache(self.db_driver)
 
         # The dbGapXReferencer conditionally requires cases to exist in
         # dbGaP prior to submission to the Gen3 commons
@@ -69,6 +105,13 @@ class UploadTransaction(TransactionBase):
 
         self._config = kwargs["flask_config"]
 
+    def spec_kwargs(self):
+        return dict(
+            super(UploadTransaction, self).spec_kwargs(),
+            role=self.role,
+            external_proxies=self.external_proxies,
+        )
+
     def get_phsids(self):
         """Fetch the phsids for the current project."""
         project = utils.lookup_project(self.db_driver, self.program, self.project)
@@ -79,9 +122,7 @@ class UploadTransaction(TransactionBase):
     def parse_doc(self, name, doc_format, doc, data):
         """Add/parse a document to the transaction."""
         self.parse_entities(data)
-        tx_document = models.submission.TransactionDocument(
-            name=name, doc_format=doc_format, doc=doc
-        )
+        tx_document = self.new_transaction_document(name, doc_format, doc)
         with self.fetch_transaction_log() as tx_log:
             tx_log.documents.append(tx_document)
 
@@ -98,15 +139,64 @@ class UploadTransaction(TransactionBase):
         """
         if isinstance(docs, dict):
             docs = [docs]
+        self.add_entities(docs)
+        self.prepare_entities()
+
+    def parse_doc_stream(self, name, doc_format, converter, stream):
+        """
+        Add/parse a delimited document read incrementally from ``stream``.
+
+        Entities are added one chunk of rows at a time as ``converter`` reads
+        them, so the request body, the normalized document and the converted
+        rows are never all held in memory at once. The normalized document is
+        spooled to a temporary file (on disk past ``SPOOL_MAX_SIZE``), which
+        the document store reads back for the transaction's document record.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+") as spool:
+            for chunk in converter.convert_stream(stream, copy_to=spool):
+                self.add_entities(chunk)
+            if converter.errors:
+                raise UserError(
+                    "Unable to parse doc '{}': {}".format(name, converter.errors)
+                )
+            spool.seek(0)
+            tx_document = self.new_transaction_document(name, doc_format, spool)
+
+        self.prepare_entities()
+        with self.fetch_transaction_log() as tx_log:
+            tx_log.documents.append(tx_document)
+
+    def new_transaction_document(self, name, doc_format, doc):
+        """
+        Return a TransactionDocument for the submitted ``doc`` (a string or a
+        text file), saved by the transaction's document store.
+        """
+        key = new_document_key(self.project_id, self.transaction_id)
+        if isinstance(doc, str):
+            value = self.document_store.dump(doc, key)
+        else:
+            value = self.document_store.dump_file(doc, key)
+        return models.submission.TransactionDocument(
+            name=name, doc_format=doc_format, doc=value
+        )
+
+    def add_entities(self, docs):
+        """
+        Add each of ``docs`` as an entity of the transaction and record them
+        in the transaction log's canonical JSON.
+        """
         for doc in docs:
             self.add_entity(doc)
 
-        with self.fetch_transaction_log() as tx_log:
-            tx_log.canonical_json += docs
-            # Mark the column dirty, or else sqlalchemy won't know it was
-            # mutated.
-            flag_modified(tx_log, "canonical_json")
+        # Appended to the stored canonical_json once, when the log is written
+        with self.fetch_transaction_log():
+            self.transaction_log_writer.append_canonical_json(docs)
 
+    def prepare_entities(self):
+        """
+        Validate the transaction's entities against the JSON schema, then
+        create their nodes and run the pre-graph validation.
+        """
         self.json_validator.record_errors(self.entities)
         self.instantiate()
         self.pre_validate()
@@ -130,19 +220,15 @@ class UploadTransaction(TransactionBase):
         """
         # Make sure that all entities are unique by checking for duplicate
         # secondary keys.
-        checked = set()
-        entities_secondary_keys = (
-            entity.secondary_keys
-            for entity in self.valid_entities
-            if entity.secondary_keys
-        )
-        for secondary_keys in entities_secondary_keys:
-            if secondary_keys in checked:
+        entities = [entity for entity in self.valid_entities if entity.secondary_keys]
+        for secondary_keys, group in duplicated_entities(
+            entities, lambda entity: entity.secondary_keys
+        ):
+            for _ in group[1:]:
                 self.record_error(
                     "Entity is not unique, {}".format(secondary_keys),
                     type=EntityErrors.NOT_UNIQUE,
                 )
-            checked.add(secondary_keys)
 
         self.specify_errors()
 
@@ -157,8 +243,10 @@ class UploadTransaction(TransactionBase):
 
     def integrity_check(self):
         """
-        Perform integrity check for all the valid entities
+        Perform integrity check for all the valid entities, with one query
+        per label and set of unique keys (for each batch of entities).
         """
+        candidates = defaultdict(list)
         for entity in self.valid_entities:
             schema = gdcdictionary.schema[entity.node.label]
             node = entity.node
@@ -172,22 +260,90 @@ class UploadTransaction(TransactionBase):
                         props[prop] = node[prop]
                     else:
                         props[key] = node[key]
-                if self.db_driver.nodes(type(node)).props(props).count() > 0:
+                candidates[(type(node), tuple(keys))].append((entity, props))
+
+        for (cls, _), key_candidates in candidates.items():
+            for batch in _batches(key_candidates):
+                existing = self.existing_props(cls, [props for _, props in batch])
+                for index in existing:
+                    entity, props = batch[index]
                     entity.record_error(
-                        "{} with {} already exists in the DB".format(node.label, props),
+                        "{} with {} already exists in the DB".format(
+                            entity.node.label, props
+                        ),
                         keys=list(props.keys()),
                     )
 
+    def existing_props(self, cls, props_list):
+        """
+        Return the indexes in ``props_list`` of the properties already held
+        by a node of class ``cls``, by joining a ``VALUES`` list of the
+        properties on the nodes' JSONB ``_props``.
+        """
+        candidates = values(
+            column("index", Integer), column("props", JSONB), name="candidates"
+        ).data(list(enumerate(props_list)))
+        query = (
+            self.db_driver.nodes(cls)
+            .join(candidates, cls._props.contains(cast(candidates.c.props, JSONB)))
+            .with_entities(candidates.c.index)
+            .distinct()
+        )
+        return sorted(index for index, in query.all())
+
     def instantiate(self):
         """Create a SQLAlchemy model for all transaction entities."""
+        self.prefetch_nodes(self.valid_entities)
         for entity in self.valid_entities:
             entity.instantiate()
 
+    def prefetch_nodes(self, entities):
+        """
+        Resolve the existing nodes for ``entities`` with a few set-based
+        queries per label, so that each entity's create-vs-merge decision is
+        made against :attr:`node_cache` instead of the database.
+
+        Entities without an id are only looked up by secondary keys when
+        updating: a node created with a newly generated id cannot already
+        exist.
+        """
+        targets = defaultdict(list)
+        for entity in entities:
+            if not entity.entity_type:
+                continue
+            if entity.entity_id:
+                targets[entity.entity_type].append((entity.entity_id, None))
+            elif self.role == "update":
+                targets[entity.entity_type].append((None, entity.secondary_keys))
+        for label, label_targets in targets.items():
+            self.node_cache.prefetch(label, label_targets)
+
     def create_links(self):
         """Construct edges between all transaction entities."""
+        self.prefetch_links(self.valid_entities)
         for entity in self.valid_entities:
             entity.set_association_proxies()
 
+    def prefetch_links(self, entities):
+        """
+        Resolve the link destinations of ``entities`` with a few set-based
+        queries per destination label. Destinations that are part of this
+        transaction were registered in :attr:`node_cache` by :meth:`flush`
+        and are not queried again.
+        """
+        targets = defaultdict(list)
+        for entity in entities:
+            for name, target_id, target in entity.link_targets():
+                if target is None:
+                    continue
+                label = entity.node._pg_links[name]["dst_type"].label
+                if target_id:
+                    targets[label].append((target_id, None))
+                else:
+                    targets[label].append((None, target._secondary_keys))
+        for label, label_targets in targets.items():
+            self.node_cache.prefetch(label, label_targets)
+
     def flush(self):
         """
         Flush entities to the session.
@@ -202,6 +358,10 @@ class UploadTransaction(TransactionBase):
         for entity in self.valid_entities:
             entity.flush_to_session()
         self.session.flush()
+        # Later link resolution can find this transaction's nodes in memory
+        for entity in self.valid_entities:
+            if entity.node is not None:
+                self.node_cache.add(entity.node)
 
     @property
     def status_code(self):
@@ -217,13 +377,13 @@ class UploadTransaction(TransactionBase):
             return 400
 
     @property
-    def json(self):
+    def json_envelope(self):
         """
-        Return a JSON representation of transaction status, errors, entities,
-        etc.
+        Return a JSON representation of transaction status, errors, etc.
+        (``json`` adds the entities).
         """
         doc = dict(
-            self.base_json,
+            super(UploadTransaction, self).json_envelope,
             **{
                 "created_entity_count": self.created_entity_count,
                 "updated_entity_count": self.updated_entity_count,
@@ -299,6 +459,8 @@ class BulkUploadTransaction(TransactionBase):
 
     REQUIRED_PROJECT_STATES = ["open"]
 
+    ASYNC_AUTHZ_ROLES = (["create"], ["update"])
+
     def __init__(self, **kwargs):
         """
         BulkUploadTransaction inherits from TransactionBase to support the
@@ -308,10 +470,22 @@ class BulkUploadTransaction(TransactionBase):
             TransactionBase.__init__()
         """
         self.external_proxies = kwargs.pop("external_proxies", {})
+        #: Shared with the subtransactions (see sheepdog.utils.document_store)
+        self.document_store = kwargs.pop("document_store", None) or get_document_store()
         super(BulkUploadTransaction, self).__init__(**kwargs)
         self.flush_timestamp = None
         self.transactional_errors = []
         self.subtransactions = []
+        #: Identity map of nodes resolved by any of the subtransactions, so
+        #: shared parents (project, case, ...) are only looked up once
+        self.node_cache = NodeLookupCache(self.db_driver)
+
+    def spec_kwargs(self):
+        return dict(
+            super(BulkUploadTransaction, self).spec_kwargs(),
+            role=self.role,
+            external_proxies=self.external_proxies,
+        )
 
     @property
     def success(self):
@@ -347,13 +521,16 @@ class BulkUploadTransaction(TransactionBase):
             role=self.role,
             dry_run=self.dry_run,
             db_driver=self.db_driver,
-            user=self.user,
             document_name=name,
             logger=self.logger,
             transaction_id=self.transaction_id,
             index_client=self.index_client,
             flask_config=self.config,
             external_proxies=self.external_proxies,
+            node_cache=self.node_cache,
+            transaction_log_writer=self.transaction_log_writer,
+            document_store=self.document_store,
+            authz_context=self.authz_context,
         )
         sub_transaction.parse_doc(name, doc_format, doc, data)
         self.subtransactions.append(sub_transaction)
@@ -416,27 +593,12 @@ class BulkUploadTransaction(TransactionBase):
         if not self.success:
             return
 
-        def duplicates(counter):
-            """Filter for items in a counter with count > 1."""
-            return {item: count for item, count in counter if count > 1}
-
-        ids = [entity.entity_id for entity in self.entities]
-        dup_ids = duplicates(Counter(ids).items())
-        secondary_keys = [e.secondary_keys for e in self.entities]
-        dup_secondary_keys = duplicates(Counter(secondary_keys).items())
-        # Check secondary_keys
-        for sk in dup_secondary_keys.keys():
-            for entity in self.entities:
-                if entity.secondary_keys == sk:
-                    entity.record_error(
-                        "Entity is duplicated elsewhere in bulk transaction",
-                        type=EntityErrors.NOT_UNIQUE,
-                    )
-
-        # Check entity ids
-        for ID in dup_ids.keys():
-            for entity in self.entities:
-                if entity.entity_id == ID:
+        entities = self.entities
+        # Check secondary_keys, then entity ids
+        keys = [lambda e: e.secondary_keys, lambda e: e.entity_id]
+        for key in keys:
+            for _, group in duplicated_entities(entities, key):
+                for entity in group:
                     entity.record_error(
                         "Entity is duplicated elsewhere in bulk transaction",
                         type=EntityErrors.NOT_UNIQUE,
@@ -455,16 +617,22 @@ class BulkUploadTransaction(TransactionBase):
                 doc.response_json = sub_tx.json
 
     def write_transaction_log(self):
-        with self.fetch_transaction_log() as tx_log:
-            tx_log.submitter = self.user.username
+        """
+        Write the transaction log, with the documents and canonical JSON
+        queued by all the subtransactions, at once.
+        """
+        with self.fetch_transaction_log(flush=True) as tx_log:
+            tx_log.submitter = auth.current_user.username
             if self.success:
-                for entity in self.entities:
-                    snapshot = models.submission.TransactionSnapshot()
-                    snapshot.entity_id = entity.node.node_id
-                    snapshot.old_props = entity.old_props
-                    snapshot.new_props = entity.node.props
-                    snapshot.action = entity.action
-                    tx_log.entities.append(snapshot)
+                self.transaction_log_writer.add_snapshots(
+                    (
+                        entity.node.node_id,
+                        entity.action,
+                        entity.old_props,
+                        entity.node.props,
+                    )
+                    for entity in self.entities
+                )
 
             self.set_subtransaction_document_response_json()
             tx_log.timestamp = self.flush_timestamp
@@ -497,17 +665,27 @@ class BulkUploadTransaction(TransactionBase):
     @property
     def json(self):
         """
-        TODO
+        Return the ``json_envelope`` with the response of each subtransaction.
         """
-        subtransaction_json = self.subtransaction_json
-        entity_error_count = sum([j["entity_error_count"] for j in subtransaction_json])
-        updated_entity_count = sum(
-            [j["updated_entity_count"] for j in subtransaction_json]
-        )
-        created_entity_count = sum(
-            [j["created_entity_count"] for j in subtransaction_json]
+        return dict(
+            self.json_envelope,
+            subtransactions=[
+                {"name": t.document_name, "response_json": t.json}
+                for t in self.subtransactions
+            ],
         )
-        document_error_count = len([t for t in self.subtransactions if not t.success])
+
+    @property
+    def json_envelope(self):
+        """
+        Return the bulk transaction's status and the counts summed over its
+        subtransactions.
+        """
+        subtransactions = self.subtransactions
+        entity_error_count = sum(t.entity_error_count for t in subtransactions)
+        updated_entity_count = sum(t.updated_entity_count for t in subtransactions)
+        created_entity_count = sum(t.created_entity_count for t in subtransactions)
+        document_error_count = len([t for t in subtransactions if not t.success])
 
         return {
             "transaction_id": self.transaction_id,
@@ -519,8 +697,183 @@ class BulkUploadTransaction(TransactionBase):
             "created_entity_count": created_entity_count,
             "document_error_count": document_error_count,
             "code": self.status_code,
-            "subtransactions": [
-                {"name": t.document_name, "response_json": t.json}
+        }
+
+    def response_json(self, summary=False):
+        """
+        Return the ``json`` of the bulk transaction with the subtransaction
+        responses as a generator (see :meth:`TransactionBase.response_json`).
+        """
+        return dict(
+            self.json_envelope,
+            subtransactions=(
+                {"name": t.document_name, "response_json": t.response_json(summary)}
                 for t in self.subtransactions
+            ),
+        )
+
+
+class UploadChunkTransaction(UploadTransaction):
+    """
+    One chunk of a :class:`ChunkedUploadTransaction`.
+
+    The chunk is flushed, validated and committed on its own, but writes to the
+    parent's TransactionLog through its own TransactionDocument. The parent
+    decides the state of the log once all chunks ran, so the chunk only keeps
+    track of its state.
+    """
+
+    def __init__(self, **kwargs):
+        super(UploadChunkTransaction, self).__init__(**kwargs)
+        self.state = None
+
+    def set_transaction_log_state(self, state):
+        self.state = state
+
+    def get_transaction_document(self, tx_log):
+        for tx_document in tx_log.documents:
+            if tx_document.name == self.document_name:
+                return tx_document
+        return None
+
+
+class ChunkedUploadTransaction(TransactionBase):
+    """
+    Upload a document in chunks of ``chunk_size`` entities, each committed in
+    its own session by an :class:`UploadChunkTransaction`. This bounds the
+    number of ORM nodes and row locks held at a time for very large uploads.
+
+    All chunks write to one TransactionLog, with a TransactionDocument per
+    chunk. Chunks are processed in order and processing stops at the first
+    chunk that fails: the chunks before it stay committed, and the same
+    document can be resubmitted with ``resume_from_chunk`` set to the index of
+    the failed chunk (reported in the response) to skip the committed ones.
+    """
+
+    REQUIRED_PROJECT_STATES = ["open"]
+
+    def __init__(self, chunk_size, resume_from_chunk=0, **kwargs):
+        self.external_proxies = kwargs.pop("external_proxies", {})
+        super(ChunkedUploadTransaction, self).__init__(**kwargs)
+        self.chunk_size = chunk_size
+        self.resume_from_chunk = resume_from_chunk
+        #: (index, name, response json, state) of each processed chunk
+        self.chunks = []
+
+    def new_chunk_transaction(self, index):
+        """Return the transaction for the chunk at ``index``."""
+        return UploadChunkTransaction(
+            program=self.program,
+            project=self.project,
+            role=self.role,
+            dry_run=self.dry_run,
+            db_driver=self.db_driver,
+            document_name=self.chunk_name(index),
+            logger=self.logger,
+            transaction_id=self.transaction_id,
+            index_client=self.index_client,
+            flask_config=self.config,
+            external_proxies=self.external_proxies,
+            authz_context=self.authz_context,
+        )
+
+    def chunk_name(self, index):
+        """Return the name of the TransactionDocument of chunk ``index``."""
+        name = "chunk {}".format(index)
+        if self.document_name:
+            name = "{} ({})".format(self.document_name, name)
+        return name
+
+    def add_chunk(self, index, chunk_transaction):
+        """Record the outcome of a chunk once it has been processed."""
+        self.chunks.append(
+            (
+                index,
+                chunk_transaction.document_name,
+                chunk_transaction.json,
+                chunk_transaction.state,
+            )
+        )
+
+    def finish(self):
+        """Transition the TransactionLog according to all chunks' outcomes."""
+        if not self.chunks and not self.transactional_errors:
+            self.transactional_errors.append("Nothing to submit")
+        if self.success:
+            state = TX_LOG_STATE_SUCCEEDED
+        elif any(state == TX_LOG_STATE_ERRORED for _, _, _, state in self.chunks):
+            state = TX_LOG_STATE_ERRORED
+        else:
+            state = TX_LOG_STATE_FAILED
+        with self.fetch_transaction_log(flush=True) as tx_log:
+            tx_log.submitter = auth.current_user.username
+            tx_log.state = state
+
+    @property
+    def failed_chunk(self):
+        """Return the index of the chunk that failed, if any."""
+        for index, _, response, _ in self.chunks:
+            if not response["success"]:
+                return index
+        return None
+
+    @property
+    def success(self):
+        return (
+            not self.transactional_errors
+            and bool(self.chunks)
+            and self.failed_chunk is None
+        )
+
+    @property
+    def status_code(self):
+        if self.dry_run:
+            return 200
+        elif not self.success:
+            return 400
+        elif self.role == "create":
+            return 201
+        else:
+            return 200
+
+    @property
+    def message(self):
+        if self.success:
+            return "Chunked transaction succeeded."
+        failed_chunk = self.failed_chunk
+        if failed_chunk is None:
+            return "Chunked transaction failed."
+        return (
+            "Chunked transaction failed at chunk {}. Chunks before it were"
+            " {}; resubmit the document with {}={} to continue.".format(
+                failed_chunk,
+                "validated" if self.dry_run else "committed",
+                FLAG_RESUME_FROM_CHUNK,
+                failed_chunk,
+            )
+        )
+
+    @property
+    def json(self):
+        responses = [response for _, _, response, _ in self.chunks]
+        failed_chunk = self.failed_chunk
+        return {
+            "transaction_id": self.transaction_id,
+            "transactional_errors": self.transactional_errors,
+            "success": self.success,
+            "message": self.message,
+            "code": self.status_code,
+            "chunk_size": self.chunk_size,
+            "skipped_chunk_count": self.resume_from_chunk,
+            "committed_chunk_count": (
+                0 if self.dry_run else len([r for r in responses if r["success"]])
+            ),
+            "resume_from_chunk": failed_chunk,
+            "entity_error_count": sum(r["entity_error_count"] for r in responses),
+            "updated_entity_count": sum(r["updated_entity_count"] for r in responses),
+            "created_entity_count": sum(r["created_entity_count"] for r in responses),
+            "chunks": [
+                {"index": index, "name": name, "response_json": response}
+                for index, name, response, _ in self.chunks
             ],
         }
@@ -312,6 +312,23 @@ def is_flag_set(flag, default=False):
         raise UserError("Boolean value not one of [true, false]")
 
 
+def get_int_flag(flag, default=None, minimum=0):
+    """
+    Return the integer value of a flag (e.g. "?chunk_size=5000"), or
+    ``default`` if it is not specified. Requires flask request context.
+    """
+    value = flask.request.args.get(flag)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise UserError("Value of '{}' is not an integer: {}".format(flag, value))
+    if value < minimum:
+        raise UserError("Value of '{}' must be at least {}".format(flag, minimum))
+    return value
+
+
 def json_dumps_formatted(data):
     """Return json string with standard format."""
     dump = json.dumps(data, indent=2, separators=(", ", ": "), ensure_ascii=False)
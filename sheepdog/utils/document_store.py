@@ -0,0 +1,381 @@
+"""
+Storage of the documents submitted with upload transactions.
+
+By default ``TransactionDocument.doc`` holds the submitted document verbatim.
+The document store configured by ``DOCUMENT_STORE`` can instead compress the
+document (``gzip`` or ``zstd``) or put it in an object store (``local``, a
+directory standing in for an object store, or ``s3``), in which case
+``TransactionDocument.doc`` only holds a reference to it.
+
+Stored values other than verbatim documents start with ``STORED_PREFIX`` and
+say how they were stored; verbatim documents that happen to start with it are
+tagged as ``text`` so that they are never mistaken for a stored value.
+:func:`load_document` returns the original document, only following object
+references into the configured object store (a submitted document can't make
+sheepdog read other files or objects).
+
+:func:`decode_stored_documents` makes sheepdog's ``TransactionDocument.doc``
+load documents that way. This only applies within sheepdog: other services
+reading ``transaction_documents.doc`` (e.g. peregrine) get the stored values,
+i.e. compressed documents and object references, unless they decode them with
+:func:`load_document`.
+"""
+
+import base64
+import gzip
+import os
+import shutil
+import tempfile
+import uuid
+import zlib
+
+from cdislogging import get_logger
+import flask
+from sqlalchemy.types import Text, TypeDecorator
+
+from sheepdog.errors import InternalError
+from sheepdog.utils.s3 import get_s3_conn
+from sheepdog.utils.streaming import SPOOL_MAX_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = get_logger(__name__)
+
+STORED_PREFIX = "sheepdog-document-store:"
+
+#: Documents smaller than this are stored verbatim by compressing stores
+DEFAULT_MIN_COMPRESSED_SIZE = 1024
+#: Number of characters read at a time from document files
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def _gzip_compress(data):
+    return gzip.compress(data)
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+    "gzip": (_gzip_compress, gzip.decompress),
+    "zstd": (_zstd_compress, _zstd_decompress),
+}
+
+#: Incremental compressors (with ``compress`` and ``flush``) of the codecs
+COMPRESSORS = {
+    "gzip": lambda: zlib.compressobj(wbits=31),
+    "zstd": lambda: zstandard.ZstdCompressor().compressobj(),
+}
+
+
+def iter_blocks(f, head=""):
+    """Yield ``head``, then the rest of the text file ``f`` by blocks."""
+    yield head
+    yield from iter(lambda: f.read(READ_BLOCK_SIZE), "")
+
+
+def encode_blocks(blocks, codec=None):
+    """Yield the text ``blocks`` UTF-8 encoded and compressed with ``codec``."""
+    compressor = COMPRESSORS[codec]() if codec else None
+    for block in blocks:
+        data = block.encode("utf-8")
+        yield compressor.compress(data) if compressor else data
+    if compressor:
+        yield compressor.flush()
+
+
+def dump_verbatim(doc):
+    """
+    Return the value saving ``doc`` verbatim, tagged if it could be taken for
+    a stored value.
+    """
+    if doc and doc.startswith(STORED_PREFIX):
+        return "{}text:{}".format(STORED_PREFIX, doc)
+    return doc
+
+
+class DocumentStore(object):
+    """Store documents verbatim in ``TransactionDocument.doc``."""
+
+    #: Where documents are put, if not in the database
+    object_store = None
+
+    def dump(self, doc, key):
+        """
+        Return the value to save in ``TransactionDocument.doc`` for ``doc``.
+
+        Args:
+            doc (str): the submitted document
+            key (str): unique name for the document, e.g. to name an object
+        """
+        return dump_verbatim(doc)
+
+    def dump_file(self, f, key):
+        """
+        Same as :meth:`dump` for the document in the text file ``f`` (e.g. a
+        spooled file), read from its current position.
+        """
+        return self.dump(f.read(), key)
+
+    def load(self, value):
+        """Return the document saved as ``value`` (see :func:`load_document`)."""
+        return load_document(value, self.object_store)
+
+
+class CompressedDocumentStore(DocumentStore):
+    """
+    Store documents compressed with ``codec`` (and base64 encoded, as the
+    column is text) in ``TransactionDocument.doc``.
+    """
+
+    def __init__(self, codec="gzip", min_size=DEFAULT_MIN_COMPRESSED_SIZE):
+        if codec not in CODECS:
+            raise ValueError("Unknown document codec '{}'".format(codec))
+        if codec == "zstd" and zstandard is None:
+            raise InternalError("The zstandard package is required for zstd")
+        self.codec = codec
+        self.min_size = min_size
+
+    def dump(self, doc, key):
+        if not doc or len(doc) < self.min_size:
+            return dump_verbatim(doc)
+        compress, _ = CODECS[self.codec]
+        return self._stored_value(compress(doc.encode("utf-8")))
+
+    def dump_file(self, f, key):
+        """Compress the document in ``f`` one block at a time."""
+        head = f.read(max(self.min_size, 1))
+        if not head or len(head) < self.min_size:
+            return dump_verbatim(head)
+        data = b"".join(encode_blocks(iter_blocks(f, head), self.codec))
+        return self._stored_value(data)
+
+    def _stored_value(self, data):
+        data = base64.b64encode(data).decode("ascii")
+        return "{}{}:{}".format(STORED_PREFIX, self.codec, data)
+
+
+class LocalObjectStore(object):
+    """Object store backed by a local directory."""
+
+    scheme = "file"
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def put(self, key, data):
+        """Store ``data`` (bytes) under ``key`` and return its URL."""
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return "file://" + path
+
+    def put_file(self, key, f):
+        """Store the content of the binary file ``f`` under ``key``."""
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(f, out)
+        return "file://" + path
+
+    def owns(self, url):
+        """Return whether ``url`` is an object of this store."""
+        if not url.startswith("file://"):
+            return False
+        path = os.path.realpath(url[len("file://") :])
+        root = os.path.realpath(self.path)
+        return os.path.commonpath([root, path]) == root and path != root
+
+    def get(self, url):
+        """Return the data (bytes) stored at ``url``."""
+        with open(url[len("file://") :], "rb") as f:
+            return f.read()
+
+
+class S3ObjectStore(object):
+    """
+    Object store backed by an S3 bucket, using the credentials configured for
+    ``host`` in ``STORAGE``.
+    """
+
+    scheme = "s3"
+
+    def __init__(self, host, bucket, prefix=""):
+        self.host = host
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @staticmethod
+    def get_bucket(host, bucket):
+        return get_s3_conn(host).get_bucket(bucket)
+
+    def put(self, key, data):
+        key_name = self.prefix + key
+        bucket = self.get_bucket(self.host, self.bucket)
+        bucket.new_key(key_name).set_contents_from_string(data)
+        return "{}{}".format(self._url_prefix, key_name)
+
+    def put_file(self, key, f):
+        key_name = self.prefix + key
+        bucket = self.get_bucket(self.host, self.bucket)
+        bucket.new_key(key_name).set_contents_from_file(f)
+        return "{}{}".format(self._url_prefix, key_name)
+
+    @property
+    def _url_prefix(self):
+        return "s3://{}/{}/".format(self.host, self.bucket)
+
+    def owns(self, url):
+        return url.startswith(self._url_prefix + self.prefix)
+
+    def get(self, url):
+        key_name = url[len(self._url_prefix) :]
+        bucket = self.get_bucket(self.host, self.bucket)
+        return bucket.get_key(key_name).get_contents_as_string()
+
+
+class ObjectDocumentStore(DocumentStore):
+    """
+    Store documents in an object store, keeping only their URL in
+    ``TransactionDocument.doc``.
+    """
+
+    def __init__(self, object_store, codec=None):
+        if codec is not None and codec not in CODECS:
+            raise ValueError("Unknown document codec '{}'".format(codec))
+        self.object_store = object_store
+        self.codec = codec
+
+    def dump(self, doc, key):
+        if not doc:
+            return doc
+        data = doc.encode("utf-8")
+        if self.codec:
+            compress, _ = CODECS[self.codec]
+            data = compress(data)
+        url = self.object_store.put(key, data)
+        return self._stored_value(url)
+
+    def dump_file(self, f, key):
+        """
+        Put the document in ``f`` in the object store, compressing it one
+        block at a time into a spooled file.
+        """
+        head = f.read(READ_BLOCK_SIZE)
+        if not head:
+            return head
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as data:
+            for block in encode_blocks(iter_blocks(f, head), self.codec):
+                data.write(block)
+            data.seek(0)
+            url = self.object_store.put_file(key, data)
+        return self._stored_value(url)
+
+    def _stored_value(self, url):
+        return "{}object:{}:{}".format(STORED_PREFIX, self.codec or "", url)
+
+
+def load_document(value, object_store=None):
+    """
+    Return the document stored as ``value`` in ``TransactionDocument.doc`` by
+    any of the document stores. Object references are only followed into
+    ``object_store``: others are returned as they are.
+    """
+    if not value or not value.startswith(STORED_PREFIX):
+        return value
+    kind, _, data = value[len(STORED_PREFIX) :].partition(":")
+    if kind == "text":
+        return data
+    if kind == "object":
+        codec, _, url = data.partition(":")
+        if object_store is None or not object_store.owns(url):
+            logger.warning("Not loading document from '{}'".format(url))
+            return value
+        data = object_store.get(url)
+    else:
+        codec = kind
+        data = base64.b64decode(data)
+    if codec:
+        if codec not in CODECS:
+            raise InternalError("Unknown document codec '{}'".format(codec))
+        _, decompress = CODECS[codec]
+        data = decompress(data)
+    return data.decode("utf-8")
+
+
+class StoredDocument(TypeDecorator):
+    """Text column holding documents saved by ``document_store``."""
+
+    impl = Text
+    cache_ok = True
+
+    def __init__(self, document_store=None):
+        super(StoredDocument, self).__init__()
+        self.document_store = document_store or DocumentStore()
+
+    def process_result_value(self, value, dialect):
+        return self.document_store.load(value)
+
+
+def decode_stored_documents(model, document_store=None):
+    """
+    Make ``model.doc`` (e.g. ``TransactionDocument.doc``) return the
+    submitted documents rather than the values saved by ``document_store``.
+    This must be called before the model is first queried, as compiled
+    queries are cached, and only applies to this process (see the module
+    documentation).
+    """
+    column = model.__table__.c.doc
+    column.type = StoredDocument(document_store)
+
+
+def new_document_key(project_id, transaction_id):
+    """Return a unique object key for a document of a transaction."""
+    return "{}/{}/{}".format(project_id, transaction_id, uuid.uuid4())
+
+
+def document_store_from_config(config):
+    """
+    Return the document store described by ``config`` (the
+    ``DOCUMENT_STORE`` setting), e.g.::
+
+        {"backend": "gzip", "min_size": 1024}
+        {"backend": "local", "path": "/var/sheepdog/documents"}
+        {"backend": "s3", "host": "...", "bucket": "...", "prefix": "docs/"}
+
+    The object store backends take an optional ``codec`` to compress the
+    objects.
+    """
+    config = config or {}
+    backend = config.get("backend", "database")
+    if backend == "database":
+        return DocumentStore()
+    if backend in CODECS:
+        return CompressedDocumentStore(
+            backend, min_size=config.get("min_size", DEFAULT_MIN_COMPRESSED_SIZE)
+        )
+    if backend == "local":
+        object_store = LocalObjectStore(config["path"])
+    elif backend == "s3":
+        object_store = S3ObjectStore(
+            config["host"], config["bucket"], prefix=config.get("prefix", "")
+        )
+    else:
+        raise ValueError("Unknown document store backend '{}'".format(backend))
+    return ObjectDocumentStore(object_store, codec=config.get("codec"))
+
+
+def get_document_store():
+    """Return the document store of the current app (verbatim by default)."""
+    store = getattr(flask.current_app, "document_store", None)
+    return store or DocumentStore()
@@ -1,24 +1,191 @@
-from queue import Queue, Full
-from threading import Thread
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+import importlib
+import itertools
+import multiprocessing
+from queue import Full
+from threading import Condition, Lock, Thread
+import time
 
+import flask
 from cdislogging import get_logger
 
-from sheepdog.errors import InternalError
-from sheepdog.globals import ASYNC_MAX_Q_LEN, ERR_ASYNC_SCHEDULING
+from sheepdog import auth
+from sheepdog.errors import InternalError, TooManyRequestsError
+from sheepdog.globals import (
+    ASYNC_MAX_Q_LEN,
+    ASYNC_RETRY_AFTER,
+    ERR_ASYNC_PROJECT_SCHEDULING,
+    ERR_ASYNC_SCHEDULING,
+    TX_LOG_STATE_ERRORED,
+)
 
 
 logger = get_logger("submission.scheduling")
 
 
-def async_pool_consumer(task_queue):
+def async_pool_consumer(task_queue, pool=None):
     task = task_queue.get()
     while task:
+        if pool is not None:
+            pool.task_started(task)
         try:
             task.target(*task.args, **task.kwargs)
         except Exception as e:  # pylint: disable=broad-except
             logger.exception(e)
         finally:
+            if pool is not None:
+                pool.task_finished(task)
+            task_queue.task_done(task)
             task = task_queue.get()
+    task_queue.task_done(task)
+
+
+def async_process_consumer(task_queue, event_queue, initializer=None):
+    """
+    Run tasks in a worker process of an :class:`AsyncProcessPool`, reporting
+    when each one starts and finishes on ``event_queue``.
+    """
+    if initializer is not None:
+        initializer()
+    task = task_queue.get()
+    while task:
+        task.started = datetime.utcnow()
+        event_queue.put(("started", task.task_id, task.to_json()))
+        try:
+            task.target(*task.args, **task.kwargs)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception(e)
+        finally:
+            event_queue.put(("finished", task.task_id, None))
+            task = task_queue.get()
+
+
+def schedule_transaction(pool, transaction, function, *args):
+    """
+    Schedule ``function(*args)`` on ``pool`` to run ``transaction``, whose
+    TransactionLog was already created. If the pool rejects the task (e.g.
+    with a :class:`TooManyRequestsError`), the log is marked as errored
+    rather than left pending, and the error is raised.
+    """
+    try:
+        pool.schedule(function, *args)
+    except (InternalError, TooManyRequestsError):
+        transaction.set_transaction_log_state(TX_LOG_STATE_ERRORED)
+        raise
+
+
+def schedule_async_transaction(worker, transaction, *args, pool=None):
+    """
+    Schedule ``worker(transaction, *args)`` on ``pool``, by default the
+    durable transaction queue if the app has one, else the async pool.
+
+    If the pool runs tasks elsewhere, the transaction is sent as the
+    :class:`TransactionSpec` of :meth:`TransactionBase.to_spec` and rebuilt
+    by the worker.
+    """
+    app = flask.current_app
+    if pool is None:
+        pool = getattr(app, "async_transaction_queue", None) or app.async_pool
+    if not pool.pickles_tasks:
+        return schedule_transaction(pool, transaction, worker, transaction, *args)
+    spec = transaction.to_spec(worker, *args)
+    schedule_transaction(pool, transaction, run_transaction_spec, spec)
+
+
+def run_transaction_spec(spec):
+    """
+    Rebuild the transaction described by a :class:`TransactionSpec` and run
+    its worker. Meant to run in a worker process that has pushed an app
+    context (see :class:`AsyncProcessPool`). The outcome is recorded in the
+    TransactionLog by the worker, as for threaded async transactions.
+
+    The transaction runs in its own app context, as the user of the spec and
+    with the authorization decisions made when it was scheduled.
+    """
+    app = flask.current_app
+    with app.app_context():
+        auth.set_transaction_user(spec.user)
+        transaction = spec.transaction_cls(
+            logger=app.logger,
+            index_client=app.index_client,
+            db_driver=app.db,
+            flask_config=app.config,
+            authz_context=auth.AuthorizationContext.from_json(spec.authz),
+            **spec.transaction_kwargs
+        )
+        return spec.worker(transaction, *spec.args)
+
+
+class TransactionSpec(object):
+    """
+    Picklable description of a transaction to run in another process: the
+    transaction class and constructor arguments, the worker function to run
+    it with (both importable by name), the worker arguments, the user (see
+    :func:`sheepdog.auth.get_transaction_user`) and the authorization
+    decisions made for them (see
+    :meth:`sheepdog.auth.AuthorizationContext.to_json`). The user's token
+    is not part of the spec.
+    """
+
+    def __init__(self, transaction_cls, worker, args, user=None, authz=None, **kwargs):
+        self.transaction_cls = transaction_cls
+        self.worker = worker
+        self.args = tuple(args)
+        self.user = user
+        self.authz = authz or []
+        self.transaction_kwargs = kwargs
+
+    @property
+    def project_id(self):
+        return "{}-{}".format(
+            self.transaction_kwargs.get("program"),
+            self.transaction_kwargs.get("project"),
+        )
+
+    def to_json(self):
+        """
+        Return a JSON representation, e.g. to persist the spec in a queue
+        table. The worker arguments and constructor arguments must be JSON
+        serializable.
+        """
+        return {
+            "transaction_cls": _import_path(self.transaction_cls),
+            "worker": _import_path(self.worker),
+            "args": list(self.args),
+            "user": self.user,
+            "authz": self.authz,
+            "transaction_kwargs": self.transaction_kwargs,
+        }
+
+    @classmethod
+    def from_json(cls, doc):
+        return cls(
+            _resolve_import_path(doc["transaction_cls"]),
+            _resolve_import_path(doc["worker"]),
+            doc["args"],
+            user=doc["user"],
+            authz=doc["authz"],
+            **doc["transaction_kwargs"]
+        )
+
+
+def _import_path(obj):
+    return "{}:{}".format(obj.__module__, obj.__qualname__)
+
+
+def _resolve_import_path(path):
+    """
+    Return the object named by ``module:qualname``. Only sheepdog objects are
+    resolved, so a stored spec can't be used to run arbitrary code.
+    """
+    module_name, _, name = path.partition(":")
+    if module_name != "sheepdog" and not module_name.startswith("sheepdog."):
+        raise ValueError("Refusing to resolve {}".format(path))
+    obj = importlib.import_module(module_name)
+    for attr in name.split("."):
+        obj = getattr(obj, attr)
+    return obj
 
 
 class AsyncPoolTask(object):
@@ -34,38 +201,395 @@ class AsyncPoolTask(object):
         self.target = target
         self.args = args
         self.kwargs = kwargs
+        self.started = None
+        self.task_id = None
+
+    @property
+    def transaction_id(self):
+        """
+        Return the id of the transaction this task works on, if any: all
+        transaction workers take the transaction as first argument.
+        """
+        if not self.args:
+            return None
+        return getattr(self.args[0], "transaction_id", None)
+
+    @property
+    def project_id(self):
+        """
+        Return the project of the transaction (or :class:`TransactionSpec`)
+        this task works on, if any.
+        """
+        if not self.args:
+            return None
+        return getattr(self.args[0], "project_id", None)
+
+    def to_json(self):
+        name = getattr(self.target, "__wrapped__", self.target)
+        return {
+            "function": getattr(name, "__name__", str(name)),
+            "transaction_id": self.transaction_id,
+            "project_id": self.project_id,
+            "started": self.started.isoformat("T") if self.started else None,
+        }
+
+
+class ProjectQueueFull(Full):
+    """Raised when a single project has too many queued tasks."""
+
+    def __init__(self, project_id):
+        super(ProjectQueueFull, self).__init__(project_id)
+        self.project_id = project_id
+
+
+class FairTaskQueue(object):
+    """
+    Task queue for :class:`AsyncPool` with one FIFO sub-queue per project.
+
+    Projects take turns (round-robin) when workers get tasks, and at most
+    ``project_concurrency`` tasks of a project run at once, so a project
+    submitting many transactions can't starve the others. A ``None`` task
+    (asking a worker to exit) is only handed out once no queued task can run.
+
+    Args:
+        maxsize (int): maximum number of queued tasks, 0 for no limit
+        project_maxsize (int): maximum number of queued tasks per project, 0
+            for no limit
+        project_concurrency (int): maximum number of running tasks per
+            project, 0 for no limit
+    """
+
+    def __init__(self, maxsize=0, project_maxsize=0, project_concurrency=0):
+        self.maxsize = maxsize
+        self.project_maxsize = project_maxsize
+        self.project_concurrency = project_concurrency
+        #: Queued tasks by project, in round-robin order
+        self.queues = OrderedDict()
+        #: Number of running tasks by project
+        self.running = Counter()
+        self.unfinished_tasks = 0
+        self._size = 0
+        self._exit_requests = 0
+        self._condition = Condition()
+
+    def qsize(self):
+        with self._condition:
+            return self._size
+
+    def put_nowait(self, task):
+        """
+        Queue a task.
+
+        Raises:
+            ProjectQueueFull: if the task's project has too many queued tasks
+            queue.Full: if the queue is full
+        """
+        with self._condition:
+            if task is None:
+                self._exit_requests += 1
+                self.unfinished_tasks += 1
+                self._condition.notify()
+                return
+            if self.maxsize and self._size >= self.maxsize:
+                raise Full
+            project_queue = self.queues.setdefault(task.project_id, deque())
+            if self.project_maxsize and len(project_queue) >= self.project_maxsize:
+                raise ProjectQueueFull(task.project_id)
+            project_queue.append(task)
+            self._size += 1
+            self.unfinished_tasks += 1
+            self._condition.notify()
+
+    def put(self, task):
+        self.put_nowait(task)
+
+    def get(self):
+        """Wait for the next task a worker may run (or ``None``) and return it."""
+        with self._condition:
+            while True:
+                task = self._next_task()
+                if task is not None:
+                    return task
+                if self._exit_requests:
+                    self._exit_requests -= 1
+                    return None
+                self._condition.wait()
+
+    def _next_task(self):
+        for project_id, project_queue in self.queues.items():
+            if self.project_concurrency and (
+                self.running[project_id] >= self.project_concurrency
+            ):
+                continue
+            task = project_queue.popleft()
+            if project_queue:
+                self.queues.move_to_end(project_id)
+            else:
+                del self.queues[project_id]
+            self._size -= 1
+            self.running[project_id] += 1
+            return task
+        return None
+
+    def task_done(self, task=None):
+        """Mark a task returned by :meth:`get` as finished."""
+        with self._condition:
+            self.unfinished_tasks -= 1
+            if task is not None:
+                self.running[task.project_id] -= 1
+                if not self.running[task.project_id]:
+                    del self.running[task.project_id]
+                # A task of this project may be able to run now
+                self._condition.notify_all()
+
+    def status(self):
+        """Return the number of queued and running tasks by project."""
+        with self._condition:
+            projects = set(self.queues) | set(self.running)
+            return {
+                str(project_id): {
+                    "queued": len(self.queues.get(project_id, ())),
+                    "running": self.running.get(project_id, 0),
+                }
+                for project_id in projects
+            }
 
 
 class AsyncPool(object):
-    """Creates a pool of workers that allows async scheduling."""
+    """
+    Creates a pool of workers that allows async scheduling.
+
+    Tasks are scheduled fairly between projects (see :class:`FairTaskQueue`).
+    When the queue, or the project's share of it, is full,
+    :meth:`schedule` raises a :class:`TooManyRequestsError` asking the client
+    to retry after ``retry_after`` seconds.
+    """
 
-    def __init__(self, worker_class=Thread, max_queue_len=ASYNC_MAX_Q_LEN):
+    #: Scheduled tasks are run in this process and need not be picklable
+    pickles_tasks = False
+
+    def __init__(
+        self,
+        worker_class=Thread,
+        max_queue_len=ASYNC_MAX_Q_LEN,
+        max_project_queue_len=0,
+        project_concurrency=0,
+        retry_after=ASYNC_RETRY_AFTER,
+    ):
         self.worker_class = worker_class
-        self.task_queue = Queue(max_queue_len)
+        self.max_queue_len = max_queue_len
+        self.retry_after = retry_after
+        self.task_queue = FairTaskQueue(
+            max_queue_len,
+            project_maxsize=max_project_queue_len,
+            project_concurrency=project_concurrency,
+        )
         self.workers = []
+        #: Tasks currently being run by a worker
+        self.in_flight = []
+        self._in_flight_lock = Lock()
+        #: Set once the pool is draining and no longer accepts tasks
+        self.closed = False
 
     def start(self, n_workers):
         """Send a NoneType to all workers requesting exit."""
         self.grow(n_workers)
 
     def schedule(self, function, *args, **kwargs):
-        """Add a task to the queue"""
+        """
+        Add a task to the queue.
+
+        When called while handling a request, the task runs in a copy of the
+        request context, as transactions read the current user and app from
+        it.
+        """
+        if self.closed:
+            raise InternalError(ERR_ASYNC_SCHEDULING)
+        if flask.has_request_context():
+            function = flask.copy_current_request_context(function)
         try:
             self.task_queue.put_nowait(AsyncPoolTask(function, *args, **kwargs))
+        except ProjectQueueFull as e:
+            raise TooManyRequestsError(
+                ERR_ASYNC_PROJECT_SCHEDULING.format(e.project_id),
+                retry_after=self.retry_after,
+            )
         except Full:
-            raise InternalError(ERR_ASYNC_SCHEDULING)
+            raise TooManyRequestsError(
+                ERR_ASYNC_SCHEDULING, retry_after=self.retry_after
+            )
 
     def close(self):
         """Send a NoneType to all workers requesting exit"""
         self.shrink(len(self.workers))
 
+    def drain(self, timeout=None):
+        """
+        Stop accepting tasks, wait up to ``timeout`` seconds for the queued
+        and running tasks to finish, then ask the workers to exit.
+
+        Return:
+            bool: whether all tasks finished in time
+        """
+        self.closed = True
+        deadline = None if timeout is None else time.time() + timeout
+        while self.task_queue.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                logger.warning(
+                    "Async pool drain timed out with %s unfinished tasks",
+                    self.task_queue.unfinished_tasks,
+                )
+                return False
+            time.sleep(0.1)
+        self.close()
+        return True
+
     def grow(self, n_workers):
         """
         Add and start workers to the scheduling pool. Note: workers are
         started immediately.
         """
         workers = [
-            self.worker_class(target=async_pool_consumer, args=(self.task_queue,))
+            self.worker_class(target=async_pool_consumer, args=(self.task_queue, self))
+            for _ in range(n_workers)
+        ]
+
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        self.workers.extend(workers)
+
+    def shrink(self, n_workers):
+        """Send a NoneType to `n_workers` workers requesting exit."""
+        for worker in range(n_workers):
+            self.task_queue.put(None)
+
+    def join(self):
+        """Wait for all workers to finish"""
+        for worker in self.workers:
+            worker.join()
+
+    def task_started(self, task):
+        task.started = datetime.utcnow()
+        with self._in_flight_lock:
+            self.in_flight.append(task)
+
+    def task_finished(self, task):
+        with self._in_flight_lock:
+            self.in_flight.remove(task)
+
+    def status(self):
+        """Return the queue depth and the tasks in flight."""
+        with self._in_flight_lock:
+            in_flight = [task.to_json() for task in self.in_flight]
+        return {
+            "accepting_tasks": not self.closed,
+            "workers": len([w for w in self.workers if w.is_alive()]),
+            "queue_length": self.task_queue.qsize(),
+            "max_queue_length": self.max_queue_len,
+            "in_flight_count": len(in_flight),
+            "in_flight": in_flight,
+            "projects": self.task_queue.status(),
+        }
+
+
+class AsyncProcessPool(object):
+    """
+    Creates a pool of worker processes that allows async scheduling of CPU
+    bound tasks without contending for the GIL with request threads.
+
+    Tasks are pickled to reach the workers, so the scheduled function must be
+    importable by name and its arguments picklable: schedule
+    :func:`run_transaction_spec` with a :class:`TransactionSpec` rather than a
+    transaction worker with a live transaction.
+
+    Workers are forked, and ``initializer`` runs in each worker before it
+    takes tasks, e.g. to replace connections inherited from the parent.
+    """
+
+    #: Scheduled tasks must be picklable
+    pickles_tasks = True
+
+    def __init__(
+        self,
+        max_queue_len=ASYNC_MAX_Q_LEN,
+        initializer=None,
+        start_method="fork",
+        retry_after=ASYNC_RETRY_AFTER,
+    ):
+        self.context = multiprocessing.get_context(start_method)
+        self.max_queue_len = max_queue_len
+        self.retry_after = retry_after
+        self.task_queue = self.context.Queue(max_queue_len)
+        self.event_queue = self.context.Queue()
+        self.initializer = initializer
+        self.workers = []
+        #: Tasks currently being run by a worker, by task id
+        self.in_flight = {}
+        self.unfinished_tasks = 0
+        self._lock = Lock()
+        self._task_ids = itertools.count()
+        self._monitor = None
+        self.closed = False
+
+    def start(self, n_workers):
+        """Start ``n_workers`` worker processes."""
+        self.grow(n_workers)
+        if self._monitor is None:
+            self._monitor = Thread(target=self._watch_events)
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def schedule(self, function, *args, **kwargs):
+        """Add a task to the queue"""
+        if self.closed:
+            raise InternalError(ERR_ASYNC_SCHEDULING)
+        task = AsyncPoolTask(function, *args, **kwargs)
+        task.task_id = next(self._task_ids)
+        with self._lock:
+            self.unfinished_tasks += 1
+        try:
+            self.task_queue.put_nowait(task)
+        except Full:
+            with self._lock:
+                self.unfinished_tasks -= 1
+            raise TooManyRequestsError(
+                ERR_ASYNC_SCHEDULING, retry_after=self.retry_after
+            )
+
+    def close(self):
+        """Send a NoneType to all workers requesting exit"""
+        self.shrink(len(self.workers))
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting tasks, wait up to ``timeout`` seconds for the queued
+        and running tasks to finish, then ask the workers to exit.
+
+        Return:
+            bool: whether all tasks finished in time
+        """
+        self.closed = True
+        deadline = None if timeout is None else time.time() + timeout
+        while self.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                logger.warning(
+                    "Async process pool drain timed out with %s unfinished tasks",
+                    self.unfinished_tasks,
+                )
+                return False
+            time.sleep(0.1)
+        self.close()
+        return True
+
+    def grow(self, n_workers):
+        """Add and start worker processes."""
+        workers = [
+            self.context.Process(
+                target=async_process_consumer,
+                args=(self.task_queue, self.event_queue, self.initializer),
+            )
             for _ in range(n_workers)
         ]
 
@@ -84,3 +608,28 @@ class AsyncPool(object):
         """Wait for all workers to finish"""
         for worker in self.workers:
             worker.join()
+
+    def _watch_events(self):
+        """Keep track of the tasks the workers start and finish."""
+        while True:
+            event, task_id, task_json = self.event_queue.get()
+            with self._lock:
+                if event == "started":
+                    self.in_flight[task_id] = task_json
+                else:
+                    self.in_flight.pop(task_id, None)
+                    self.unfinished_tasks -= 1
+
+    def status(self):
+        """Return the queue depth and the tasks in flight."""
+        with self._lock:
+            in_flight = list(self.in_flight.values())
+            unfinished_tasks = self.unfinished_tasks
+        return {
+            "accepting_tasks": not self.closed,
+            "workers": len([w for w in self.workers if w.is_alive()]),
+            "queue_length": max(unfinished_tasks - len(in_flight), 0),
+            "max_queue_length": self.max_queue_len,
+            "in_flight_count": len(in_flight),
+            "in_flight": in_flight,
+        }
@@ -0,0 +1,71 @@
+"""
+Streamed JSON responses, for transaction responses too large to build as one
+dict and serialize in one block.
+
+A response document may hold generators (e.g. of entity responses):
+:func:`spool_json` serializes it piece by piece to a spooled file, while the
+transaction's session is still open, and :func:`spooled_json_response` sends
+the file in blocks.
+"""
+
+import json
+import tempfile
+import types
+
+import flask
+
+
+#: Size of the blocks a spooled response is sent in
+RESPONSE_BLOCK_SIZE = 64 * 1024
+#: Spooled responses larger than this are written to disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+def _is_streamed(value):
+    return isinstance(value, types.GeneratorType) or (
+        isinstance(value, dict) and any(_is_streamed(v) for v in value.values())
+    )
+
+
+def iter_json(value):
+    """
+    Yield the JSON serialization of ``value`` in pieces. Generators are
+    serialized as arrays, one item at a time.
+    """
+    if isinstance(value, types.GeneratorType):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from iter_json(item)
+        yield "]"
+    elif isinstance(value, dict) and _is_streamed(value):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield "{}{}: ".format(", " if i else "", json.dumps(str(key)))
+            yield from iter_json(item)
+        yield "}"
+    else:
+        yield json.dumps(value)
+
+
+def spool_json(doc):
+    """Serialize ``doc`` to a spooled temporary file, rewound for reading."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+")
+    for piece in iter_json(doc):
+        spool.write(piece)
+    spool.seek(0)
+    return spool
+
+
+def spooled_json_response(spool, code):
+    """Return a response streaming the JSON in ``spool``, then closing it."""
+
+    def blocks():
+        with spool:
+            block = spool.read(RESPONSE_BLOCK_SIZE)
+            while block:
+                yield block
+                block = spool.read(RESPONSE_BLOCK_SIZE)
+
+    return flask.Response(blocks(), status=code, mimetype="application/json")
@@ -0,0 +1,361 @@
+"""
+Durable queue of async transactions, stored in the database.
+
+Transactions scheduled on a :class:`DatabaseTransactionQueue` are persisted
+in the ``async_transaction_queue`` table and claimed with ``SELECT ... FOR
+UPDATE SKIP LOCKED``, so any sheepdog worker on any node can process them,
+and a transaction survives the restart of the worker that accepted it.
+
+The table is created by :func:`migrate_transaction_queue`, on the
+``AUTO_MIGRATE_DATABASE`` path (see ``sheepdog.api.migrate_database``).
+"""
+
+from datetime import datetime, timedelta
+import os
+import socket
+from threading import Event, Lock, Thread
+import time
+import zlib
+
+from cdislogging import get_logger
+from sqlalchemy import Column, DateTime, Index, Integer, Text, and_, or_, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.declarative import declarative_base
+import pytz
+
+from sheepdog import models
+from sheepdog.errors import InternalError
+from sheepdog.globals import (
+    ERR_ASYNC_SCHEDULING,
+    TX_LOG_STATE_ERRORED,
+    TX_LOG_STATE_PENDING,
+)
+from sheepdog.utils.scheduling import TransactionSpec, run_transaction_spec
+
+
+logger = get_logger("submission.transaction_queue")
+
+Base = declarative_base()
+
+QUEUE_STATE_QUEUED = "QUEUED"
+QUEUE_STATE_RUNNING = "RUNNING"
+
+#: Key of the advisory lock taken while creating the queue table
+MIGRATION_LOCK_KEY = zlib.crc32(b"async_transaction_queue")
+
+
+class QueuedTransaction(Base):
+    __tablename__ = "async_transaction_queue"
+
+    def __repr__(self):
+        return "<QueuedTransaction({}, {})>".format(self.id, self.transaction_id)
+
+    id = Column(
+        Integer,
+        primary_key=True,
+    )
+
+    #: TransactionLog id of the queued transaction
+    transaction_id = Column(
+        Integer,
+        nullable=False,
+        index=True,
+    )
+
+    project_id = Column(
+        Text,
+        nullable=False,
+    )
+
+    state = Column(
+        Text,
+        nullable=False,
+        default=QUEUE_STATE_QUEUED,
+    )
+
+    #: JSON representation of the TransactionSpec to run (which holds no
+    #: credentials, see TransactionSpec)
+    spec = Column(
+        JSONB,
+        nullable=False,
+    )
+
+    #: Number of times the transaction was claimed
+    attempts = Column(
+        Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_datetime = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=text("now()"),
+    )
+
+    #: When the transaction was claimed, or its lease last renewed
+    claimed_datetime = Column(
+        DateTime(timezone=True),
+    )
+
+    #: host:pid of the worker that claimed the transaction
+    claimed_by = Column(
+        Text,
+    )
+
+    __table_args__ = (Index("async_transaction_queue_state_idx", "state", "id"),)
+
+
+def migrate_transaction_queue(db_driver):
+    """
+    Create the queue table if it doesn't exist. Workers migrating at the same
+    time take turns on an advisory lock.
+    """
+    with db_driver.engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+        QueuedTransaction.__table__.create(connection, checkfirst=True)
+
+
+class DatabaseTransactionQueue(object):
+    """
+    Pool of worker threads that run the transactions of a durable queue
+    table. It has the same interface as
+    :class:`sheepdog.utils.scheduling.AsyncPool`, but only accepts
+    :func:`run_transaction_spec` tasks with a JSON serializable
+    :class:`TransactionSpec`.
+
+    A claimed transaction is leased for ``lease_seconds``, and the lease is
+    renewed every third of that while the transaction runs: if the worker
+    running it dies, another worker claims it once the lease expired. A
+    transaction whose TransactionLog is no longer pending was already run and
+    is only removed from the queue; one claimed more than ``max_attempts``
+    times is given up on, removed from the queue and its TransactionLog
+    marked as errored.
+    """
+
+    pickles_tasks = True
+
+    def __init__(self, app, poll_interval=1, lease_seconds=300, max_attempts=3):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_name = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.workers = []
+        self._heartbeat = None
+        #: Transaction ids currently being run by this process' workers
+        self.in_flight = {}
+        self._in_flight_lock = Lock()
+        self._stopping = Event()
+        self.closed = False
+
+    @property
+    def db_driver(self):
+        return self.app.db
+
+    def start(self, n_workers):
+        """
+        Start ``n_workers`` threads, and one renewing the leases of their
+        transactions.
+        """
+        workers = [Thread(target=self._consume) for _ in range(n_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        self.workers.extend(workers)
+        if self._heartbeat is None:
+            self._heartbeat = Thread(target=self._renew_leases_periodically)
+            self._heartbeat.daemon = True
+            self._heartbeat.start()
+
+    def schedule(self, function, spec):
+        """Persist a transaction spec in the queue."""
+        if function is not run_transaction_spec or not isinstance(
+            spec, TransactionSpec
+        ):
+            raise ValueError("Only transaction specs can be queued")
+        if self.closed:
+            raise InternalError(ERR_ASYNC_SCHEDULING)
+        kwargs = spec.transaction_kwargs
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            session.add(
+                QueuedTransaction(
+                    transaction_id=kwargs["transaction_id"],
+                    project_id="{}-{}".format(kwargs["program"], kwargs["project"]),
+                    state=QUEUE_STATE_QUEUED,
+                    spec=spec.to_json(),
+                    attempts=0,
+                )
+            )
+
+    def claim(self):
+        """
+        Claim the oldest queued transaction (or one whose lease expired)
+        without waiting on rows locked by other workers.
+
+        Return:
+            Optional[Tuple[int, int, dict, int]]: queue id, transaction id,
+            spec and attempts of the claimed transaction
+        """
+        now = datetime.now(pytz.utc)
+        expired = now - timedelta(seconds=self.lease_seconds)
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            queued = (
+                session.query(QueuedTransaction)
+                .filter(
+                    or_(
+                        QueuedTransaction.state == QUEUE_STATE_QUEUED,
+                        and_(
+                            QueuedTransaction.state == QUEUE_STATE_RUNNING,
+                            QueuedTransaction.claimed_datetime < expired,
+                        ),
+                    )
+                )
+                .order_by(QueuedTransaction.id)
+                .with_for_update(skip_locked=True)
+                .limit(1)
+                .first()
+            )
+            if queued is None:
+                return None
+            queued.state = QUEUE_STATE_RUNNING
+            queued.attempts += 1
+            queued.claimed_datetime = now
+            queued.claimed_by = self.worker_name
+            return queued.id, queued.transaction_id, queued.spec, queued.attempts
+
+    def run(self, queue_id, transaction_id, spec, attempts):
+        """Run a claimed transaction and remove it from the queue."""
+        if not self._is_pending(transaction_id):
+            # A previous worker got as far as finishing the transaction
+            return self._delete(queue_id)
+        if attempts > self.max_attempts:
+            logger.error(
+                "Giving up on transaction %s after %s attempts",
+                transaction_id,
+                attempts - 1,
+            )
+            return self._fail(queue_id, transaction_id)
+
+        with self._in_flight_lock:
+            self.in_flight[queue_id] = {
+                "transaction_id": transaction_id,
+                "attempts": attempts,
+                "started": datetime.utcnow().isoformat("T"),
+            }
+        try:
+            with self.app.app_context():
+                run_transaction_spec(TransactionSpec.from_json(spec))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception(e)
+            self._fail(queue_id, transaction_id)
+        else:
+            self._delete(queue_id)
+        finally:
+            with self._in_flight_lock:
+                self.in_flight.pop(queue_id, None)
+
+    def renew_leases(self):
+        """Renew the leases of the transactions this process is running."""
+        with self._in_flight_lock:
+            queue_ids = list(self.in_flight)
+        if not queue_ids:
+            return
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            session.query(QueuedTransaction).filter(
+                QueuedTransaction.id.in_(queue_ids),
+                QueuedTransaction.claimed_by == self.worker_name,
+            ).update(
+                {"claimed_datetime": datetime.now(pytz.utc)},
+                synchronize_session=False,
+            )
+
+    def _renew_leases_periodically(self):
+        # keeps going while draining, until the workers are done
+        while any(worker.is_alive() for worker in self.workers):
+            time.sleep(self.lease_seconds / 3.0)
+            try:
+                self.renew_leases()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception(e)
+
+    def _consume(self):
+        while not self._stopping.is_set():
+            try:
+                claimed = self.claim()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception(e)
+                claimed = None
+            if claimed is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+            self.run(*claimed)
+
+    def _is_pending(self, transaction_id):
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            tx_log = session.query(models.submission.TransactionLog).get(transaction_id)
+            return tx_log is not None and tx_log.state == TX_LOG_STATE_PENDING
+
+    def _delete(self, queue_id):
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            session.query(QueuedTransaction).filter(
+                QueuedTransaction.id == queue_id
+            ).delete()
+
+    def _fail(self, queue_id, transaction_id):
+        """
+        Remove a transaction from the queue and mark its TransactionLog as
+        errored, where the failure is recorded.
+        """
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            session.query(QueuedTransaction).filter(
+                QueuedTransaction.id == queue_id
+            ).delete()
+            tx_log = session.query(models.submission.TransactionLog).get(transaction_id)
+            if tx_log is not None and tx_log.state == TX_LOG_STATE_PENDING:
+                tx_log.state = TX_LOG_STATE_ERRORED
+
+    def close(self):
+        """Stop claiming transactions."""
+        self.closed = True
+        self._stopping.set()
+
+    def drain(self, timeout=None):
+        """
+        Stop claiming transactions and wait up to ``timeout`` seconds for the
+        running ones to finish. Queued transactions stay in the table for
+        other workers.
+
+        Return:
+            bool: whether the running transactions finished in time
+        """
+        self.close()
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time.time(), 0))
+        return not any(worker.is_alive() for worker in self.workers)
+
+    def join(self):
+        """Wait for all workers to finish"""
+        for worker in self.workers:
+            worker.join()
+
+    def status(self):
+        """Return the queue depth and the transactions in flight."""
+        with self.db_driver.session_scope(can_inherit=False) as session:
+            queue_length = (
+                session.query(QueuedTransaction)
+                .filter(QueuedTransaction.state == QUEUE_STATE_QUEUED)
+                .count()
+            )
+        with self._in_flight_lock:
+            in_flight = list(self.in_flight.values())
+        return {
+            "accepting_tasks": not self.closed,
+            "workers": len([w for w in self.workers if w.is_alive()]),
+            "queue_length": queue_length,
+            "in_flight_count": len(in_flight),
+            "in_flight": in_flight,
+        }
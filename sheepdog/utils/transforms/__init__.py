@@ -14,7 +14,7 @@ from sheepdog.utils.transforms.bcr_xml_to_json import (
     BcrXmlToJsonParser,
     BcrClinicalXmlToJsonParser,
 )
-from sheepdog.globals import SUB_DELIMITERS
+from sheepdog.globals import DELIMITED_CHUNK_SIZE, SUB_DELIMITERS
 
 
 def parse_bool_from_string(value):
@@ -47,6 +47,8 @@ def parse_list_from_string(value, list_item_type=None):
         items = [list_item_type(item) for item in items]
     elif list_item_type == bool:
         items = [e.lower() in ["true", "t", "yes", "y"] for e in items]
+    elif list_item_type == str:
+        pass
     else:
         current_app.logger.warning(
             f"'parse_list_from_string' does not know how to handle type '{list_item_type}' so assuming string is fine... Value is '{value}'"
@@ -87,6 +89,44 @@ def strip(text):
         return text.strip()
 
 
+def iter_normalized_lines(stream, encoding="utf-8"):
+    """
+    Lazily yield the lines of ``stream`` the way the delimited converters see
+    a whole document after ``"\n".join(strip(doc).splitlines())``: newlines
+    are normalized to ``\n``, and whitespace at the start and end of the
+    document is dropped.
+
+    Args:
+        stream: binary or text file-like object, e.g. ``flask.request.stream``
+        encoding (str): encoding of a binary ``stream``
+
+    Return:
+        Iterator[str]: lines ending in ``\n`` (except for the last one)
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding=encoding, newline=None)
+
+    # Whitespace-only lines are held back until we know whether they are
+    # trailing whitespace of the document.
+    started, pending, previous = False, [], None
+    for line in stream:
+        line = line.rstrip("\n")
+        if not started:
+            if not line.strip():
+                continue
+            started, line = True, line.lstrip()
+        if not line.strip():
+            pending.append(line)
+            continue
+        if previous is not None:
+            yield previous + "\n"
+        for blank in pending:
+            yield blank + "\n"
+        pending, previous = [], line
+    if previous is not None:
+        yield previous.rstrip()
+
+
 def strip_whitespace_from_str_dict(dictionary):
     """
     Return new dict with leading/trailing whitespace removed from keys and
@@ -115,6 +155,8 @@ class DelimitedConverter(object):
         self.format = ""
         self.errors = []
         self.docs = []
+        #: Conversion plans by (node class, header), see get_row_plan()
+        self._row_plans = {}
 
     def set_reader(self, _):
         """
@@ -137,6 +179,44 @@ class DelimitedConverter(object):
             raise UserError(f"Unable to parse document: {e}")
         return self.docs, self.errors
 
+    def set_stream_reader(self, stream, copy_to=None):
+        """
+        Implement this in a subclass to set self.reader to be an iterable of
+        rows read incrementally from a file-like ``stream``.
+        """
+        msg = "set_stream_reader not implemented for {}".format(type(self))
+        raise NotImplementedError(msg)
+
+    def convert_stream(self, stream, chunk_size=DELIMITED_CHUNK_SIZE, copy_to=None):
+        """
+        Read a document incrementally from ``stream`` and yield its canonical
+        JSON entities in lists of at most ``chunk_size``, so only one chunk of
+        converted rows is held by the converter at a time.
+
+        Args:
+            stream: binary or text file-like object
+            chunk_size (int): maximum number of entities per chunk
+            copy_to: optional text file-like object that receives the
+                normalized document as it is read
+
+        Return:
+            Iterator[list]: chunks of entity docs; errors are gathered in
+            ``self.errors``
+        """
+        try:
+            self.set_stream_reader(stream, copy_to=copy_to)
+            for row in self.reader:
+                self.add_row(row)
+                if len(self.docs) >= chunk_size:
+                    chunk, self.docs = self.docs, []
+                    yield chunk
+        except Exception as e:
+            current_app.logger.exception(e)
+            raise UserError(f"Unable to parse document: {e}")
+        if self.docs:
+            chunk, self.docs = self.docs, []
+            yield chunk
+
     @staticmethod
     def get_unknown_cls_dict(row):
         """
@@ -171,54 +251,98 @@ class DelimitedConverter(object):
         if cls is None:
             return
 
+        prop_plan, link_plan = self.get_row_plan(cls, tuple(row))
+
         # Add properties
-        props_dict = get_props_from_row(row)
-        for key, value in props_dict.items():
+        for key, convert in prop_plan:
+            value = row[key]
             # Translating a tsv null value (empty string) to None so the dictionary can remove that key's value
             if value == "":
                 doc[key] = None
             elif value == "null":
                 doc[key] = None
-            else:
-                converted = self.convert_type(cls, key, value)
+            elif value is not None:
+                converted = convert(value)
                 if converted is not None:
                     doc[key] = converted
 
         # Add links
-        links_dict = get_links_from_row(row)
-        for key, value in links_dict.items():
-            self.add_link_value(links, cls, key, value)
+        for key, link in link_plan:
+            self.add_link_value(links, key, link, row[key])
         doc.update(links)
         self.docs.append(doc)
 
-    def add_link_value(self, links, cls, key, value):
-        key_parts = key.split(".")
-        if len(key_parts) == 0:
-            return
+    def get_row_plan(self, cls, keys):
+        """
+        Return the conversion plan for rows of type ``cls`` with the columns
+        ``keys``, compiling it the first time this header is seen for ``cls``.
+
+        The plan is a tuple ``(prop_plan, link_plan)``: ``prop_plan`` lists
+        ``(key, converter)`` for property columns and ``link_plan`` lists
+        ``(key, link)`` for link columns, where ``link`` is the result of
+        :meth:`compile_link`.
+        """
+        plan = self._row_plans.get((cls, keys))
+        if plan is None:
+            prop_plan, link_plan = [], []
+            for key in keys:
+                if "." in key:
+                    link_plan.append((key, self.compile_link(cls, key)))
+                else:
+                    prop_plan.append((key, self.compile_type_converter(cls, key)))
+            plan = self._row_plans[(cls, keys)] = (prop_plan, link_plan)
+        return plan
+
+    @staticmethod
+    def compile_link(cls, key):
+        """
+        Parse a link column ``key`` (e.g. ``cases.submitter_id``) of type
+        ``cls``.
 
+        Return:
+            tuple: ``(link_name, prop, converter)``, or ``(None, error, None)``
+            if the column name is invalid
+        """
+        key_parts = key.split(".")
         link_name = key_parts[0]
         if not link_name:
-            error = "Invalid link name: {}".format(key)
-            return self.record_error(error, columns=[key])
+            return None, "Invalid link name: {}".format(key), None
         prop = ".".join(key_parts[1:])
         if not prop:
-            error = "Invalid link property name: {}".format(key)
-            return self.record_error(error, columns=[key])
+            return None, "Invalid link property name: {}".format(key), None
+
+        try:
+            edge = getattr(cls, link_name)
+            dst_cls = Node.get_subclass_named(edge.target_class.__dst_class__)
+            convert = DelimitedConverter.compile_type_converter(dst_cls, prop)
+        except Exception as exception:  # pylint: disable=broad-except
+            # Only fail if the column actually has values, as before
+            def convert(_, exception=exception):
+                raise exception
+
+        return link_name, prop, convert
+
+    def add_link_value(self, links, key, link, value):
+        link_name, prop, convert = link
+        if link_name is None:
+            return self.record_error(prop, columns=[key])
 
         if link_name not in links:
             links[link_name] = []
 
-        l_values = self.value_to_list_value(cls, link_name, prop, value)
+        l_values = self.value_to_list_value(convert, prop, value)
         if l_values is not None:
             links[link_name].extend(l_values)
 
-    def value_to_list_value(self, cls, link_name, prop, value):
+    def value_to_list_value(self, convert, prop, value):
         if value is None:
             return value
         l_values = value.split(SUB_DELIMITERS.get(self.format))
         r_values = []
         for v in l_values:
-            converted_value = self.convert_link_value(cls, link_name, prop, v)
+            if v in ["", "null"]:
+                continue
+            converted_value = convert(strip(v))
             # only add the prop if there is a link - for example,
             # TSV submissions may include empty link columns
             if converted_value:
@@ -226,42 +350,65 @@ class DelimitedConverter(object):
         return r_values
 
     @staticmethod
-    def get_converted_type_from_list(cls, prop_name, value):
+    def compile_type_converter(cls, prop_name):
+        """
+        Return a function that casts a value of property ``prop_name`` of
+        ``cls`` to its type. Looking the type up once per column, rather than
+        per cell, keeps the per-row work to calling the returned function.
+        """
         types = cls.__pg_properties__.get(prop_name, (str,))
         value_type = types[0]
-        try:
-            if value_type == bool:
-                return parse_bool_from_string(value)
-            elif value_type == list:
-                # Parse the item type from the dictionary schema.
-                # NOTE: `cls.__pg_properties__.get(prop_name)` would be easier but the value is
-                # only `list` and does not include the item type.
-                # https://github.com/uc-cdis/gen3datamodel/blob/190f998/gdcdatamodel/models/__init__.py#L120
-                # Setting this ^ to `list[<item type>]` may work but it breaks other code.
-                list_item_type = (
-                    dictionary.schema.get(cls.label, {})
-                    .get("properties", {})
-                    .get(prop_name, {})
-                    .get("items", {})
-                    .get("type")
-                )
-                list_item_type = jsonschema_to_python_type(list_item_type)
-                current_app.logger.debug(
-                    f"get_converted_type_from_list: {cls.label}.{prop_name} items type is {list_item_type}"
-                )
+        if value_type == bool:
+            convert = parse_bool_from_string
+        elif value_type == list:
+            # Parse the item type from the dictionary schema.
+            # NOTE: `cls.__pg_properties__.get(prop_name)` would be easier but the value is
+            # only `list` and does not include the item type.
+            # https://github.com/uc-cdis/gen3datamodel/blob/190f998/gdcdatamodel/models/__init__.py#L120
+            # Setting this ^ to `list[<item type>]` may work but it breaks other code.
+            list_item_type = (
+                dictionary.schema.get(cls.label, {})
+                .get("properties", {})
+                .get(prop_name, {})
+                .get("items", {})
+                .get("type")
+            )
+            list_item_type = jsonschema_to_python_type(list_item_type)
+            current_app.logger.debug(
+                f"compile_type_converter: {cls.label}.{prop_name} items type is {list_item_type}"
+            )
+
+            def convert(value):
                 return parse_list_from_string(value, list_item_type=list_item_type)
-            elif value_type == float:
+
+        elif value_type == float:
+
+            def convert(value):
                 if float(value).is_integer():
                     return int(float(value))
                 else:
                     return float(value)
-            elif strip(value) == "":
-                return None
-            else:
-                return value_type(value)
-        except Exception as exception:  # pylint: disable=broad-except
-            current_app.logger.exception(exception)
-            return value
+
+        else:
+
+            def convert(value):
+                if strip(value) == "":
+                    return None
+                else:
+                    return value_type(value)
+
+        def convert_or_keep(value):
+            try:
+                return convert(value)
+            except Exception as exception:  # pylint: disable=broad-except
+                current_app.logger.exception(exception)
+                return value
+
+        return convert_or_keep
+
+    @staticmethod
+    def get_converted_type_from_list(cls, prop_name, value):
+        return DelimitedConverter.compile_type_converter(cls, prop_name)(value)
 
     @staticmethod
     def convert_type(to_cls, key, value):
@@ -325,6 +472,13 @@ class DelimitedConverter(object):
             dict(message=message, columns=columns, line=self.reader.line_num, **kwargs)
         )
 
+    @staticmethod
+    def _copy_lines(lines, copy_to):
+        """Write ``lines`` to ``copy_to`` as they are consumed."""
+        for line in lines:
+            copy_to.write(line)
+            yield line
+
 
 class TSVToJSONConverter(DelimitedConverter):
     def set_reader(self, doc):
@@ -334,6 +488,13 @@ class TSVToJSONConverter(DelimitedConverter):
         f = io.StringIO(doc)
         self.reader = csv.DictReader(f, delimiter="\t")
 
+    def set_stream_reader(self, stream, copy_to=None):
+        self.format = "tsv"
+        lines = iter_normalized_lines(stream)
+        if copy_to is not None:
+            lines = self._copy_lines(lines, copy_to)
+        self.reader = csv.DictReader(lines, delimiter="\t")
+
 
 class CSVToJSONConverter(DelimitedConverter):
     def set_reader(self, doc):
@@ -342,3 +503,10 @@ class CSVToJSONConverter(DelimitedConverter):
         doc = "\n".join(strip(doc).splitlines())
         f = io.StringIO(doc)
         self.reader = csv.DictReader(f, delimiter=",")
+
+    def set_stream_reader(self, stream, copy_to=None):
+        self.format = "csv"
+        lines = iter_normalized_lines(stream)
+        if copy_to is not None:
+            lines = self._copy_lines(lines, copy_to)
+        self.reader = csv.DictReader(lines, delimiter=",")
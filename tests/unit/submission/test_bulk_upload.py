@@ -0,0 +1,104 @@
+import json
+from unittest.mock import MagicMock, patch
+
+import flask
+import pytest
+
+from sheepdog.errors import UserError
+from sheepdog.transactions.upload import bulk_transaction_worker
+from sheepdog.transactions.upload.transaction import BulkUploadTransaction
+from sheepdog.utils.document_store import CompressedDocumentStore
+
+
+@pytest.fixture
+def app():
+    app = flask.Flask(__name__)
+    with app.test_request_context(), patch.multiple(
+        "sheepdog.transactions.transaction_base",
+        models=MagicMock(),
+        auth=MagicMock(),
+        validators=MagicMock(),
+    ), patch.multiple(
+        "sheepdog.transactions.upload.transaction",
+        models=MagicMock(),
+        auth=MagicMock(),
+    ), patch(
+        "sheepdog.transactions.upload.transaction.dbgap"
+    ), patch(
+        "sheepdog.transactions.transaction_base.utils.lookup_project",
+        return_value=MagicMock(state="open"),
+    ):
+        yield app
+
+
+def new_bulk_transaction(**kwargs):
+    db_driver = MagicMock()
+    query = db_driver.nodes.return_value.options.return_value
+    query.get.return_value = MagicMock(id=1, documents=[])
+    return BulkUploadTransaction(
+        program="program",
+        project="project",
+        role="create",
+        logger=MagicMock(),
+        index_client=MagicMock(),
+        flask_config={},
+        db_driver=db_driver,
+        transaction_id=1,
+        **kwargs
+    )
+
+
+def test_bulk_upload_runs_its_subtransactions(app):
+    store = CompressedDocumentStore(min_size=0)
+    transaction = new_bulk_transaction(document_store=store)
+    wrappers = [
+        {"name": "a.json", "doc_format": "json", "doc": json.dumps([])},
+        {"name": "b.json", "doc_format": "json", "doc": json.dumps([])},
+    ]
+
+    # no entities: the transaction fails, but it ran to the end
+    with pytest.raises(UserError) as e:
+        bulk_transaction_worker(transaction, wrappers)
+    assert e.value.message == "Bulk Transaction failed"
+    assert len(transaction.subtransactions) == 2
+    for subtransaction in transaction.subtransactions:
+        assert subtransaction.document_store is store
+        assert subtransaction.transactional_errors == ["Nothing to submit"]
+
+
+def test_bulk_upload_defaults_to_the_app_document_store(app):
+    app.document_store = CompressedDocumentStore()
+    assert new_bulk_transaction().document_store is app.document_store
+
+
+def test_bulk_upload_appends_canonical_json_once(app):
+    from sheepdog.transactions import transaction_base
+
+    table = transaction_base.models.submission.TransactionLog.__table__ = MagicMock()
+    transaction = new_bulk_transaction()
+    wrappers = [
+        {
+            "name": "{}.json".format(i),
+            "doc_format": "json",
+            "doc": json.dumps(
+                [
+                    {"type": "case", "submitter_id": "case-{}-{}".format(i, j)}
+                    for j in range(2)
+                ]
+            ),
+        }
+        for i in range(3)
+    ]
+
+    with pytest.raises(UserError):
+        bulk_transaction_worker(transaction, wrappers)
+
+    # all the subtransactions' documents, in one UPDATE
+    table.update.assert_called_once()
+    session = transaction.db_driver.session_scope.return_value.__enter__.return_value
+    update = table.update.return_value.where.return_value.values.return_value
+    statements = [call.args[0] for call in session.execute.call_args_list]
+    assert statements.count(update) == 1
+    docs = table.c.canonical_json.op.return_value.call_args.args[0].value
+    assert len(docs) == 6
+    assert transaction.transaction_log_writer.canonical_json == []
@@ -0,0 +1,104 @@
+import io
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sheepdog.utils.transforms import (
+    TSVToJSONConverter,
+    iter_normalized_lines,
+    strip,
+)
+
+
+DOCS = [
+    "type\tsubmitter_id\ncase\tcase-1\ncase\tcase-2\n",
+    "\r\n  \n type\tsubmitter_id\r\ncase\tcase-1\r\n\r\ncase\tcase-2\t \r\n\n  ",
+    "type\tsubmitter_id\rcase\tcase-1\r  \rcase\tcase-2",
+    "",
+    " \n\t\n",
+]
+
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_iter_normalized_lines_matches_whole_document(doc):
+    expected = "\n".join(strip(doc).splitlines())
+    stream = io.BytesIO(doc.encode("utf-8"))
+    assert "".join(iter_normalized_lines(stream)) == expected
+
+
+class FakeCase(object):
+    label = "case"
+    __pg_properties__ = {}
+
+
+@patch("sheepdog.utils.transforms.set_row_type", return_value=FakeCase)
+def test_convert_stream_yields_chunks(_):
+    rows = "".join("case\tcase-{}\n".format(i) for i in range(5))
+    doc = "type\tsubmitter_id\n" + rows
+    copy = io.StringIO()
+
+    converter = TSVToJSONConverter()
+    stream = io.BytesIO(doc.encode("utf-8"))
+    chunks = list(converter.convert_stream(stream, chunk_size=2, copy_to=copy))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert chunks[0][0] == {"type": "case", "submitter_id": "case-0"}
+    assert copy.getvalue() == strip(doc)
+    assert converter.docs == []
+
+
+@patch("sheepdog.utils.transforms.set_row_type", return_value=FakeCase)
+def test_delimited_chunks_repeat_header(_):
+    from sheepdog.transactions.upload import _delimited_chunks
+
+    doc = "type\tsubmitter_id\ncase\tcase-0\ncase\tcase-1\ncase\tcase-2\n"
+    stream = io.BytesIO(doc.encode("utf-8"))
+    chunks = list(_delimited_chunks(TSVToJSONConverter(), stream, 2))
+
+    assert [text for text, _ in chunks] == [
+        "type\tsubmitter_id\ncase\tcase-0\ncase\tcase-1\n",
+        "type\tsubmitter_id\ncase\tcase-2",
+    ]
+    assert [len(data) for _, data in chunks] == [2, 1]
+
+
+class FakeSample(object):
+    label = "sample"
+    __pg_properties__ = {"days_to_collection": (float,), "is_ffpe": (bool,)}
+
+
+@patch("sheepdog.utils.transforms.set_row_type", return_value=FakeSample)
+def test_row_plan_is_compiled_once_per_header(_):
+    doc = "type\tdays_to_collection\tis_ffpe\n" + "sample\t3.0\tTrue\n" * 3
+    converter = TSVToJSONConverter()
+    with patch.object(
+        TSVToJSONConverter,
+        "compile_type_converter",
+        wraps=TSVToJSONConverter.compile_type_converter,
+    ) as compile_type_converter:
+        docs, errors = converter.convert(doc)
+
+    assert not errors
+    assert docs == [{"type": "sample", "days_to_collection": 3, "is_ffpe": True}] * 3
+    assert compile_type_converter.call_count == 3
+
+
+@patch("sheepdog.utils.transforms.set_row_type", return_value=FakeCase)
+@patch("sheepdog.transactions.upload.transaction.SPOOL_MAX_SIZE", 1024)
+def test_parse_doc_stream_stores_the_spooled_document(_):
+    from sheepdog.transactions.upload.transaction import UploadTransaction
+
+    doc = "type\tsubmitter_id\n" + "case\tcase-1\n" * 1000
+    transaction = MagicMock()
+    spooled = []
+
+    def new_transaction_document(name, doc_format, spool):
+        # on disk past SPOOL_MAX_SIZE, and read by the store from there
+        spooled.append((spool._rolled, spool.read()))
+
+    transaction.new_transaction_document.side_effect = new_transaction_document
+    stream = io.BytesIO(doc.encode("utf-8"))
+    UploadTransaction.parse_doc_stream(
+        transaction, "doc.tsv", "tsv", TSVToJSONConverter(), stream
+    )
+    assert spooled == [(True, strip(doc))]
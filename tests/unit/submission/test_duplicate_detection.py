@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock
+
+from sheepdog.transactions.entity_base import EntityBase
+from sheepdog.transactions.transaction_base import TransactionBase
+from sheepdog.transactions.upload.transaction import (
+    BulkUploadTransaction,
+    UploadTransaction,
+    duplicated_entities,
+)
+
+
+class FakeEntity(EntityBase):
+    pg_secondary_keys = ()
+    secondary_keys = ()
+    secondary_keys_dicts = []
+
+    def __init__(self, transaction, entity_id, secondary_keys):
+        super(FakeEntity, self).__init__(transaction)
+        self.entity_id = entity_id
+        self.secondary_keys = secondary_keys
+
+
+class FakeTransaction(TransactionBase):
+    def __init__(self):
+        self.logger = MagicMock()
+        self.entities = []
+        self.transactional_errors = []
+
+
+def add_entities(transaction, keys):
+    entities = [FakeEntity(transaction, *key) for key in keys]
+    transaction.entities.extend(entities)
+    return entities
+
+
+def test_duplicated_entities():
+    entities = add_entities(FakeTransaction(), [(1, "a"), (2, "b"), (3, "a")])
+    duplicated = list(duplicated_entities(entities, lambda e: e.secondary_keys))
+    assert duplicated == [("a", [entities[0], entities[2]])]
+
+
+def test_pre_validate_records_non_unique_secondary_keys():
+    transaction = FakeTransaction()
+    add_entities(transaction, [(1, "a"), (2, "a"), (3, "a"), (4, ()), (5, ())])
+    transaction.specify_errors = MagicMock()
+
+    UploadTransaction.pre_validate(transaction)
+    assert (
+        transaction.transactional_errors
+        == [{"message": "Entity is not unique, a", "type": "NOT_UNIQUE"}] * 2
+    )
+
+
+def test_bulk_check_for_duplicates():
+    subtransactions = [FakeTransaction(), FakeTransaction()]
+    first = add_entities(subtransactions[0], [(1, "a"), (2, "b")])
+    second = add_entities(subtransactions[1], [(1, "c"), (3, "b"), (4, "d")])
+    bulk = BulkUploadTransaction.__new__(BulkUploadTransaction)
+    bulk.transactional_errors = []
+    bulk.subtransactions = subtransactions
+
+    bulk.check_for_duplicates()
+    assert [len(e.errors) for e in first + second] == [1, 1, 1, 1, 0]
+    assert first[0].errors[0]["type"] == "NOT_UNIQUE"
+
+
+class FakeNode(dict):
+    label = "case"
+
+
+def test_integrity_check_batches_unique_keys(monkeypatch):
+    schema = {
+        "case": {
+            "uniqueKeys": [["id"], ["project_id", "submitter_id"]],
+            "properties": {"project_id": {}, "submitter_id": {}},
+        }
+    }
+    monkeypatch.setattr(
+        "sheepdog.transactions.upload.transaction.gdcdictionary.schema", schema
+    )
+    transaction = FakeTransaction()
+    entities = add_entities(transaction, [(1, "a"), (2, "b"), (3, "c")])
+    for entity in entities:
+        entity.node = FakeNode(project_id="p", submitter_id=entity.secondary_keys)
+    transaction.existing_props = MagicMock(return_value=[1])
+
+    UploadTransaction.integrity_check(transaction)
+    transaction.existing_props.assert_called_once_with(
+        FakeNode, [{"project_id": "p", "submitter_id": key} for key in "abc"]
+    )
+    assert [len(e.errors) for e in entities] == [0, 1, 0]
+    assert entities[1].errors[0]["keys"] == ["project_id", "submitter_id"]
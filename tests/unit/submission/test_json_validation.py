@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from gen3datamodel.validators import GDCJSONValidator
+import pytest
+
+from sheepdog.transactions.upload import json_validation
+from sheepdog.transactions.upload.json_validation import (
+    BatchJSONValidator,
+    get_schema_validator,
+)
+
+
+SCHEMA = {
+    "case": {
+        "type": "object",
+        "required": ["submitter_id"],
+        "additionalProperties": False,
+        "properties": {
+            "type": {"enum": ["case"]},
+            "submitter_id": {"type": "string"},
+            "age": {"type": "integer", "minimum": 0},
+            "diagnoses": {
+                "type": "array",
+                "items": {"type": "object", "properties": {"id": {"type": "string"}}},
+            },
+        },
+    },
+    "sample": {
+        "type": "object",
+        "properties": {"type": {"enum": ["sample"]}, "count": {"type": "number"}},
+    },
+}
+
+
+@pytest.fixture
+def fake_dictionary(monkeypatch):
+    fake = SimpleNamespace(schema=SCHEMA, settings={"_dict_version": "1.0"})
+    monkeypatch.setattr("sheepdog.dictionary", fake)
+    monkeypatch.setattr(json_validation, "dictionary", fake)
+    monkeypatch.setattr(json_validation, "_validators", {})
+    return fake
+
+
+class FakeEntity(object):
+    def __init__(self, doc):
+        self.doc = doc
+        self.errors = []
+
+    def record_error(self, message, **kwargs):
+        self.errors.append(dict(message=message, **kwargs))
+
+
+DOCS = [
+    {"type": "case", "submitter_id": "a", "age": -1},
+    {"type": "sample", "count": "many"},
+    {"type": "case", "age": 3, "unknown": 1},
+    {"type": "case", "submitter_id": "b", "diagnoses": [{"id": 1}]},
+    {"type": "sample", "count": 2},
+    {"type": "nope"},
+    {"type": "case"},
+]
+
+
+def test_errors_match_gdc_json_validator(fake_dictionary):
+    expected = [FakeEntity(doc) for doc in DOCS]
+    validator = GDCJSONValidator()
+    validator.schemas = fake_dictionary
+    validator.record_errors(expected)
+
+    entities = [FakeEntity(doc) for doc in DOCS]
+    BatchJSONValidator(MagicMock()).record_errors(entities)
+    assert [e.errors for e in entities] == [e.errors for e in expected]
+    assert entities[3].errors[0]["keys"] == ["diagnoses.0.id"]
+    # validation stops at the first entity of an unknown type
+    assert entities[-1].errors == []
+
+
+def test_validators_are_cached_per_dictionary_version(fake_dictionary):
+    validator = get_schema_validator("case")
+    assert get_schema_validator("case") is validator
+
+    fake_dictionary.settings["_dict_version"] = "2.0"
+    assert get_schema_validator("case") is not validator
+
+    fake_dictionary.schema = dict(SCHEMA, case=dict(SCHEMA["case"]))
+    new_validator = get_schema_validator("case")
+    assert new_validator.schema is fake_dictionary.schema["case"]
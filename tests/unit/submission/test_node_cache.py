@@ -0,0 +1,66 @@
+from unittest.mock import MagicMock, patch
+
+from sheepdog.transactions.upload.node_cache import (
+    NodeLookupCache,
+    normalize_secondary_keys,
+)
+
+
+class FakeNode(object):
+    def __init__(self, label, node_id, submitter_id, project_id="CGCI-BLGSP"):
+        self.label = label
+        self.node_id = node_id
+        self._secondary_keys = ((project_id, submitter_id),)
+
+
+def test_normalize_secondary_keys():
+    assert normalize_secondary_keys((("CGCI-BLGSP", "Case-1"),)) == (
+        ("cgci-blgsp", "case-1"),
+    )
+    assert normalize_secondary_keys((("CGCI-BLGSP", None),)) is None
+    assert normalize_secondary_keys(()) is None
+
+
+def test_get_only_answers_for_resolved_keys():
+    cache = NodeLookupCache(MagicMock())
+    node = FakeNode("case", "id-1", "case-1")
+
+    assert cache.get("case", "id-1", node._secondary_keys) is None
+    cache.add(node)
+    assert cache.get("case", "id-1", node._secondary_keys) == [node]
+    assert cache.get("case", "id-1", (("CGCI-BLGSP", "other"),)) == []
+    # secondary keys were never queried, so the cache can't answer for them
+    assert cache.get("case", None, node._secondary_keys) is None
+
+
+def test_lookup_falls_back_to_database_once():
+    cache = NodeLookupCache(MagicMock())
+    node = FakeNode("case", "id-1", "Case-1")
+    keys = (("cgci-blgsp", "CASE-1"),)
+
+    with patch("sheepdog.transactions.upload.node_cache.lookup_node") as lookup:
+        lookup.return_value.all.return_value = [node]
+        assert cache.lookup("case", None, keys) == [node]
+        assert cache.lookup("case", None, keys) == [node]
+        assert cache.lookup("case", "id-1", keys) == [node]
+        lookup.assert_called_once()
+
+        lookup.return_value.all.return_value = []
+        assert cache.lookup("case", "id-2", ()) == []
+        assert cache.lookup("case", "id-2", keys) == []
+        assert lookup.call_count == 2
+
+
+def test_get_drops_nodes_whose_keys_changed():
+    cache = NodeLookupCache(MagicMock())
+    node = FakeNode("case", "id-1", "case-1")
+    keys = node._secondary_keys
+    cache._resolved_secondary_keys.add(("case", normalize_secondary_keys(keys)))
+    cache.add(node)
+    assert cache.get("case", None, keys) == [node]
+
+    # e.g. the submitter_id was updated and the node flushed again
+    node._secondary_keys = (("CGCI-BLGSP", "case-2"),)
+    cache.add(node)
+    assert cache.get("case", None, keys) == []
+    assert cache.get("case", "id-1", node._secondary_keys) == [node]
@@ -0,0 +1,59 @@
+from unittest.mock import MagicMock
+
+from sheepdog.transactions.entity_base import EntityBase
+from sheepdog.transactions.transaction_base import TransactionBase
+
+
+class FakeEntity(EntityBase):
+    pg_secondary_keys = ()
+    secondary_keys = ()
+    secondary_keys_dicts = []
+
+
+class FakeTransaction(TransactionBase):
+    def __init__(self):
+        self.logger = MagicMock()
+        self.entities = []
+        self.transactional_errors = []
+
+
+def test_partition_is_cached_until_an_error_is_recorded():
+    transaction = FakeTransaction()
+    entities = [FakeEntity(transaction) for _ in range(3)]
+    transaction.entities.extend(entities)
+
+    valid = transaction.valid_entities
+    assert valid == entities
+    assert transaction.valid_entities is valid
+    assert transaction.success
+
+    entities[1].record_error("invalid")
+    assert transaction.valid_entities == [entities[0], entities[2]]
+    assert transaction.entity_error_count == 1
+    assert transaction.entity_errors == [entities[1].errors]
+    assert not transaction.success
+
+
+def test_partition_is_invalidated_by_new_entities():
+    transaction = FakeTransaction()
+    entity = FakeEntity(transaction)
+    entity.record_error("invalid before being added")
+    assert transaction.entity_error_count == 0
+
+    transaction.entities.append(entity)
+    assert transaction.entity_error_count == 1
+    assert transaction.valid_entities == []
+
+
+def test_summary_response_json_only_has_invalid_entities():
+    transaction = FakeTransaction()
+    transaction.transaction_id = 1
+    transaction.dry_run = False
+    entities = [FakeEntity(transaction) for _ in range(3)]
+    transaction.entities.extend(entities)
+    entities[2].record_error("invalid")
+
+    doc = transaction.response_json(summary=True)
+    assert doc["entity_error_count"] == 1
+    assert [e["valid"] for e in doc["entities"]] == [False]
+    assert len(list(transaction.response_json()["entities"])) == 3
@@ -0,0 +1,131 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from sheepdog.transactions.transaction_base import TransactionLogWriter
+
+
+@pytest.fixture(autouse=True)
+def models():
+    with patch("sheepdog.transactions.transaction_base.models") as models:
+        yield models
+
+
+def new_db_driver():
+    db_driver = MagicMock()
+    query = db_driver.nodes.return_value.options.return_value
+    query.get.side_effect = lambda id_: MagicMock(id=id_)
+    return db_driver
+
+
+def get_session(db_driver):
+    return db_driver.session_scope.return_value.__enter__.return_value
+
+
+def test_the_log_is_loaded_once_and_written_at_flush_points():
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+
+    for _ in range(3):
+        with writer.transaction_log(1) as log:
+            log.documents.append("document")
+    # loaded in one short session, nothing written yet
+    assert db_driver.session_scope.call_count == 1
+    db_driver.nodes.return_value.options.return_value.get.assert_called_once_with(1)
+
+    with writer.transaction_log(1, flush=True) as flushed_log:
+        assert flushed_log is log
+        log.state = "SUCCEEDED"
+    assert db_driver.session_scope.call_count == 2
+    db_driver.session_scope.assert_called_with(can_inherit=False)
+    get_session(db_driver).add.assert_called_once_with(log)
+    assert writer.tx_log is log
+
+
+def test_changes_of_a_failed_context_are_written_at_the_next_flush_point(models):
+    models.submission.TransactionLog.__table__ = MagicMock()
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+
+    with pytest.raises(ValueError):
+        with writer.transaction_log(1, flush=True):
+            writer.append_canonical_json([{"submitter_id": "case-1"}])
+            raise ValueError()
+    assert writer.canonical_json == [{"submitter_id": "case-1"}]
+
+    writer.flush()
+    get_session(db_driver).execute.assert_called_once()
+    assert writer.canonical_json == []
+
+
+def test_a_failed_flush_loads_the_log_again():
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+    with writer.transaction_log(1):
+        pass
+
+    get_session(db_driver).add.side_effect = RuntimeError()
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert writer.tx_log is None
+
+    get_session(db_driver).add.side_effect = None
+    with writer.transaction_log(1) as log:
+        assert log.id == 1
+    query = db_driver.nodes.return_value.options.return_value
+    assert query.get.call_count == 2
+
+
+def test_switching_logs_writes_the_previous_one():
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+
+    with writer.transaction_log(1) as log:
+        with writer.transaction_log(1) as nested_log:
+            assert nested_log is log
+    with writer.transaction_log(2) as other_log:
+        assert other_log.id == 2
+    get_session(db_driver).add.assert_called_once_with(log)
+
+
+def test_snapshots_are_inserted_in_batches(models):
+    models.submission.TransactionSnapshot.__table__ = MagicMock()
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+    snapshots = [("id-{}".format(i), "create", {}, {"i": i}) for i in range(5)]
+
+    with patch("sheepdog.transactions.transaction_base.SNAPSHOT_INSERT_BATCH_SIZE", 2):
+        with writer.transaction_log(1, flush=True):
+            writer.add_snapshots(iter(snapshots))
+
+    values = models.submission.TransactionSnapshot.__table__.insert.return_value.values
+    batches = [call.args[0] for call in values.call_args_list]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0] == {
+        "transaction_id": 1,
+        "entity_id": "id-0",
+        "action": "create",
+        "old_props": {},
+        "new_props": {"i": 0},
+    }
+    assert get_session(db_driver).execute.call_count == 3
+    assert writer.snapshots == []
+
+
+def test_canonical_json_is_appended_once_across_contexts(models):
+    models.submission.TransactionLog.__table__ = MagicMock()
+    db_driver = new_db_driver()
+    writer = TransactionLogWriter(db_driver)
+
+    for i in range(3):
+        with writer.transaction_log(1):
+            writer.append_canonical_json([{"submitter_id": "case-{}".format(i)}])
+    with writer.transaction_log(1, flush=True):
+        pass
+    with writer.transaction_log(1, flush=True):
+        pass
+
+    assert get_session(db_driver).execute.call_count == 1
+    update = models.submission.TransactionLog.__table__.update
+    update.assert_called_once()
+    assert writer.canonical_json == []
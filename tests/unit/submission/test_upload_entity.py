@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock
+
+from sheepdog.transactions.upload.entity import UploadEntity
+
+
+class FakeNode(object):
+    def __init__(self, properties):
+        self._secondary_keys = tuple(sorted(properties.items()))
+        self._secondary_keys_dicts = [dict(properties)]
+
+
+def make_entity():
+    entity = UploadEntity(MagicMock())
+    entity.get_skeleton_node = MagicMock(
+        side_effect=lambda label, properties: FakeNode(properties)
+    )
+    return entity
+
+
+def test_skeleton_node_is_built_once():
+    entity = make_entity()
+    entity.doc = {"type": "case", "submitter_id": "a"}
+    entity.entity_type = "case"
+
+    assert entity.secondary_keys_dicts == [{"type": "case", "submitter_id": "a"}]
+    assert entity.secondary_keys == (("submitter_id", "a"), ("type", "case"))
+    assert entity.secondary_keys_dicts == [{"type": "case", "submitter_id": "a"}]
+    assert entity.get_skeleton_node.call_count == 1
+
+
+def test_skeleton_node_is_rebuilt_when_the_doc_changes():
+    entity = make_entity()
+    entity.doc = {"submitter_id": "a"}
+    entity.entity_type = "case"
+    assert entity.secondary_keys == (("submitter_id", "a"),)
+
+    entity.doc = {"submitter_id": "b"}
+    assert entity.secondary_keys == (("submitter_id", "b"),)
+
+    entity.doc["submitter_id"] = "c"
+    entity.doc_changed()
+    assert entity.secondary_keys == (("submitter_id", "c"),)
+    assert entity.get_skeleton_node.call_count == 3
+
+
+def test_node_takes_precedence_over_skeleton_node():
+    entity = make_entity()
+    entity.doc = {"submitter_id": "a"}
+    entity.entity_type = "case"
+    entity.node = FakeNode({"submitter_id": "b"})
+
+    assert entity.secondary_keys_dicts == [{"submitter_id": "b"}]
+    assert not entity.get_skeleton_node.called
@@ -1,11 +1,25 @@
 import pytest
 from unittest.mock import patch, MagicMock
+import threading
 import time
 import flask
 import json
 import base64
+from gen3datamodel import models
+from psqlgraph.query import GraphQuery
+from sqlalchemy.dialects import postgresql
 from sheepdog.auth import check_if_jwt_close_to_expiry
 from sheepdog.auth import authorize, AUTHZ_CACHE, CACHE_SECONDS
+from sheepdog.auth import AuthorizationContext, get_subject_path, resolve_subjects
+from sheepdog.auth import KNOWN_RESOURCES, check_resource_access, create_resource
+from sheepdog.auth.cache import AuthzCache, LRUCache
+from sheepdog.auth.mapping import (
+    AUTH_MAPPING_CACHE,
+    ResourceTrie,
+    get_auth_mapping_trie,
+)
+from sheepdog.errors import AuthZError
+from sheepdog.transactions.upload import sync_transaction_resources
 
 
 @pytest.fixture
@@ -48,6 +62,15 @@ def test_check_if_jwt_close_to_expiry():
     assert check_if_jwt_close_to_expiry(valid_token) is False
 
 
+def test_check_if_jwt_close_to_expiry_uses_configured_staleness():
+    """Tests JWT expiration against the configured cache staleness."""
+    token = encode_jwt({"data": "test", "exp": time.time() + 1000})
+    with patch.object(AUTHZ_CACHE, "max_staleness", 2000):
+        assert check_if_jwt_close_to_expiry(token) is True
+    with patch.object(AUTHZ_CACHE, "max_staleness", 10):
+        assert check_if_jwt_close_to_expiry(token) is False
+
+
 @patch("sheepdog.auth.get_jwt_from_header", return_value="jwt")
 @patch("sheepdog.auth.check_if_jwt_close_to_expiry", return_value=False)
 def test_authorize_caching(
@@ -150,3 +173,329 @@ def test_authorize_expired_token(
 
         authorize("program", "project", ["role1"])
         mock_auth_request.call_count == 2
+
+
+@patch("sheepdog.auth.get_jwt_from_header", return_value="jwt")
+@patch("sheepdog.auth.check_if_jwt_close_to_expiry", return_value=False)
+def test_authorize_sends_all_resources_at_once(
+    mock_jwt, mock_jwt_expired, mock_flask_app, mock_auth_request
+):
+    """Ensures the resources are authorized in one request, cached as a whole"""
+
+    AUTHZ_CACHE.clear()
+
+    with patch.object(flask, "current_app") as mock_app:
+        mock_app.auth.auth_request = mock_auth_request
+
+        authorize("program", "project", ["read"], ["/cases/a", "/cases/b"])
+        mock_auth_request.assert_called_once_with(
+            jwt="jwt",
+            service="sheepdog",
+            methods=["read"],
+            resources=[
+                "/programs/program/projects/project/cases/a",
+                "/programs/program/projects/project/cases/b",
+            ],
+        )
+
+        mock_auth_request.return_value = False
+        with pytest.raises(AuthZError):
+            authorize("program", "project", ["read"], ["/cases/a", "/cases/c"])
+        assert mock_auth_request.call_count == 2
+
+        authorize("program", "project", ["read"], ["/cases/a", "/cases/b"])
+        assert mock_auth_request.call_count == 2
+
+
+@patch("sheepdog.auth.authorize")
+def test_check_resource_access_deduplicates_subjects(mock_authorize, graph_app):
+    graph_app.node_authz_entity_name = "case"
+    nodes = [models.Sample(node_id="sample-1"), models.Sample(node_id="sample-2")]
+    RecordingQuery.rows = [("case-1", "c1"), ("case-1", "c1")]
+
+    assert check_resource_access("program", "project", nodes) is None
+    mock_authorize.assert_called_once_with(
+        "program", "project", ["read"], ["/cases/c1"]
+    )
+
+
+@patch("sheepdog.auth.authorize")
+def test_authorization_context_resolves_each_role_once(mock_authorize):
+    """Ensures a transaction authorizes each role and resource only once"""
+
+    def fake_authorize(program, project, roles, resource_list=None):
+        if roles != ["create"]:
+            raise AuthZError("user is unauthorized")
+
+    mock_authorize.side_effect = fake_authorize
+    context = AuthorizationContext()
+
+    for _ in range(3):
+        context.authorize("program", "project", ["create"])
+        with pytest.raises(AuthZError):
+            context.authorize("program", "project", ["update"])
+
+    assert mock_authorize.call_count == 2
+    context.authorize("program", "project", ["create"], ["/subjects/a"])
+    assert mock_authorize.call_count == 3
+
+
+@patch("sheepdog.auth.authorize")
+def test_authorization_context_round_trip(mock_authorize):
+    """Ensures an async transaction only gets the decisions made for it"""
+
+    def fake_authorize(program, project, roles, resource_list=None):
+        if roles != ["create"]:
+            raise AuthZError("user is unauthorized")
+
+    mock_authorize.side_effect = fake_authorize
+    context = AuthorizationContext()
+    context.resolve("program", "project", ["create"])
+    context.resolve("program", "project", ["update"])
+
+    context = AuthorizationContext.from_json(json.loads(json.dumps(context.to_json())))
+    context.authorize("program", "project", ["create"])
+    with pytest.raises(AuthZError):
+        context.authorize("program", "project", ["update"])
+    with pytest.raises(AuthZError):
+        context.authorize("program", "project", ["delete"])
+    assert mock_authorize.call_count == 2
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_authz_cache_ttl_is_bounded_by_token_expiry():
+    backend = MagicMock()
+    cache = AuthzCache(backend, max_staleness=60)
+
+    cache.set("key", True, encode_jwt({"exp": time.time() + 10.5}))
+    assert backend.set.call_args[1]["timeout"] == 10
+    cache.set("key", True, encode_jwt({"exp": time.time() + 1000}))
+    assert backend.set.call_args[1]["timeout"] == 60
+
+    backend.reset_mock()
+    cache.set("key", True, encode_jwt({"exp": time.time() - 10}))
+    backend.set.assert_not_called()
+
+
+def test_authz_cache_counters():
+    cache = AuthzCache(max_staleness=60)
+    key = cache.key("jwt", ["role1"], ["/programs/program/projects/project"])
+    assert "jwt" not in key
+
+    assert cache.get(key) is None
+    cache.set(key, False)
+    assert cache.get(key) is False
+    assert cache.status()["hits"] == 1
+    assert cache.status()["misses"] == 1
+    assert cache.status()["hit_ratio"] == 0.5
+
+
+def test_get_subject_path():
+    sample, aliquot = models.Sample, models.Aliquot
+
+    assert get_subject_path(sample, "cases", "case") == [
+        (models.SampleDerivedFromCase, models.Case)
+    ]
+    assert get_subject_path(aliquot, "samples", "case") == [
+        (models.AliquotDerivedFromSample, sample),
+        (models.SampleDerivedFromCase, models.Case),
+    ]
+    assert get_subject_path(models.Case, "experiments", "case") is None
+
+
+class RecordingQuery(GraphQuery):
+    """Records the SQL of the queries run, returning ``rows`` for each."""
+
+    statements = []
+    rows = []
+
+    def all(self):
+        self.statements.append(
+            str(self.statement.compile(dialect=postgresql.dialect()))
+        )
+        return list(self.rows)
+
+
+@pytest.fixture
+def graph_app():
+    app = flask.Flask(__name__)
+    app.db = MagicMock()
+    app.db.nodes.side_effect = lambda cls: RecordingQuery([cls])
+    RecordingQuery.statements = []
+    RecordingQuery.rows = [("case-1", "c1")]
+    with app.app_context():
+        yield app
+
+
+def test_resolve_subjects_joins_the_path_of_each_label(graph_app):
+    nodes = [
+        models.Case(node_id="case-0", submitter_id="c0"),
+        models.Sample(node_id="sample-1"),
+        models.Sample(node_id="sample-2"),
+        models.Aliquot(node_id="aliquot-1"),
+    ]
+    assert resolve_subjects(nodes, "case") == {("case-0", "c0"), ("case-1", "c1")}
+
+    # one query per label and link, whatever the number of nodes
+    assert len(RecordingQuery.statements) == len(models.Sample._pg_links) + 1
+    sample_cases, aliquot_cases = (
+        RecordingQuery.statements[0],
+        RecordingQuery.statements[-1],
+    )
+    assert "FROM node_sample JOIN edge_samplederivedfromcase" in sample_cases
+    assert "JOIN node_case" in sample_cases
+    assert "JOIN edge_aliquotderivedfromsample" in aliquot_cases
+    assert "JOIN edge_samplederivedfromcase" in aliquot_cases
+
+
+def test_resolve_subjects_of_stop_nodes():
+    nodes = [
+        MagicMock(label="subject", node_id="1", props={"submitter_id": "a"}),
+        MagicMock(label="subject", node_id="1", props={"submitter_id": "a"}),
+        MagicMock(label="subject", node_id="2", props={"submitter_id": "b"}),
+    ]
+    assert resolve_subjects(nodes, "subject") == {("1", "a"), ("2", "b")}
+
+
+def test_resource_trie_authorized_ids():
+    trie = ResourceTrie(
+        {
+            "/programs/p/projects/q/persons/a": ["read"],
+            "/programs/p/projects/q/persons/b": ["read"],
+            "/programs/p/projects/q/persons/c/more": ["read"],
+            "/programs/p/projects/q/samples/d": ["read"],
+            "/programs/p/projects/all": ["read"],
+            "/programs/p/projects/persons/persons": ["read"],
+            "/programs/p/projects/persons/persons/e": ["read"],
+        }
+    )
+    assert sorted(trie.authorized_ids("p", "q", "person")) == ["a", "b"]
+    assert trie.authorized_ids("p", "all", "person") is None
+    assert trie.authorized_ids("p", "persons", "person") is None
+    assert trie.authorized_ids("p", "q", None) == []
+    assert trie.authorized_ids("p", "other", "person") == []
+
+
+def test_auth_mapping_trie_is_cached_until_token_expiry():
+    AUTH_MAPPING_CACHE.clear()
+    get_mapping = MagicMock(return_value={"/programs/p/projects/q": ["read"]})
+    token = encode_jwt({"exp": time.time() + 1000})
+
+    trie = get_auth_mapping_trie("user", token, get_mapping)
+    assert get_auth_mapping_trie("user", token, get_mapping) is trie
+    get_mapping.assert_called_once()
+
+    expired_token = encode_jwt({"exp": time.time() - 1})
+    get_auth_mapping_trie("user", expired_token, get_mapping)
+    get_auth_mapping_trie("user", expired_token, get_mapping)
+    assert get_mapping.call_count == 3
+
+    # mappings that could not be retrieved are not cached
+    get_mapping = MagicMock(return_value=None)
+    other_token = encode_jwt({"exp": time.time() + 1000, "sub": "other"})
+    assert get_auth_mapping_trie("user", other_token, get_mapping).children == {}
+    get_auth_mapping_trie("user", other_token, get_mapping)
+    assert get_mapping.call_count == 2
+
+
+class ArboristStub(object):
+    """Records the resources created, failing for the ``failing`` ones."""
+
+    def __init__(self, failing=()):
+        self.created = []
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+
+    def create_resource(self, parent_path, resource_json, create_parents=False):
+        with self.lock:
+            self.created.append(resource_json["name"])
+        if resource_json["name"] in self.failing:
+            raise Exception("could not create resource")
+        return {"name": resource_json["name"]}
+
+
+@pytest.fixture
+def arborist_app():
+    app = flask.Flask(__name__)
+    app.auth = ArboristStub()
+    app.node_authz_entity = MagicMock(label="subject")
+    app.subject_entity = MagicMock(label="person")
+    KNOWN_RESOURCES.clear()
+    with app.app_context():
+        yield app
+
+
+def test_create_resource_syncs_each_path_once(arborist_app):
+    arborist_app.auth.failing.add("/programs/p/projects/q/persons/b")
+    data = [
+        {"type": "person", "submitter_id": "a"},
+        {"type": "person", "submitter_id": "a"},
+        {"type": "person", "submitter_id": "b"},
+        {"type": "subject", "submitter_id": "s", "persons": {"submitter_id": "a"}},
+        {"type": "sample", "submitter_id": "x"},
+        {"type": "sample", "submitter_id": "y"},
+    ]
+    create_resource("p", "q", data)
+    assert sorted(arborist_app.auth.created) == [
+        "/programs/p/projects/q",
+        "/programs/p/projects/q/persons/a",
+        "/programs/p/projects/q/persons/a/subjects/s",
+        "/programs/p/projects/q/persons/b",
+    ]
+
+    # known resources are skipped, failed ones are retried
+    arborist_app.auth.created = []
+    create_resource("p", "q", data)
+    assert arborist_app.auth.created == ["/programs/p/projects/q/persons/b"]
+
+
+def test_create_resource_resolves_or_skips_incomplete_entities(arborist_app):
+    arborist_app.db = MagicMock()
+    node = MagicMock(props={"submitter_id": "a"})
+    arborist_app.db.nodes.return_value.ids.return_value.first.return_value = node
+    data = [
+        # merged documents link by id
+        {"type": "subject", "submitter_id": "s", "persons": [{"id": "person-a"}]},
+        {"type": "subject", "submitter_id": "t"},
+        {"type": "subject", "submitter_id": "u", "persons": []},
+        {"type": "person"},
+        {"submitter_id": "no type"},
+        {"type": "person", "submitter_id": "b"},
+    ]
+    create_resource("p", "q", data)
+    assert sorted(arborist_app.auth.created) == [
+        "/programs/p/projects/q/persons/a/subjects/s",
+        "/programs/p/projects/q/persons/b",
+    ]
+    arborist_app.db.nodes.return_value.ids.assert_called_once_with("person-a")
+
+
+def test_sync_transaction_resources_only_after_commit(arborist_app):
+    transaction = MagicMock(program="p", project="q", dry_run=False, success=False)
+    transaction.valid_entities = [
+        MagicMock(doc={"type": "person", "submitter_id": "a"})
+    ]
+
+    sync_transaction_resources(transaction)
+    transaction.dry_run, transaction.success = True, True
+    sync_transaction_resources(transaction)
+    assert arborist_app.auth.created == []
+
+    transaction.dry_run = False
+    sync_transaction_resources(transaction)
+    assert arborist_app.auth.created == ["/programs/p/projects/q/persons/a"]
+
+    # a committed transaction doesn't fail because of its resources
+    with patch("sheepdog.auth.create_resource", side_effect=Exception("down")):
+        sync_transaction_resources(transaction)
+    assert transaction.logger.exception.called
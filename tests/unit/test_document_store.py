@@ -0,0 +1,127 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, Text, create_engine, text
+
+from sheepdog.utils.document_store import (
+    CompressedDocumentStore,
+    DocumentStore,
+    LocalObjectStore,
+    ObjectDocumentStore,
+    S3ObjectStore,
+    STORED_PREFIX,
+    decode_stored_documents,
+    document_store_from_config,
+    load_document,
+)
+
+
+DOC = "type\tsubmitter_id\n" + "case\tcase-1\n" * 200
+
+
+def test_database_store_is_verbatim():
+    store = DocumentStore()
+    assert store.dump(DOC, "key") == DOC
+    assert store.load(DOC) == DOC
+
+
+def test_compressed_store_round_trip():
+    store = CompressedDocumentStore("gzip")
+    value = store.dump(DOC, "key")
+    assert value.startswith(STORED_PREFIX + "gzip:")
+    assert len(value) < len(DOC)
+    assert load_document(value) == DOC
+    # small documents aren't worth compressing
+    assert store.dump("{}", "key") == "{}"
+
+
+@pytest.mark.parametrize("store", [DocumentStore(), CompressedDocumentStore()])
+def test_verbatim_documents_are_never_taken_for_stored_values(tmpdir, store):
+    secret = tmpdir.join("secret")
+    secret.write("secret")
+    doc = "{}object::file://{}".format(STORED_PREFIX, secret)
+
+    value = store.dump(doc, "key")
+    assert value != doc
+    assert store.load(value) == doc
+    assert load_document(value) == doc
+
+
+@pytest.mark.parametrize("codec", [None, "gzip"])
+def test_object_store_round_trip(tmpdir, codec):
+    store = ObjectDocumentStore(LocalObjectStore(str(tmpdir)), codec=codec)
+    value = store.dump(DOC, "CGCI-BLGSP/1/doc")
+    assert value.startswith(STORED_PREFIX + "object:")
+    assert tmpdir.join("CGCI-BLGSP", "1", "doc").check()
+    assert store.load(value) == DOC
+
+
+def test_object_references_are_only_followed_into_the_store(tmpdir):
+    store = ObjectDocumentStore(LocalObjectStore(str(tmpdir.join("docs"))))
+    tmpdir.join("secret").write("secret")
+    tmpdir.join("docs-other", "doc").write("secret", ensure=True)
+    for url in [
+        "file://{}".format(tmpdir.join("secret")),
+        "file://{}/../secret".format(tmpdir.join("docs")),
+        "file://{}".format(tmpdir.join("docs-other", "doc")),
+        "s3://host/bucket/key",
+    ]:
+        value = "{}object::{}".format(STORED_PREFIX, url)
+        assert store.load(value) == value
+        assert DocumentStore().load(value) == value
+
+
+def test_s3_object_store_owns_its_bucket_and_prefix():
+    object_store = S3ObjectStore("host", "bucket", prefix="docs/")
+    assert object_store.owns("s3://host/bucket/docs/p/1/doc")
+    assert not object_store.owns("s3://host/bucket/other/doc")
+    assert not object_store.owns("s3://host/other-bucket/docs/doc")
+    assert not object_store.owns("s3://other-host/bucket/docs/doc")
+
+
+@pytest.mark.parametrize("doc", [DOC, "{}", ""])
+def test_stores_dump_files_like_documents(tmpdir, doc):
+    stores = [
+        DocumentStore(),
+        CompressedDocumentStore("gzip"),
+        CompressedDocumentStore("gzip", min_size=0),
+        ObjectDocumentStore(LocalObjectStore(str(tmpdir))),
+        ObjectDocumentStore(LocalObjectStore(str(tmpdir)), codec="gzip"),
+    ]
+    for i, store in enumerate(stores):
+        value = store.dump_file(io.StringIO(doc), "doc-{}".format(i))
+        assert store.load(value) == doc
+        assert (value == doc) == (store.dump(doc, "other-{}".format(i)) == doc)
+
+
+def test_document_store_from_config(tmpdir):
+    assert type(document_store_from_config(None)) is DocumentStore
+    assert document_store_from_config({"backend": "gzip"}).codec == "gzip"
+    store = document_store_from_config({"backend": "local", "path": str(tmpdir)})
+    assert isinstance(store.object_store, LocalObjectStore)
+    with pytest.raises(ValueError):
+        document_store_from_config({"backend": "tape"})
+
+
+def test_stored_documents_are_decoded_when_read():
+    table = Table(
+        "document",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("doc", Text),
+    )
+    decode_stored_documents(SimpleNamespace(__table__=table))
+    engine = create_engine("sqlite://")
+    table.metadata.create_all(engine)
+    stored = CompressedDocumentStore("gzip").dump(DOC, "key")
+    with engine.begin() as connection:
+        connection.execute(table.insert(), [{"id": 1, "doc": stored}])
+        connection.execute(table.insert(), [{"id": 2, "doc": "{}"}])
+
+    with engine.connect() as connection:
+        select = table.select().order_by(table.c.id)
+        assert [row.doc for row in connection.execute(select)] == [DOC, "{}"]
+        # the column still holds the stored value
+        raw = connection.execute(text("SELECT doc FROM document WHERE id = 1"))
+        assert raw.scalar() == stored
@@ -0,0 +1,369 @@
+import json
+import pickle
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import flask
+import pytest
+
+from sheepdog import auth
+from sheepdog.errors import AuthZError, InternalError, TooManyRequestsError
+from sheepdog.transactions.deletion import transaction_worker as deletion_worker
+from sheepdog.transactions.deletion.transaction import DeletionTransaction
+from sheepdog.transactions.upload import single_transaction_worker
+from sheepdog.transactions.upload.transaction import UploadTransaction
+from sheepdog.utils.scheduling import (
+    AsyncPool,
+    AsyncPoolTask,
+    AsyncProcessPool,
+    FairTaskQueue,
+    TransactionSpec,
+    run_transaction_spec,
+    schedule_async_transaction,
+    schedule_transaction,
+)
+
+
+class FakeTransaction(object):
+    transaction_id = 42
+
+
+def test_async_pool_status_and_drain():
+    pool = AsyncPool(max_queue_len=4)
+    started, release = threading.Event(), threading.Event()
+
+    def worker(transaction):
+        started.set()
+        release.wait(5)
+
+    pool.start(1)
+    pool.schedule(worker, FakeTransaction())
+    assert started.wait(5)
+
+    status = pool.status()
+    assert status["workers"] == 1
+    assert status["max_queue_length"] == 4
+    assert status["in_flight_count"] == 1
+    assert status["in_flight"][0]["transaction_id"] == 42
+    assert status["in_flight"][0]["function"] == "worker"
+
+    # still running: the drain times out but no longer accepts tasks
+    assert pool.drain(timeout=0.1) is False
+    with pytest.raises(InternalError):
+        pool.schedule(worker, FakeTransaction())
+
+    release.set()
+    assert pool.drain(timeout=5) is True
+    pool.join()
+    assert pool.status()["in_flight_count"] == 0
+
+
+class FakeProjectTransaction(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+
+def project_task(project_id):
+    return AsyncPoolTask(None, FakeProjectTransaction(project_id))
+
+
+def test_fair_task_queue_round_robin():
+    queue = FairTaskQueue()
+    for project_id in ["a", "a", "a", "b", "c"]:
+        queue.put_nowait(project_task(project_id))
+
+    order = []
+    for _ in range(5):
+        task = queue.get()
+        order.append(task.project_id)
+        queue.task_done(task)
+    assert order == ["a", "b", "c", "a", "a"]
+    assert queue.unfinished_tasks == 0
+
+
+def test_fair_task_queue_project_concurrency():
+    queue = FairTaskQueue(project_concurrency=1)
+    for project_id in ["a", "a", "b"]:
+        queue.put_nowait(project_task(project_id))
+    queue.put_nowait(None)
+
+    first = queue.get()
+    assert first.project_id == "a"
+    # the second "a" task has to wait for the first one
+    assert queue.get().project_id == "b"
+    assert queue.get() is None
+    assert queue.status() == {
+        "a": {"queued": 1, "running": 1},
+        "b": {"queued": 0, "running": 1},
+    }
+
+    queue.task_done(first)
+    assert queue.get().project_id == "a"
+
+
+def test_async_pool_backpressure():
+    pool = AsyncPool(max_queue_len=3, max_project_queue_len=2, retry_after=7)
+    pool.schedule(print, FakeProjectTransaction("a"))
+    pool.schedule(print, FakeProjectTransaction("a"))
+    with pytest.raises(TooManyRequestsError) as e:
+        pool.schedule(print, FakeProjectTransaction("a"))
+    assert e.value.code == 429
+    assert e.value.retry_after == 7
+
+    pool.schedule(print, FakeProjectTransaction("b"))
+    with pytest.raises(TooManyRequestsError):
+        pool.schedule(print, FakeProjectTransaction("c"))
+
+
+def test_rejected_transactions_are_not_left_pending():
+    pool = AsyncPool(max_queue_len=1)
+    transaction = MagicMock(project_id="a")
+    schedule_transaction(pool, transaction, print, transaction)
+    transaction.set_transaction_log_state.assert_not_called()
+
+    with pytest.raises(TooManyRequestsError):
+        schedule_transaction(pool, transaction, print, transaction)
+    transaction.set_transaction_log_state.assert_called_once_with("ERRORED")
+
+
+def test_too_many_requests_sets_retry_after():
+    from sheepdog.api import _too_many_requests, app
+
+    with app.test_request_context():
+        response, code = _too_many_requests(TooManyRequestsError("busy", 7))
+    assert code == 429
+    assert response.headers["Retry-After"] == "7"
+    assert response.json["message"] == "busy"
+
+
+def write_marker(path):
+    with open(path, "w") as f:
+        f.write("done")
+
+
+def test_async_process_pool_runs_and_drains(tmpdir):
+    pool = AsyncProcessPool(max_queue_len=4)
+    pool.start(1)
+    marker = str(tmpdir.join("marker"))
+    pool.schedule(write_marker, marker)
+
+    assert pool.drain(timeout=10) is True
+    pool.join()
+    with open(marker) as f:
+        assert f.read() == "done"
+    status = pool.status()
+    assert status["in_flight_count"] == 0
+    assert status["queue_length"] == 0
+    assert not status["accepting_tasks"]
+
+
+class FakeUploadTransaction(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+def fake_worker(transaction, *args):
+    user = (auth.current_user.id, auth.current_user.username)
+    return transaction, args, flask.has_request_context(), user
+
+
+USER = {"id": "7", "username": "submitter"}
+AUTHZ = [
+    {
+        "program": "CGCI",
+        "project": "BLGSP",
+        "roles": ["create"],
+        "resource_list": [],
+        "authorized": True,
+    }
+]
+
+
+def test_run_transaction_spec_rebuilds_transaction():
+    app = flask.Flask(__name__)
+    app.db = "db"
+    app.index_client = "index_client"
+    spec = TransactionSpec(
+        FakeUploadTransaction,
+        fake_worker,
+        ["name", "json", "{}", {}],
+        user=USER,
+        authz=AUTHZ,
+        program="CGCI",
+        project="BLGSP",
+        transaction_id=1,
+    )
+    spec = pickle.loads(pickle.dumps(spec))
+
+    with app.app_context():
+        transaction, args, has_request, user = run_transaction_spec(spec)
+
+    assert args == ("name", "json", "{}", {})
+    assert not has_request
+    assert user == ("7", "submitter")
+    assert transaction.kwargs["program"] == "CGCI"
+    assert transaction.kwargs["transaction_id"] == 1
+    assert transaction.kwargs["db_driver"] == "db"
+    authz_context = transaction.kwargs["authz_context"]
+    authz_context.authorize("CGCI", "BLGSP", ["create"])
+    # only the decisions made when scheduling are available
+    with pytest.raises(AuthZError):
+        authz_context.authorize("CGCI", "BLGSP", ["update"])
+
+
+def test_transaction_spec_json_round_trip():
+    spec = TransactionSpec(
+        UploadTransaction,
+        single_transaction_worker,
+        ["name", "json", "{}", {}],
+        user=USER,
+        authz=AUTHZ,
+        program="CGCI",
+        project="BLGSP",
+        transaction_id=1,
+    )
+    doc = json.loads(json.dumps(spec.to_json()))
+    assert doc["transaction_cls"] == (
+        "sheepdog.transactions.upload.transaction:UploadTransaction"
+    )
+    assert "headers" not in doc
+
+    spec = TransactionSpec.from_json(doc)
+    assert spec.transaction_cls is UploadTransaction
+    assert spec.worker is single_transaction_worker
+    assert spec.args == ("name", "json", "{}", {})
+    assert spec.user == USER
+    assert spec.authz == AUTHZ
+    assert spec.transaction_kwargs["transaction_id"] == 1
+
+
+def test_transaction_spec_only_resolves_sheepdog_objects():
+    doc = TransactionSpec(FakeUploadTransaction, fake_worker, []).to_json()
+    with pytest.raises(ValueError):
+        TransactionSpec.from_json(doc)
+    doc["transaction_cls"] = "os:system"
+    with pytest.raises(ValueError):
+        TransactionSpec.from_json(doc)
+
+
+@pytest.fixture
+def deletion_app():
+    app = flask.Flask(__name__)
+    with app.test_request_context(), patch.multiple(
+        "sheepdog.transactions.transaction_base",
+        models=MagicMock(),
+        auth=MagicMock(**{"get_transaction_user.return_value": USER}),
+        validators=MagicMock(),
+    ), patch(
+        "sheepdog.transactions.transaction_base.utils.lookup_project",
+        return_value=MagicMock(state="open"),
+    ), patch(
+        "sheepdog.auth.authorize"
+    ):
+        yield app
+
+
+def new_deletion_transaction():
+    return DeletionTransaction(
+        program="CGCI",
+        project="BLGSP",
+        logger=MagicMock(),
+        index_client=MagicMock(),
+        db_driver=MagicMock(),
+        transaction_id=1,
+        authz_context=auth.AuthorizationContext(),
+        to_delete=True,
+    )
+
+
+class RecordingPool(object):
+    def __init__(self, pickles_tasks):
+        self.pickles_tasks = pickles_tasks
+        self.tasks = []
+
+    def schedule(self, function, *args):
+        self.tasks.append((function, args))
+
+
+def test_deletion_transaction_spec(deletion_app):
+    spec = new_deletion_transaction().to_spec(deletion_worker, ["id"])
+    doc = json.loads(json.dumps(spec.to_json()))
+    assert doc["worker"] == "sheepdog.transactions.deletion:transaction_worker"
+    assert doc["args"] == [["id"]]
+    assert doc["user"] == USER
+    assert doc["authz"] == [
+        {
+            "program": "CGCI",
+            "project": "BLGSP",
+            "roles": ["delete"],
+            "resource_list": [],
+            "authorized": True,
+        }
+    ]
+    # the role is set by the transaction itself
+    assert "role" not in doc["transaction_kwargs"]
+    assert doc["transaction_kwargs"]["to_delete"] is True
+    assert doc["transaction_kwargs"]["transaction_id"] == 1
+
+
+def test_async_transactions_use_the_transaction_queue(deletion_app):
+    deletion_app.async_pool = RecordingPool(pickles_tasks=False)
+    transaction = new_deletion_transaction()
+
+    schedule_async_transaction(deletion_worker, transaction, ["id"])
+    assert deletion_app.async_pool.tasks == [(deletion_worker, (transaction, ["id"]))]
+
+    deletion_app.async_transaction_queue = RecordingPool(pickles_tasks=True)
+    schedule_async_transaction(deletion_worker, transaction, ["id"])
+    [(function, (spec,))] = deletion_app.async_transaction_queue.tasks
+    assert function is run_transaction_spec
+    assert spec.transaction_cls is DeletionTransaction
+    assert spec.args == (["id"],)
+    assert len(deletion_app.async_pool.tasks) == 1
+
+
+class SlowPool(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.timeouts = []
+
+    def drain(self, timeout=None):
+        self.timeouts.append(timeout)
+        time.sleep(min(self.seconds, timeout))
+        return False
+
+    def status(self):
+        return {
+            "queue_length": 1,
+            "in_flight_count": 1,
+            "in_flight": [{"transaction_id": 42, "project_id": "CGCI-BLGSP"}],
+            "projects": {"CGCI-BLGSP": {"queued": 1, "running": 1}},
+        }
+
+
+def test_async_drain_shares_one_deadline():
+    from sheepdog.api import async_drain
+
+    app = flask.Flask(__name__)
+    app.config["ASYNC_DRAIN_TIMEOUT"] = 0.3
+    app.async_upload_pool = SlowPool(0.5)
+    app.async_pool = SlowPool(0.5)
+    async_drain(app)
+    assert app.async_upload_pool.timeouts == [pytest.approx(0.3, abs=0.05)]
+    assert app.async_pool.timeouts == [pytest.approx(0, abs=0.05)]
+
+
+def test_async_status_only_has_counts():
+    from sheepdog.api import app
+
+    pool = SlowPool(0)
+    with patch.object(app, "async_pool", pool, create=True), patch.object(
+        app, "async_upload_pool", SlowPool(0), create=True
+    ):
+        response = app.test_client().get("/_status/async")
+    assert response.status_code == 200
+    assert "CGCI-BLGSP" not in response.get_data(as_text=True)
+    assert response.json["in_flight_count"] == 1
+    assert response.json["project_count"] == 1
+    assert response.json["upload_processes"]["queue_length"] == 1
@@ -0,0 +1,52 @@
+import json
+
+import flask
+
+from sheepdog.utils.streaming import (
+    iter_json,
+    spool_json,
+    spooled_json_response,
+)
+
+
+def entity_responses(n):
+    return ({"id": str(i), "errors": [], "unique_keys": [{"i": i}]} for i in range(n))
+
+
+def test_iter_json_streams_generators():
+    doc = {
+        "success": True,
+        "entities": entity_responses(3),
+        "subtransactions": (
+            {"name": name, "response_json": {"entities": entity_responses(1)}}
+            for name in "ab"
+        ),
+    }
+    pieces = list(iter_json(doc))
+    assert len(pieces) > 1
+    assert json.loads("".join(pieces)) == {
+        "success": True,
+        "entities": list(entity_responses(3)),
+        "subtransactions": [
+            {"name": name, "response_json": {"entities": list(entity_responses(1))}}
+            for name in "ab"
+        ],
+    }
+
+
+def test_plain_values_are_serialized_at_once():
+    assert list(iter_json({"a": [1, {"b": None}]})) == ['{"a": [1, {"b": null}]}']
+
+
+def test_spooled_json_response(monkeypatch):
+    monkeypatch.setattr("sheepdog.utils.streaming.RESPONSE_BLOCK_SIZE", 16)
+    doc = {"code": 201, "entities": entity_responses(10)}
+    spool = spool_json(doc)
+
+    with flask.Flask(__name__).test_request_context():
+        response = spooled_json_response(spool, 201)
+        body = response.get_data()
+    assert response.status_code == 201
+    assert response.mimetype == "application/json"
+    assert json.loads(body)["entities"][9]["id"] == "9"
+    assert spool.closed
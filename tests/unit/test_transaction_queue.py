@@ -0,0 +1,32 @@
+from unittest.mock import MagicMock, patch
+
+from sheepdog.utils.transaction_queue import DatabaseTransactionQueue
+
+
+def new_queue():
+    app = MagicMock()
+    session = app.db.session_scope.return_value.__enter__.return_value
+    return DatabaseTransactionQueue(app, lease_seconds=30), session
+
+
+def test_renew_leases_of_transactions_in_flight():
+    queue, session = new_queue()
+    queue.renew_leases()
+    # nothing running, nothing to renew
+    assert not session.query.called
+
+    queue.in_flight[3] = {"transaction_id": 42, "attempts": 1}
+    queue.renew_leases()
+    update = session.query.return_value.filter.return_value.update
+    assert update.call_count == 1
+    assert list(update.call_args[0][0]) == ["claimed_datetime"]
+
+
+@patch("sheepdog.utils.transaction_queue.models")
+def test_transactions_given_up_on_leave_the_queue(models):
+    queue, session = new_queue()
+    queue._is_pending = lambda transaction_id: True
+    session.query.return_value.get.return_value.state = "PENDING"
+    queue.run(3, 42, {}, attempts=queue.max_attempts + 1)
+    assert session.query.return_value.filter.return_value.delete.called
+    assert session.query.return_value.get.return_value.state == "ERRORED"